@@ -1,8 +1,9 @@
 """interface.py contains the functions used by the Python interface which is used in the interaction
 with the API."""
+import functools
 import hashlib as h
 import json
-from typing import List
+from typing import Iterator, List, Union
 import requests
 from fastapi import status
 import server.datastructure as d
@@ -13,12 +14,20 @@ import sys
 import concurrent.futures
 import data_handle as dh
 from datetime import datetime, timedelta
+from time import sleep
 
 from server.security import key_manager # import for development. Split security module into two pieces on deployment
+from server.tracing import Tracer, File_Exporter, CORRELATION_HEADER, PARENT_HEADER
 
 # max size variable
 #max_size = 16793598 # bytes
 max_size = 6478488
+# number of times a request rejected by the server admission control is retried
+max_retries = 5
+# number of names requested per page from the listing and search calls
+page_size = 1000
+# number of time-series samples or appended rows sent per request
+sample_batch_size = 5000
 
 def return_hash(password: str):
     """ Hash function used by the interface. It is used to only send hashes and not plain passwords."""
@@ -32,15 +41,117 @@ def has_common_element(list_A, list_B):
     return any(elem in set_B for elem in list_A)
 
 
+class Traced_Session(requests.Session):
+    """ Session recording a span for every HTTP request and sending its correlation ID to the API. """
+
+    def __init__(self, tracer: Tracer) -> None:
+        super().__init__()
+        self.tracer = tracer
+
+    def request(self, method, url, *args, **kwargs):
+        with self.tracer.span("http " + method, url=url) as span:
+            headers = dict(kwargs.pop("headers", None) or {})
+            headers[CORRELATION_HEADER] = span.trace_id
+            headers[PARENT_HEADER] = span.span_id
+            response = super().request(method, url, *args, headers=headers, **kwargs)
+            span.set("status", response.status_code)
+            span.set("response_bytes", response.headers.get("Content-Length"))
+            return response
+
+
+def traced(function):
+    """ Decorator recording a client span for the interface call when tracing is enabled. """
+    @functools.wraps(function)
+    def wrapper(self, *args, **kwargs):
+        if self.tracer is None:
+            return function(self, *args, **kwargs)
+        with self.tracer.span(function.__name__):
+            return function(self, *args, **kwargs)
+    return wrapper
+
+
+class Ingest_Stream:
+    """ WebSocket connection streaming rows into datasets and samples into time-series experiments. At most window
+    frames are sent ahead of the acknowledgements of the API, so a slow API slows the sender down instead of
+    queueing data. Opened with API_interface.open_ingest_stream. """
+
+    def __init__(self, connection, window: int = 8) -> None:
+        self.connection = connection
+        self.window = window
+        self.next_id = 0
+        self.pending = set()
+        self.written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def receive(self) -> None:
+        """ Waits for the next reply and raises RuntimeError for a rejected frame. """
+        reply = json.loads(self.connection.recv())
+        if "error" in reply:
+            self.pending.discard(reply.get("id"))
+            raise RuntimeError(f"Frame {reply.get('id')} was rejected: {reply['error']}")
+        for frame_id in reply.get("acks") or []:
+            self.pending.discard(frame_id)
+        self.written += reply.get("written") or 0
+
+    def send(self, frame: dict) -> int:
+        while len(self.pending) >= self.window:
+            self.receive()
+        self.next_id += 1
+        frame["id"] = self.next_id
+        self.pending.add(self.next_id)
+        self.connection.send(json.dumps(frame))
+        return self.next_id
+
+    def append_rows(self, project_id: str, experiment_id: str, dataset_id: str, rows: list) -> int:
+        """ Sends rows to append to a dataset. Returns the frame ID. """
+        return self.send({"project": project_id, "experiment": experiment_id, "dataset": dataset_id, "rows": rows})
+
+    def append_samples(self, project_id: str, experiment_id: str, series: str, samples: list) -> int:
+        """ Sends (time, values) samples for a series of a time-series experiment. The time is a datetime or a UNIX
+        timestamp. Returns the frame ID. """
+        rows = [[time.isoformat() if isinstance(time, datetime) else time] + list(values) for time, values in samples]
+        return self.send({"project": project_id, "experiment": experiment_id, "series": series, "rows": rows})
+
+    def flush(self) -> None:
+        """ Waits until every frame sent has been acknowledged. """
+        while len(self.pending) != 0:
+            self.receive()
+
+    def close(self) -> None:
+        try:
+            self.flush()
+        finally:
+            self.connection.close()
+
+
 class API_interface:
     """ The Class containing the interface functions and variables. """
 
-    def __init__(self, path_in: str, user_cache=False) -> None:
+    def __init__(self, path_in: str, user_cache=False, trace_file=None, write_mode=None, fast_insert=False) -> None:
         self.path: str = path_in
         self.token: str = ""
         self.username: str = ""
         self.max_size = max_size
-        self.s = requests.Session()
+        self.max_retries = max_retries
+        self.page_size = page_size
+        # acknowledged, journaled or buffered. None uses the API default (acknowledged)
+        self.write_mode = write_mode
+        # send the datasets to the raw insert, which doesn't validate every data element on the API
+        self.fast_insert = fast_insert
+        # (project, content hash) of the data arrays the API is known to store
+        self.known_blobs = set()
+        # tracing writes the client spans to trace_file and sends the correlation ID to the API
+        self.tracer = None
+        if trace_file is not None:
+            self.tracer = Tracer("interface", File_Exporter(trace_file))
+            self.s = Traced_Session(self.tracer)
+        else:
+            self.s = requests.Session()
 
         self.user_cache = user_cache
         self.cache_proj_name: str
@@ -53,6 +164,42 @@ class API_interface:
         response = self.s.get(self.path)
         return response.status_code == status.HTTP_200_OK
 
+    def post_with_retry(self, url: str, json_in: dict, method: str = "POST", params=None) -> requests.Response:
+        """ Sends a heavy request. Waits for the Retry-After period and retries if the server is busy (HTTP 429)."""
+        response = self.s.request(method, url=url, json=json_in, params=params)
+        retries = 0
+        while response.status_code == status.HTTP_429_TOO_MANY_REQUESTS and retries < self.max_retries:
+            sleep(float(response.headers.get("Retry-After", 1)))
+            response = self.s.request(method, url=url, json=json_in, params=params)
+            retries += 1
+        if response.status_code == status.HTTP_429_TOO_MANY_REQUESTS:
+            raise RuntimeError("The server is busy. Retry the request later.")
+        return response
+
+    def iter_pages(self, url: str, json_in: dict, key: str = "names", query: Union[dict, None] = None) -> Iterator:
+        """ Yields the names (or the entries under key) returned by a paginated call. The next page is only requested once the previous one has
+        been consumed. The query holds extra query parameters of the call. """
+        cursor = None
+        while True:
+            params = dict(query or {}, limit=self.page_size)
+            if cursor is not None:
+                params["cursor"] = cursor
+            response = self.post_with_retry(url, json_in, method="GET", params=params)
+            if response.status_code == status.HTTP_401_UNAUTHORIZED:
+                raise PermissionError(response.json().get("detail"))
+            if response.status_code != status.HTTP_200_OK:
+                raise RuntimeError(f"Listing failed with status {response.status_code}: {response.text}")
+            page = response.json()
+            if not isinstance(page, dict):
+                # the call returns the encoded {"message": False} when the token fails to authenticate
+                return
+            for item in page.get(key):
+                yield item
+            cursor = page.get("next_cursor")
+            if cursor is None:
+                return
+
+    @traced
     def insert_dataset(self, project_name: str, experiment_name: str, dataset_in: d.Dataset) -> bool:
         """ The function responsible for an insertion of a dataset. It authenticates the user and verifies the write permission."""
 
@@ -65,7 +212,7 @@ class API_interface:
         if self.check_object_size(dataset_in):
             # dataset within parameters
             # proceed without fragmentation
-            self.s.post(url=f'{self.path}{project_name}/{experiment_name}/insert_dataset', json=dataset_in.dict())
+            self.post_dataset(project_name, experiment_name, dataset_in)
             return True
         else:
             # dataset needs fragmentation
@@ -74,29 +221,115 @@ class API_interface:
             for dataset_temp in datasets:
                 # insert each dataset
                 dataset_temp.set_credentials(self.username, self.token)
-                response = self.s.post(url=f'{self.path}{project_name}/{experiment_name}/insert_dataset', json=dataset_temp.dict())
+                response = self.post_dataset(project_name, experiment_name, dataset_temp)
                 responses.append(response)
             if False in responses:
                 return False
             else:
                 return True
 
+    def post_dataset(self, project_name: str, experiment_name: str, dataset_in: d.Dataset) -> requests.Response:
+        """ Sends a dataset to the API. Large data arrays are sent with their content hash, and data the API is known to
+        store already is sent as the hash alone. """
+        url = f'{self.path}{project_name}/{experiment_name}/insert_dataset'
+        if self.fast_insert:
+            url += '_raw'
+        if self.write_mode is not None:
+            url += f'?write_mode={self.write_mode}'
+        body = dataset_in.dict()
+        deduplicated = d.count_elements(dataset_in.data) >= d.DEDUP_MIN_ELEMENTS
+        if deduplicated:
+            body["data_hash"] = d.hash_data(dataset_in.data)
+        if self.fast_insert:
+            # the raw insert counts and hashes the data on the request bytes when data is the last field
+            body["data"] = body.pop("data")
+        if not deduplicated:
+            return self.s.post(url=url, json=body)
+        key = (project_name, body["data_hash"])
+        if key in self.known_blobs:
+            response = self.s.post(url=url, json=dict(body, data=[]))
+            if response.status_code != status.HTTP_404_NOT_FOUND:
+                return response
+            # the data was removed from the API since. Send it in full
+            self.known_blobs.discard(key)
+        response = self.s.post(url=url, json=body)
+        if response.status_code == status.HTTP_200_OK:
+            self.known_blobs.add(key)
+        return response
+
+    def flush_writes(self) -> dict:
+        """ Waits until every dataset sent with the buffered write mode has been written. Returns the number of
+        writes flushed and the failures reported by the API. """
+        user_in = d.User(username=self.username, hash_in=self.token)
+        response = self.s.post(self.path + "flush", json=user_in.dict())
+        if response.status_code != status.HTTP_200_OK:
+            raise RuntimeError(f"The flush failed with status {response.status_code}")
+        return response.json()
+
+    def submit_job(self, kind: str, params: dict) -> str:
+        """ Queues a background job on the server, for example grant_permission with {"project": ..., "author": ...,
+        "permission": "read"}, backfill_name_index, collect_blobs or migrate_project with {"project": ...}. Returns the
+        job ID. """
+        request = d.Job_Request(kind=kind, params=params, username=self.username, token=self.token)
+        response = self.s.post(self.path + "jobs", json=request.dict())
+        if response.status_code != status.HTTP_200_OK:
+            raise RuntimeError(f"The job submission failed with status {response.status_code}: {response.text}")
+        return response.json().get("job_id")
+
+    def get_job(self, job_id: str) -> dict:
+        """ Returns the status, progress and result of a submitted job. """
+        user_in = d.User(username=self.username, hash_in=self.token)
+        response = self.s.get(self.path + "jobs/" + job_id, json=user_in.dict())
+        if response.status_code != status.HTTP_200_OK:
+            raise RuntimeError(f"The job lookup failed with status {response.status_code}: {response.text}")
+        return response.json()
+
+    def cancel_job(self, job_id: str) -> dict:
+        """ Cancels a queued job or stops a running job at its next progress report. """
+        user_in = d.User(username=self.username, hash_in=self.token)
+        response = self.s.post(self.path + "jobs/" + job_id + "/cancel", json=user_in.dict())
+        if response.status_code != status.HTTP_200_OK:
+            raise RuntimeError(f"The cancellation failed with status {response.status_code}: {response.text}")
+        return response.json()
+
+    def wait_for_job(self, job_id: str, poll_interval: float = 1.0, timeout: Union[float, None] = None) -> dict:
+        """ Polls the job until it is done, failed or cancelled and returns it. Raises TimeoutError after timeout
+        seconds. """
+        started = datetime.now()
+        while True:
+            job = self.get_job(job_id)
+            if job.get("status") in ("done", "failed", "cancelled"):
+                return job
+            if timeout is not None and datetime.now() - started > timedelta(seconds=timeout):
+                raise TimeoutError(f"The job {job_id} is still {job.get('status')}")
+            sleep(poll_interval)
+
+    def check_blob_exists(self, project_name: str, data_hash: str) -> bool:
+        """ Returns True if the project already stores data with the content hash. """
+        user_in = d.Author(name=self.username, permission="none")
+        response = self.s.get(f'{self.path}{project_name}/blobs/{data_hash}', json=user_in.dict())
+        exists = response.status_code == status.HTTP_200_OK and response.json().get("exists") == True
+        if exists:
+            self.known_blobs.add((project_name, data_hash))
+        return exists
+
+    @traced
     def return_full_dataset(self, project_name: str, experiment_name: str, dataset_name: str):  # -> d.Dataset | None:
         """ The function responsible for returning a dataset. It authenticates the user and verifies the read permission. """
         # TODO: raise exceptions not return False
         user_in = d.User(username=self.username, hash_in=self.token)
-        response = self.s.post(
+        response = self.post_with_retry(
             url=f'{self.path}{project_name}/{experiment_name}/{dataset_name}/return_dataset',
-            json=user_in.dict())
+            json_in=user_in.dict())
         temp = json.loads(response.json())
-        if temp.get("message") == None and temp.get("meta").get("fragmented") != True:
-            # the database was found and the data wasn't fragmented
+        if temp.get("message") == None and (temp.get("meta") or {}).get("fragmented") != True:
+            # the database was found and the data wasn't fragmented or was reassembled by the API
             return d.Dataset(name=temp.get("name"), data=temp.get("data"), meta=temp.get("meta"),
                              data_type=temp.get("data_type"), author=temp.get("author"),
                              data_headings=temp.get("data_headings"))
         elif temp.get("message") == False:
             raise Exception("The dataset wasn't found")
-        # if the dataset is fragmented
+        # if the dataset is fragmented and the API didn't reassemble it
         # recollect the dataset
         front_dataset = d.Dataset(name=temp.get("name"), data=temp.get("data"), meta=temp.get("meta"),
                         data_type=temp.get("data_type"), author=temp.get("author"),
@@ -104,6 +337,7 @@ class API_interface:
         front_dataset = self.collect_frag_data(front_dataset=front_dataset, project_name=project_name, experiment_name=experiment_name, user_in=user_in)
         return front_dataset
 
+    @traced
     def insert_experiment(self, project_name: str, experiment: d.Experiment) -> bool:
         """ The function which utilises insert_dataset to recursively insert a full experiment and initialise it if it doesn't exist. """
 
@@ -120,6 +354,7 @@ class API_interface:
         else:
             return True
 
+    @traced
     def return_full_experiment(self, project_name: str, experiment_name: str) -> d.Experiment:
         """ It returns an Experiment object containing the data within the database. """
         names_list = self.get_dataset_names(project_id=project_name, experiment_id=experiment_name)
@@ -143,6 +378,7 @@ class API_interface:
         # call api for each dataset and return the contents -> then add the contents to an object and return the object
         return d.Experiment(name=exp_name, children=datasets, meta=exp_meta, author=exp_author)
 
+    @traced
     def return_full_project(self, project_name: str):
         """ Utilises the return_experiment function to recursively return the entire project that the user has a permission to view. """
         # check the project exists if not raise error
@@ -163,6 +399,64 @@ class API_interface:
 
 
 
+    @traced
+    def export_project(self, project_name: str, file_name: str, chunk_size: int = 1024 * 1024) -> int:
+        """ Streams the project to an NDJSON file, one project, experiment or dataset per line. The file is written as
+        the data arrives so the project is never held in memory. Time-series experiments aren't exported. Returns the
+        number of bytes written. """
+        user = d.User(username=self.username, hash_in=self.token)
+        response = self.s.post(self.path + project_name + "/export", json=user.dict(), stream=True)
+        retries = 0
+        while response.status_code == status.HTTP_429_TOO_MANY_REQUESTS and retries < self.max_retries:
+            sleep(float(response.headers.get("Retry-After", 1)))
+            response = self.s.post(self.path + project_name + "/export", json=user.dict(), stream=True)
+            retries += 1
+        if response.status_code != status.HTTP_200_OK:
+            raise RuntimeError(f"The export of '{project_name}' failed with status {response.status_code}")
+        written = 0
+        with open(file_name, "wb") as file:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                file.write(chunk)
+                written += len(chunk)
+            file.close()
+        response.close()
+        return written
+
+    @traced
+    def import_project(self, file_name: str, import_id: str = None, chunk_size: int = 1024 * 1024) -> dict:
+        """ Streams an NDJSON project file (see export_project) to the API, which writes the datasets in batches. The
+        file is read in chunks so its size isn't limited by the memory. Returns the import summary. The progress can
+        be followed from another thread with get_import_progress(import_id). """
+        with open(file_name, "rb") as file:
+            project = json.loads(file.readline())
+        if project.get("type") != "project":
+            raise ValueError("The first line of the file must describe the project")
+        credentials = json.dumps({"type": "auth", "username": self.username, "token": self.token}) + "\n"
+
+        def body():
+            yield credentials.encode("utf8")
+            with open(file_name, "rb") as file:
+                chunk = file.read(chunk_size)
+                while len(chunk) != 0:
+                    yield chunk
+                    chunk = file.read(chunk_size)
+                file.close()
+
+        params = {} if import_id is None else {"import_id": import_id}
+        response = self.s.post(self.path + project.get("name") + "/import", data=body(), params=params,
+                               headers={"Content-Type": "application/x-ndjson"})
+        if response.status_code != status.HTTP_200_OK:
+            raise RuntimeError(f"The import failed with status {response.status_code}: {response.text}")
+        return response.json()
+
+    def get_import_progress(self, import_id: str) -> dict:
+        """ Returns the progress of a running or recently finished import. """
+        response = self.s.get(self.path + "import_progress/" + import_id)
+        if response.status_code != status.HTTP_200_OK:
+            return None
+        return response.json()
+
+    @traced
     def insert_project(self, project: d.Project):
         """ Function which inserts project recursively using the insert_experiment function. """
         response_out = []
@@ -259,23 +553,159 @@ class API_interface:
         else:
             return False
 
+    def iter_experiment_names(self, project_id: str) -> Iterator[str]:
+        """ Yields the experiment names of the project one page at a time. """
+        user_in = d.Author(name=self.username, permission="none")
+        return self.iter_pages(self.path + project_id + "/names", user_in.dict())
+
     def get_experiment_names(self, project_id: str):
+        try:
+            return list(self.iter_experiment_names(project_id))
+        except PermissionError:
+            return None
 
+    def iter_dataset_names(self, project_id: str, experiment_id: str) -> Iterator[str]:
+        """ Yields the dataset names of the experiment one page at a time. """
         user_in = d.Author(name=self.username, permission="none")
-        response = self.s.get(self.path + project_id + "/names", json=user_in.dict())
-        return response.json().get("names")
+        return self.iter_pages(self.path + project_id + "/" + experiment_id + "/names", user_in.dict())
 
     def get_dataset_names(self, project_id: str, experiment_id: str) -> List:
+        try:
+            return list(self.iter_dataset_names(project_id, experiment_id))
+        except PermissionError:
+            return None
+
+    def iter_search_dataset_names(self, project_id: str, experiment_id: str, prefix: Union[str, None] = None,
+                                  contains: Union[str, None] = None) -> Iterator[str]:
+        """ Yields the names of the datasets which start with the prefix and contain the substring, one page at a time. """
         user_in = d.Author(name=self.username, permission="none")
-        response = self.s.get(self.path + project_id + "/" + experiment_id + "/names", json=user_in.dict())
-        return response.json().get("names")
+        query = {key: value for key, value in (("prefix", prefix), ("contains", contains)) if value is not None}
+        return self.iter_pages(self.path + project_id + "/" + experiment_id + "/name_search", user_in.dict(),
+                               query=query)
+
+    def search_dataset_names(self, project_id: str, experiment_id: str, prefix: Union[str, None] = None,
+                             contains: Union[str, None] = None) -> List:
+        try:
+            return list(self.iter_search_dataset_names(project_id, experiment_id, prefix, contains))
+        except PermissionError:
+            return None
+
+    def iter_manifest(self, project_id: str, experiment_id: str) -> Iterator[dict]:
+        """ Yields the manifest entries of the experiment one page at a time. Each entry describes a dataset by its
+        name, data_type, data_headings, meta, author, byte_size, element_count and content_hash without the data. """
+        user_in = d.Author(name=self.username, permission="none")
+        return self.iter_pages(self.path + project_id + "/" + experiment_id + "/manifest", user_in.dict(),
+                               key="entries")
+
+    def get_manifest(self, project_id: str, experiment_id: str) -> List[dict]:
+        return list(self.iter_manifest(project_id, experiment_id))
+
+    def append_to_dataset(self, project_id: str, experiment_id: str, dataset_id: str, rows: list) -> int:
+        """ Appends rows to the data of a stored dataset. Only the new rows are sent, so a growing acquisition costs
+        the size of the new data per call. With several data_headings every row is a list with a value per heading.
+        Returns the number of rows appended. """
+        appended = 0
+        url = f'{self.path}{project_id}/{experiment_id}/{dataset_id}/append'
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == sample_batch_size:
+                appended += self.post_rows(url, batch)
+                batch = []
+        if len(batch) != 0:
+            appended += self.post_rows(url, batch)
+        return appended
+
+    def post_rows(self, url: str, rows: list) -> int:
+        request = d.Rows(rows=rows, username=self.username, token=self.token)
+        response = self.post_with_retry(url, request.dict())
+        if response.status_code != status.HTTP_200_OK:
+            raise RuntimeError(f"The append failed with status {response.status_code}: {response.text}")
+        return response.json().get("appended")
+
+    def update_dataset_meta(self, project_id: str, experiment_id: str, dataset_id: str, set_meta: dict = None,
+                            unset_meta: List[str] = None, data_headings: List[str] = None) -> bool:
+        """ Changes meta variables, removes meta variables or replaces the data headings of a stored dataset without
+        downloading and inserting it again. Returns True if the dataset was changed. """
+        request = d.Meta_Update(set=set_meta, unset=unset_meta, data_headings=data_headings, username=self.username,
+                                token=self.token)
+        response = self.s.patch(f'{self.path}{project_id}/{experiment_id}/{dataset_id}/meta', json=request.dict())
+        if response.status_code != status.HTTP_200_OK:
+            raise RuntimeError(f"The meta update failed with status {response.status_code}: {response.text}")
+        return response.json().get("updated")
+
+    def get_derived_dataset(self, project_id: str, experiment_id: str, dataset_id: str, transform: str,
+                            **params) -> d.Dataset:
+        """ Returns a transform of a stored dataset computed by the API: "histogram" (bins, range, log_counts), "fft"
+        (sample_spacing) or "log" (base). Tabular data needs the column (heading or index) or the row parameter. The
+        API stores the result and returns it again until the dataset changes. """
+        request = d.Derived_Request(params=params, username=self.username, token=self.token)
+        response = self.post_with_retry(f'{self.path}{project_id}/{experiment_id}/{dataset_id}/derived/{transform}',
+                                        request.dict())
+        if response.status_code != status.HTTP_200_OK:
+            raise RuntimeError(f"The transform failed with status {response.status_code}: {response.text}")
+        return d.Dataset(**response.json())
+
+    def open_ingest_stream(self, window: int = 8) -> Ingest_Stream:
+        """ Opens an authenticated WebSocket stream for continuous acquisition. Requires the websockets package. """
+        from websockets.sync.client import connect  # only needed for streaming
+        connection = connect(self.path.replace("http", "ws", 1) + "ingest", max_size=None)
+        connection.send(json.dumps({"username": self.username, "token": self.token}))
+        reply = json.loads(connection.recv())
+        if not reply.get("authenticated"):
+            connection.close()
+            raise PermissionError(reply.get("error"))
+        return Ingest_Stream(connection, window)
+
+    def create_timeseries(self, project_id: str, experiment_id: str, headings: List[str], meta: dict = None) -> bool:
+        """ Creates a time-series experiment whose samples have a value for each heading. The user is the author. """
+        author = [d.Author(name=self.username, permission="write").dict()]
+        request = d.Timeseries(headings=headings, meta=meta, author=author, username=self.username, token=self.token)
+        response = self.s.post(f'{self.path}{project_id}/{experiment_id}/create_timeseries', json=request.dict())
+        if response.status_code != status.HTTP_200_OK:
+            raise RuntimeError(f"Creating the experiment failed with status {response.status_code}: {response.text}")
+        return True
+
+    def append_samples(self, project_id: str, experiment_id: str, series: str, samples: list) -> int:
+        """ Appends (time, values) samples to a series of a time-series experiment. The time is a datetime or a UNIX
+        timestamp and the values follow the experiment headings. Returns the number of samples appended. """
+        appended = 0
+        for start in range(0, len(samples), sample_batch_size):
+            batch = d.Sample_Batch(series=series, username=self.username, token=self.token,
+                                   samples=[d.Sample(time=time, values=values)
+                                            for time, values in samples[start:start + sample_batch_size]])
+            response = self.post_with_retry(f'{self.path}{project_id}/{experiment_id}/append_samples',
+                                            json.loads(batch.json()))
+            if response.status_code != status.HTTP_200_OK:
+                raise RuntimeError(f"The append failed with status {response.status_code}: {response.text}")
+            appended += response.json().get("appended")
+        return appended
+
+    def iter_samples(self, project_id: str, experiment_id: str, series: str = None, start: datetime = None,
+                     end: datetime = None, every: float = None) -> Iterator[dict]:
+        """ Yields the samples of a time-series experiment between start and end in time order, one page at a time.
+        Each sample has its time, series and values. With every (seconds) the samples are averaged over intervals of
+        that length and also carry the number of samples averaged. """
+        query = d.Sample_Query(username=self.username, token=self.token, series=series, start=start, end=end,
+                               every=every)
+        return self.iter_pages(f'{self.path}{project_id}/{experiment_id}/samples', json.loads(query.json()),
+                               key="samples")
+
+    def get_samples(self, project_id: str, experiment_id: str, series: str = None, start: datetime = None,
+                    end: datetime = None, every: float = None) -> List[dict]:
+        return list(self.iter_samples(project_id, experiment_id, series, start, end, every))
+
+    def iter_project_names(self) -> Iterator[str]:
+        """ Yields the project names one page at a time. """
+        user_in = d.Author(name=self.username, permission="none")
+        return self.iter_pages(self.path + "names", user_in.dict())
 
     def get_project_names(self):
         """ Returns the list of project names - Lists databases except admin, local and Authentication. """
-        user_in = d.Author(name=self.username, permission="none")
-        response = self.s.get(self.path + "names", json=user_in.dict())
-        project_list = response.json()  # this returns a python dictionary
-        return project_list.get("names")
+        try:
+            return list(self.iter_project_names())
+        except PermissionError:
+            return None
 
     def tree_print(self):
         """Returns the names of all the projects/experiments/datasets the user has access to."""
@@ -374,6 +804,7 @@ class API_interface:
 
     def purge_everything(self):
         self.s.post(self.path +"purge")
+        self.known_blobs.clear()
         print("purged")
 
     def experiment_search_meta(self, meta_search : dict, experiment_id : str, project_id : str):
@@ -389,20 +820,18 @@ class API_interface:
         if response == False:
             raise Exception("The experiment doesn't exist")
 
-        author_temp = d.Author(name=self.username ,permission="write")
-        dataset = d.Dataset(name="search request body", data=[], meta=meta_search, data_type="search", author=[author_temp.dict()], data_headings=[])
-        dataset.set_credentials(self.username, self.token)
-        response = self.s.get(self.path + project_id + "/" + experiment_id + "/meta_search", json=dataset.dict())
-        if response == False:
-            print("No datasets found")
-            return []
-        names = response.json()
-        names = names.get("names")
         datasets = []
-        for name in names:
+        for name in self.iter_meta_search_names(meta_search, experiment_id, project_id):
             datasets.append(self.return_full_dataset(project_name=project_id, experiment_name=experiment_id, dataset_name=name))
         return datasets
 
+    def iter_meta_search_names(self, meta_search: dict, experiment_id: str, project_id: str) -> Iterator[str]:
+        """Yields the names of the datasets matching the meta variables one page at a time"""
+        author_temp = d.Author(name=self.username ,permission="write")
+        dataset = d.Dataset(name="search request body", data=[], meta=meta_search, data_type="search", author=[author_temp.dict()], data_headings=[])
+        dataset.set_credentials(self.username, self.token)
+        return self.iter_pages(self.path + project_id + "/" + experiment_id + "/meta_search", dataset.dict())
+
 # group management functions to be tested
     # Note: Do not append groups to individual datasets unless you already appended it to the experiment and project. Otherwise it won't be returned
     def add_group_to_dataset(self, author_permission:str, author_name:str, group_name:str, project_id:str, experiment_id:str, dataset_id:str):
@@ -0,0 +1,308 @@
+"""load_testing.py measures the throughput of the API server. The FastAPI app is started in process and the requests
+of the interface are sent to it through the Starlette test client, so neither a running server nor Atlas is needed.
+The server is given a mongomock client, an in-memory MongoDB installed with requirements-dev.txt, or connects to the
+MongoDB URL given with --mongo. Every virtual user is a thread with its own account, project and interface session,
+which sends a random mix of logins, project name listings, dataset inserts, dataset downloads and meta searches until
+the run ends. The report holds the throughput and the p50/p95/p99 latency of every operation and, since an operation
+of the interface can send several requests, of every route of the API.
+
+Usage:
+    python load_testing.py --users 16 --duration 30
+    python load_testing.py --mongo mongodb://127.0.0.1:27017 --mix login=1,names=2,return_dataset=4
+
+A real MongoDB is never purged. The accounts and projects of a run are named after its run ID and stay in the
+database."""
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List
+from urllib.parse import urlsplit
+from requests.adapters import BaseAdapter
+
+# the API server modules import each other by their module name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server"))
+import server.datastructure as d
+from interface import API_interface
+import monitoring
+
+# operations and their share of the requests sent by the virtual users
+DEFAULT_MIX = {"login": 1, "names": 2, "insert": 2, "return_dataset": 4, "meta_search": 3}
+DEFAULT_USERS = 8
+DEFAULT_DURATION = 20.0  # seconds
+SEED_DATASETS = 50  # datasets inserted into the project of every virtual user before the run
+DATA_SIZE = 1000  # values per dataset
+SAMPLE_IDS = 10  # distinct values of the sample_id meta variable searched for
+PASSWORD = "load_test_password"
+LOCAL_MONGO = "mongodb://127.0.0.1:27017"
+
+
+def make_client(mongo: str):
+    """Returns the mongomock client the API server is pointed at, or None for a MongoDB URL, which the server connects
+    to itself"""
+    if mongo != "mongomock":
+        return None
+    try:
+        import mongomock
+    except ImportError:
+        raise SystemExit("mongomock isn't installed. Install requirements-dev.txt or pass --mongo with a MongoDB URL")
+    client = mongomock.MongoClient()
+    # the purge call expects the system databases
+    for name in ("admin", "local"):
+        client[name]["load_testing"].insert_one({})
+    return client
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of sorted values"""
+    if len(values) == 0:
+        return float("nan")
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+class Timed_Adapter(BaseAdapter):
+    """Transport adapter of a virtual user recording the latency and the errors of every request by its method and
+    route template, for example POST /{project_id}/{experiment_id}/meta_search"""
+    def __init__(self, adapter: BaseAdapter, app, latencies: Dict[str, List[float]], errors: Dict[str, int]):
+        BaseAdapter.__init__(self)
+        self.adapter = adapter
+        self.app = app
+        self.latencies = latencies
+        self.errors = errors
+
+    def send(self, request, **kwargs):
+        route, _ = monitoring.match_route({"type": "http", "method": request.method,
+                                           "path": urlsplit(request.url).path, "app": self.app})
+        key = f"{request.method} {route}"
+        started = time.perf_counter()
+        try:
+            response = self.adapter.send(request, **kwargs)
+        except Exception:
+            self.errors[key] = self.errors.get(key, 0) + 1
+            raise
+        finally:
+            self.latencies.setdefault(key, []).append(time.perf_counter() - started)
+        if response.status_code >= 400:
+            self.errors[key] = self.errors.get(key, 0) + 1
+        return response
+
+    def close(self) -> None:
+        self.adapter.close()
+
+
+def make_data(generator: random.Random, size: int) -> list:
+    return [[i, generator.random()] for i in range(size // 2)]
+
+
+class Virtual_User(object):
+    """A user of the interface with its own project. The latencies of the operations and of the requests are kept per
+    user and merged after the run."""
+    def __init__(self, index: int, run_id: str, connect: Callable, data_size: int, seed: int):
+        self.username = f"load_{run_id}_{index}"
+        self.project_id = f"load_{run_id}_{index}"
+        self.experiment_id = "experiment_0"
+        self.data_size = data_size
+        self.generator = random.Random(seed + index)
+        self.dataset_names = []
+        self.inserted = 0
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.route_latencies: Dict[str, List[float]] = {}
+        self.route_errors: Dict[str, int] = {}
+        self.ui = connect(self.route_latencies, self.route_errors)
+        self.operations = {
+            "login": self.login,
+            "names": self.names,
+            "insert": self.insert,
+            "return_dataset": self.return_dataset,
+            "meta_search": self.meta_search
+        }
+
+    def dataset(self, name: str):
+        author = [d.Author(name=self.username, permission="write").dict()]
+        return d.Dataset(name=name, data=make_data(self.generator, self.data_size), data_type="load test",
+                         author=author, data_headings=["index", "value"],
+                         meta={"sample_id": self.generator.randrange(SAMPLE_IDS), "user": self.username})
+
+    def set_up(self, seed_datasets: int) -> None:
+        """Creates the account and the project searched and read during the run"""
+        self.ui.create_user(self.username, PASSWORD, "load@test", "load test user")
+        self.ui.generate_token(self.username, PASSWORD)
+        author = [d.Author(name=self.username, permission="write").dict()]
+        self.dataset_names = [f"seed_{i}" for i in range(seed_datasets)]
+        experiment = d.Experiment(name=self.experiment_id, children=[self.dataset(name) for name in self.dataset_names],
+                                  meta=None, author=author)
+        self.ui.insert_project(d.Project(name=self.project_id, author=author, groups=[experiment], meta=None,
+                                         creator=self.username))
+
+    def login(self) -> bool:
+        return self.ui.generate_token(self.username, PASSWORD)
+
+    def names(self) -> bool:
+        return self.ui.get_project_names() is not None
+
+    def insert(self) -> bool:
+        name = f"dataset_{self.inserted}"
+        self.inserted += 1
+        inserted = self.ui.insert_dataset(self.project_id, self.experiment_id, self.dataset(name))
+        if inserted:
+            self.dataset_names.append(name)
+        return inserted is not False
+
+    def return_dataset(self) -> bool:
+        name = self.generator.choice(self.dataset_names)
+        return self.ui.return_full_dataset(self.project_id, self.experiment_id, name) is not None
+
+    def meta_search(self) -> bool:
+        # only the names, experiment_search_meta would also check the experiment and download the datasets
+        meta = {"sample_id": self.generator.randrange(SAMPLE_IDS)}
+        list(self.ui.iter_meta_search_names(meta, self.experiment_id, self.project_id))
+        return True
+
+    def run(self, mix: Dict[str, float], end: float) -> None:
+        # the requests of the set up aren't part of the report
+        self.route_latencies.clear()
+        self.route_errors.clear()
+        names = list(mix)
+        weights = [mix[name] for name in names]
+        while time.perf_counter() < end:
+            operation = self.generator.choices(names, weights)[0]
+            started = time.perf_counter()
+            try:
+                succeeded = self.operations[operation]()
+            except Exception:
+                succeeded = False
+            self.latencies.setdefault(operation, []).append(time.perf_counter() - started)
+            if not succeeded:
+                self.errors[operation] = self.errors.get(operation, 0) + 1
+
+
+def summarise_latencies(latencies: Dict[str, List[float]], errors: Dict[str, int], elapsed: float) -> dict:
+    """Returns the throughput and the latency percentiles in milliseconds of the given latencies"""
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": len(latencies) / elapsed,
+        "p50": percentile(latencies, 0.50) * 1000,
+        "p95": percentile(latencies, 0.95) * 1000,
+        "p99": percentile(latencies, 0.99) * 1000
+    }
+
+
+def summarise(users: List[Virtual_User], elapsed: float) -> Dict[str, Dict[str, dict]]:
+    """Merges the latencies of the users into the throughput and latency percentiles of every operation, with their
+    total, and of every route"""
+    operations = {}
+    for operation in sorted({operation for user in users for operation in user.latencies}):
+        operations[operation] = summarise_latencies(
+            [latency for user in users for latency in user.latencies.get(operation, [])],
+            sum(user.errors.get(operation, 0) for user in users), elapsed)
+    operations["total"] = summarise_latencies(
+        [latency for user in users for values in user.latencies.values() for latency in values],
+        sum(entry["errors"] for entry in operations.values()), elapsed)
+    routes = {}
+    for route in sorted({route for user in users for route in user.route_latencies}):
+        routes[route] = summarise_latencies(
+            [latency for user in users for latency in user.route_latencies.get(route, [])],
+            sum(user.route_errors.get(route, 0) for user in users), elapsed)
+    return {"operations": operations, "routes": routes}
+
+
+def print_table(title: str, entries: Dict[str, dict]) -> None:
+    width = max([len(title)] + [len(name) for name in entries]) + 2
+    print(f"{title:<{width}}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, entry in entries.items():
+        print(f"{name:<{width}}{entry['requests']:>10}{entry['errors']:>8}{entry['throughput']:>10.1f}"
+              f"{entry['p50']:>10.1f}{entry['p95']:>10.1f}{entry['p99']:>10.1f}")
+
+
+def print_report(report: Dict[str, Dict[str, dict]], users: int, duration: float) -> None:
+    print(f"{users} virtual users for {duration:.1f} s")
+    print_table("operation", report["operations"])
+    print()
+    print_table("route", report["routes"])
+
+
+def parse_mix(text: str) -> Dict[str, float]:
+    """Parses the operation mix, for example login=1,names=2"""
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"The operations are {', '.join(DEFAULT_MIX)}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def run_load_test(users: int = DEFAULT_USERS, duration: float = DEFAULT_DURATION, mix: Dict[str, float] = None,
+                  mongo: str = "mongomock", seed_datasets: int = SEED_DATASETS, data_size: int = DATA_SIZE,
+                  seed: int = 0, interface_options: dict = None) -> Dict[str, dict]:
+    """Starts the API server in process, runs the virtual users and returns the report of the operations and of the
+    routes"""
+    client = make_client(mongo)
+    # the server only connects to this URL on the first command, so with mongomock it's never contacted
+    os.environ["RESDATA_MONGO_URL"] = LOCAL_MONGO if client is not None else mongo
+    import API_server
+    if client is not None:
+        API_server.use_client(client)
+    from fastapi.testclient import TestClient
+    run_id = uuid.uuid4().hex[:8]
+    test_client = TestClient(API_server.app)
+
+    def connect(route_latencies: Dict[str, List[float]], route_errors: Dict[str, int]):
+        ui = API_interface("http://testserver/", **(interface_options or {}))
+        # the requests of the interface session are handled by the app in process and timed by route
+        ui.s.mount("http://", Timed_Adapter(test_client.get_adapter("http://testserver/"), API_server.app,
+                                            route_latencies, route_errors))
+        return ui
+
+    with test_client:
+        virtual_users = [Virtual_User(index, run_id, connect, data_size, seed) for index in range(users)]
+        for user in virtual_users:
+            user.set_up(seed_datasets)
+        end = time.perf_counter() + duration
+        started = time.perf_counter()
+        threads = [threading.Thread(target=user.run, args=(mix or DEFAULT_MIX, end), name=user.username)
+                   for user in virtual_users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+    return summarise(virtual_users, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the API server running in process")
+    parser.add_argument("--users", type=int, default=DEFAULT_USERS, help="concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION, help="seconds of load")
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX,
+                        help="weights of the operations, for example login=1,names=2,insert=1")
+    parser.add_argument("--mongo", default="mongomock", help="mongomock or the URL of a local MongoDB")
+    parser.add_argument("--seed-datasets", type=int, default=SEED_DATASETS, help="datasets per user before the run")
+    parser.add_argument("--data-size", type=int, default=DATA_SIZE, help="values per dataset")
+    parser.add_argument("--write-mode", default=None, help="write mode of the inserts")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the operation choices")
+    parser.add_argument("--json", default=None, help="file the report is written to as JSON")
+    arguments = parser.parse_args()
+    started = time.perf_counter()
+    report = run_load_test(arguments.users, arguments.duration, arguments.mix, arguments.mongo,
+                           arguments.seed_datasets, arguments.data_size, arguments.seed,
+                           {"write_mode": arguments.write_mode})
+    print_report(report, arguments.users, arguments.duration)
+    if arguments.json is not None:
+        with open(arguments.json, "w") as file:
+            json.dump({"users": arguments.users, "duration": arguments.duration, "mongo": arguments.mongo,
+                       "mix": arguments.mix, "wall_time": time.perf_counter() - started,
+                       "operations": report["operations"], "routes": report["routes"]},
+                      file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+""" Admission control for the heavy API calls. It limits the number of concurrent heavy requests and the response
+bytes held by the server, both globally and per user, so bulk downloads can't exhaust the server memory."""
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Dict, Union
+from fastapi import HTTPException, status
+from fastapi.responses import Response, StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+# declare constants for the admission control
+MAX_HEAVY_REQUESTS = 16
+MAX_HEAVY_REQUESTS_PER_USER = 4
+MAX_BYTES_IN_FLIGHT = 512 * 1024 * 1024
+MAX_BYTES_IN_FLIGHT_PER_USER = 128 * 1024 * 1024
+QUEUE_TIMEOUT = 10  # seconds an over-limit request waits in the queue. Zero rejects immediately
+RETRY_AFTER = 5  # seconds suggested to the client in the Retry-After header
+
+
+class Ticket(object):
+    """Admission granted to a single request"""
+    def __init__(self, username: str):
+        self.username = username
+        self.nbytes = 0
+        self.released = False
+
+
+class Admitted_Response(Response):
+    """Response which releases its ticket once the body has been sent, also when the client disconnects"""
+    def __init__(self, controller: "Admission_Controller", ticket: Ticket, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.controller = controller
+        self.ticket = ticket
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.controller.release(self.ticket)
+
+
+class Admitted_Streaming_Response(StreamingResponse):
+    """Streaming response which releases its ticket once the last chunk has been sent or the client disconnected"""
+    def __init__(self, controller: "Admission_Controller", ticket: Ticket, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.controller = controller
+        self.ticket = ticket
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.controller.release(self.ticket)
+
+
+class Admission_Controller(object):
+    """Server-wide admission controller. Heavy requests queue for a slot and for response bytes and get a 429
+    with a Retry-After header if they wait longer than the queue timeout. Light requests never touch it."""
+    def __init__(self, max_requests: int = MAX_HEAVY_REQUESTS, max_user_requests: int = MAX_HEAVY_REQUESTS_PER_USER,
+                 max_bytes: int = MAX_BYTES_IN_FLIGHT, max_user_bytes: int = MAX_BYTES_IN_FLIGHT_PER_USER,
+                 queue_timeout: float = QUEUE_TIMEOUT, retry_after: int = RETRY_AFTER):
+        self.max_requests = max_requests
+        self.max_user_requests = max_user_requests
+        self.max_bytes = max_bytes
+        self.max_user_bytes = max_user_bytes
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.requests = 0
+        self.user_requests: Dict[str, int] = {}
+        self.bytes = 0
+        self.user_bytes: Dict[str, int] = {}
+        self.rejected = 0
+        self.condition: Union[asyncio.Condition, None] = None
+
+    def get_condition(self) -> asyncio.Condition:
+        """The condition is created lazily so it belongs to the running event loop"""
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        return self.condition
+
+    def rejection(self) -> HTTPException:
+        self.rejected += 1
+        return HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                             detail="The server is busy with heavy requests. Retry later.",
+                             headers={"Retry-After": str(self.retry_after)})
+
+    async def wait_until(self, predicate) -> None:
+        """Waits until the predicate holds. Must be called with the condition lock held."""
+        if predicate():
+            return
+        if self.queue_timeout <= 0:
+            raise self.rejection()
+        try:
+            await asyncio.wait_for(self.get_condition().wait_for(predicate), self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise self.rejection()
+
+    async def acquire(self, username: str) -> Ticket:
+        """Waits for a heavy request slot"""
+        def slot_free():
+            return self.requests < self.max_requests and self.user_requests.get(username, 0) < self.max_user_requests
+        async with self.get_condition():
+            await self.wait_until(slot_free)
+            self.requests += 1
+            self.user_requests[username] = self.user_requests.get(username, 0) + 1
+        return Ticket(username)
+
+    async def reserve_bytes(self, ticket: Ticket, size: int) -> None:
+        """Waits until the response bytes fit within the budget. A response larger than the budget is admitted
+        once nothing else is in flight."""
+        username = ticket.username
+        def bytes_free():
+            user_bytes = self.user_bytes.get(username, 0)
+            return (self.bytes == 0 or self.bytes + size <= self.max_bytes) and \
+                   (user_bytes == 0 or user_bytes + size <= self.max_user_bytes)
+        async with self.get_condition():
+            await self.wait_until(bytes_free)
+            self.bytes += size
+            self.user_bytes[username] = self.user_bytes.get(username, 0) + size
+            ticket.nbytes += size
+
+    async def release(self, ticket: Ticket) -> None:
+        """Returns the slot and the bytes held by the ticket and wakes up the queued requests. Shielded, so a
+        cancelled request still returns them."""
+        if ticket.released:
+            return
+        ticket.released = True
+        await asyncio.shield(self.give_back(ticket))
+
+    async def give_back(self, ticket: Ticket) -> None:
+        username = ticket.username
+        async with self.get_condition():
+            self.requests -= 1
+            self.bytes -= ticket.nbytes
+            self.user_requests[username] -= 1
+            self.user_bytes[username] = self.user_bytes.get(username, 0) - ticket.nbytes
+            if self.user_requests[username] == 0:
+                self.user_requests.pop(username)
+                self.user_bytes.pop(username, None)
+            self.get_condition().notify_all()
+
+    @asynccontextmanager
+    async def admit(self, username: str):
+        """Holds a heavy request slot for the duration of the block. Used by calls with small responses."""
+        ticket = await self.acquire(username)
+        try:
+            yield ticket
+        finally:
+            await self.release(ticket)
+
+    def respond(self, ticket: Ticket, content: str, media_type: str = "application/json") -> Response:
+        """Returns the response which releases the ticket once the body has been sent"""
+        return Admitted_Response(self, ticket, content=content, media_type=media_type)
+
+    def stream(self, ticket: Ticket, content, media_type: str = "application/json") -> StreamingResponse:
+        """Streams the response from an iterator and releases the ticket once the last chunk has been sent"""
+        return Admitted_Streaming_Response(self, ticket, content, media_type=media_type)
@@ -0,0 +1,259 @@
+""" Project archives in the NDJSON format. Each line is a JSON object with a "type" of project, experiment or dataset.
+The project line comes first and every experiment line comes before the datasets of the experiment, which carry the
+experiment name. The export reads the project through MongoDB cursors one batch at a time and the import writes the
+datasets in bulk batches, so the memory used by either doesn't depend on the project size. Time-series experiments
+are left out of the archives."""
+import json
+from collections import OrderedDict
+from time import time
+from typing import AsyncIterator, Dict, Iterator, List, Union
+from pymongo import ASCENDING
+from pymongo.database import Database
+import datastructure as d
+import blobs
+import manifest
+import pagination
+import security
+import storage
+
+# number of documents fetched from MongoDB per batch during the export
+EXPORT_BATCH_SIZE = 64
+
+EXPERIMENT_CONFIG_TYPE = manifest.EXPERIMENT_CONFIG_TYPE
+"""data_type of the document holding the experiment variables"""
+
+
+def to_line(record: dict) -> bytes:
+    return (json.dumps(record, separators=(",", ":"), default=str) + "\n").encode("utf8")
+
+
+def project_record(config: dict) -> dict:
+    return {
+        "type": "project",
+        "name": config.get("name"),
+        "meta": config.get("meta"),
+        "author": config.get("author"),
+        "creator": config.get("creator")
+    }
+
+
+def experiment_record(config: dict) -> dict:
+    return {
+        "type": "experiment",
+        "name": config.get("name"),
+        "meta": config.get("meta"),
+        "author": config.get("author")
+    }
+
+
+def dataset_record(experiment_id: str, document: dict) -> dict:
+    return {
+        "type": "dataset",
+        "experiment": experiment_id,
+        "name": document.get("name"),
+        "data": document.get("data"),
+        "meta": document.get("meta"),
+        "data_type": document.get("data_type"),
+        "author": document.get("author"),
+        "data_headings": document.get("data_headings")
+    }
+
+
+def export_project(project: Database, username: str) -> Iterator[bytes]:
+    """Yields the NDJSON lines of the project, limited to the experiments and datasets the user can access. Time-series
+    experiments aren't exported, as the archive format has no lines for their samples."""
+    config = project["config"].find_one({}, {"_id": 0})
+    yield to_line(project_record(config))
+    experiment_names = sorted(name for name in project.list_collection_names() if not manifest.is_reserved(name))
+    for experiment_id in experiment_names:
+        collection = project[experiment_id]
+        experiment_config = collection.find_one({"name": experiment_id, "data_type": EXPERIMENT_CONFIG_TYPE})
+        if not security.has_permission(experiment_config, username):
+            continue
+        yield to_line(experiment_record(experiment_config))
+        pagination.ensure_name_index(collection)
+        documents = collection.find({"author.name": username, "_id": {"$ne": experiment_config["_id"]}},
+                                    {"_id": 0}).sort("name", ASCENDING).batch_size(EXPORT_BATCH_SIZE)
+        try:
+            for document in documents:
+                if storage.is_fragmented(document):
+                    # the parts have no authors and are written into the line of the front dataset
+                    extra = {"type": "dataset", "experiment": experiment_id}
+                    for chunk in storage.reassemble(project, experiment_id, document, extra):
+                        yield chunk.encode("utf8")
+                    yield b"\n"
+                else:
+                    yield to_line(dataset_record(experiment_id, blobs.resolve(project, document)))
+        finally:
+            documents.close()
+
+
+# declare constants for the import
+IMPORT_BATCH_SIZE = 256  # datasets written per bulk insert
+IMPORT_BATCH_BYTES = 8 * 1024 * 1024  # bytes of NDJSON buffered before a bulk insert
+MAX_LINE_BYTES = 17 * 1024 * 1024  # a dataset line can't exceed the MongoDB document limit by much
+IMPORT_HISTORY = 100  # number of finished imports whose progress is kept
+
+
+class Import_Progress(object):
+    """Progress of an import, reported by the /import_progress call while the import runs"""
+    def __init__(self, import_id: str, project_id: str):
+        self.import_id = import_id
+        self.project_id = project_id
+        self.status = "running"
+        self.lines = 0
+        self.bytes = 0
+        self.experiments = 0
+        self.datasets = 0
+        self.error = None
+        self.started = time()
+        self.finished = None
+
+    def finish(self, error: Union[str, None] = None) -> None:
+        self.status = "done" if error is None else "failed"
+        self.error = error
+        self.finished = time()
+
+    def to_dict(self) -> dict:
+        return {
+            "import_id": self.import_id,
+            "project": self.project_id,
+            "status": self.status,
+            "lines": self.lines,
+            "bytes": self.bytes,
+            "experiments": self.experiments,
+            "datasets": self.datasets,
+            "error": self.error,
+            "started": self.started,
+            "finished": self.finished
+        }
+
+
+imports: "OrderedDict[str, Import_Progress]" = OrderedDict()
+"""Progress of the running and recently finished imports by import ID"""
+
+
+def register_import(import_id: str, project_id: str) -> Import_Progress:
+    if import_id in imports and imports[import_id].status == "running":
+        raise ValueError(f"The import '{import_id}' is already running")
+    progress = Import_Progress(import_id, project_id)
+    imports[import_id] = progress
+    while len(imports) > IMPORT_HISTORY:
+        imports.popitem(last=False)
+    return progress
+
+
+async def read_lines(stream: AsyncIterator[bytes], max_line_bytes: int = MAX_LINE_BYTES) -> AsyncIterator[bytes]:
+    """Splits a streamed body into lines without holding more than one line in memory"""
+    buffer = bytearray()
+    async for chunk in stream:
+        buffer += chunk
+        start = 0
+        end = buffer.find(b"\n", start)
+        while end != -1:
+            if end > start:
+                yield bytes(buffer[start:end])
+            start = end + 1
+            end = buffer.find(b"\n", start)
+        del buffer[:start]
+        if len(buffer) > max_line_bytes:
+            raise ValueError(f"A line is longer than {max_line_bytes} bytes")
+    if len(buffer.strip()) != 0:
+        yield bytes(buffer)
+
+
+class Importer(object):
+    """Validates the records of an NDJSON project archive and writes the datasets in batches. The project line must
+    come first and every dataset must follow the line of its experiment."""
+    def __init__(self, project: Database, username: str, progress: Import_Progress):
+        self.project = project
+        self.username = username
+        self.progress = progress
+        self.has_project = False
+        self.experiments = set()
+        self.batches: Dict[str, List[dict]] = {}
+        self.batch_count = 0
+        self.batch_bytes = 0
+
+    def add_lines(self, lines: List[bytes]) -> None:
+        """Validates and stages a block of lines and writes the full batches. Blocks, so the API runs it in a worker
+        thread."""
+        for line in lines:
+            self.add_line(line)
+            if self.batch_full():
+                self.flush()
+
+    def add_line(self, line: bytes) -> None:
+        """Validates a line and stages it. Raises ValueError for malformed input and PermissionError if the user
+        can't write to the project or experiment."""
+        self.progress.lines += 1
+        self.progress.bytes += len(line) + 1
+        record = json.loads(line)
+        if not isinstance(record, dict):
+            raise ValueError("Every line must be a JSON object")
+        record_type = record.pop("type", None)
+        if record_type == "project":
+            self.add_project(record)
+        elif record_type == "experiment":
+            self.add_experiment(record)
+        elif record_type == "dataset":
+            self.add_dataset(record, len(line))
+        else:
+            raise ValueError(f"Unknown record type '{record_type}'")
+
+    def add_project(self, record: dict) -> None:
+        if self.has_project:
+            raise ValueError("The archive contains more than one project")
+        project = d.Simple_Request_body(**record)
+        if project.name != self.project.name:
+            raise ValueError(f"The archive contains the project '{project.name}' and not '{self.project.name}'")
+        config = self.project["config"].find_one({}, {"author": 1})
+        if config is None:
+            json_dict = project.convertJSON()
+            json_dict["data"] = []
+            self.project["config"].insert_one(json_dict)
+        elif not security.has_permission(config, self.username, write=True):
+            raise PermissionError("You don't have write access to the project")
+        self.has_project = True
+
+    def add_experiment(self, record: dict) -> None:
+        if not self.has_project:
+            raise ValueError("The project line must come before the experiments")
+        name = record.get("name")
+        if not isinstance(name, str) or manifest.is_reserved(name):
+            raise ValueError(f"'{name}' isn't a valid experiment name")
+        author = record.get("author")
+        if author is None:
+            author = [d.Author(name=self.username, permission="write").dict()]
+        experiment_config = d.Dataset(name=name, data=[], meta=record.get("meta"), data_type=EXPERIMENT_CONFIG_TYPE,
+                                      author=author, data_headings=["experiment_metadata"])
+        collection = self.project[name]
+        existing = collection.find_one({"name": name, "data_type": EXPERIMENT_CONFIG_TYPE}, {"author": 1})
+        if existing is None:
+            document = experiment_config.convertJSON()
+            storage.store_dataset(self.project, name, document)
+        elif not security.has_permission(existing, self.username, write=True):
+            raise PermissionError(f"You don't have write access to the experiment '{name}'")
+        self.experiments.add(name)
+        self.progress.experiments += 1
+
+    def add_dataset(self, record: dict, size: int) -> None:
+        experiment_id = record.pop("experiment", None)
+        if experiment_id not in self.experiments:
+            raise ValueError(f"The dataset '{record.get('name')}' doesn't follow the line of its experiment")
+        dataset = d.Dataset(**record)
+        self.batches.setdefault(experiment_id, []).append(dataset.convertJSON())
+        self.batch_count += 1
+        self.batch_bytes += size
+
+    def batch_full(self) -> bool:
+        return self.batch_count >= IMPORT_BATCH_SIZE or self.batch_bytes >= IMPORT_BATCH_BYTES
+
+    def flush(self) -> None:
+        """Writes the staged datasets with one bulk insert per experiment"""
+        for experiment_id, documents in self.batches.items():
+            storage.store_datasets(self.project, experiment_id, [(document, None) for document in documents])
+            self.progress.datasets += len(documents)
+        self.batches = {}
+        self.batch_count = 0
+        self.batch_bytes = 0
@@ -0,0 +1,130 @@
+""" Content-addressed storage of the data arrays. Each project keeps one copy of every distinct large array in the
+blobs collection, keyed by its content hash, and the datasets reference it with data_ref instead of holding the data.
+Arrays smaller than DEDUP_MIN_ELEMENTS values stay inline. A blob lists the projects which stored it, since the
+consolidated layout shares the blobs collection, and a project only sees and references its own blobs. The blobs no
+longer referenced by the datasets of a project, for example after an append copied the data back into the dataset,
+are removed by the collect_blobs job."""
+import hashlib
+from datetime import datetime, timedelta
+from typing import Set, Tuple, Union
+import bson
+from pymongo import UpdateOne
+from pymongo.database import Database
+from pymongo.errors import DuplicateKeyError
+import datastructure as d
+
+BLOB_COLLECTION = "blobs"
+# blobs stored or referenced more recently are kept by the garbage collection, so a dataset being inserted with the
+# data_hash of a blob isn't left without data
+BLOB_GC_GRACE = timedelta(days=1)
+
+
+def describe_data(data: list, element_count: Union[int, None] = None) -> dict:
+    """Returns the size, value count and content hash of a data array"""
+    return {
+        "byte_size": len(bson.encode({"data": data})),
+        "element_count": element_count if element_count is not None else d.count_elements(data),
+        "content_hash": d.hash_data(data)
+    }
+
+
+def describe_raw(body: bytes) -> Union[dict, None]:
+    """Describes the data array of a raw JSON dataset body from its bytes, without a Python pass over the values.
+    Works when data is the last field and holds numbers and nested arrays only, as sent by the interface, and returns
+    None otherwise. The hash is the same as hash_data of the parsed data if the numbers are written as Python
+    writes them."""
+    body = body.rstrip()
+    if not body.endswith(b"}"):
+        return None
+    key_end = body.rfind(b'"')
+    # an escaped quote would make the key end with data without being data
+    if key_end < 6 or body[key_end - 5:key_end + 1] != b'"data"' or body[key_end - 6:key_end - 5] == b"\\":
+        return None
+    separator, _, span = body[key_end + 1:-1].partition(b":")
+    span = span.translate(None, b" \t\r\n")
+    if separator.strip() != b"" or not span.startswith(b"[") or not span.endswith(b"]") or b"{" in span or \
+            b"}" in span:
+        return None
+    # every value is followed by a comma except the last one of each non-empty array
+    element_count = span.count(b",") + 1 - span.count(b"[]")
+    return {"byte_size": None, "element_count": element_count, "content_hash": hashlib.sha256(span).hexdigest()}
+
+
+def blob_query(project: Database, content_hash: str) -> dict:
+    """Returns the query of a blob stored by the project"""
+    return {"_id": content_hash, "projects": project.name}
+
+
+def has_blob(project: Database, content_hash: str) -> bool:
+    return project[BLOB_COLLECTION].find_one(blob_query(project, content_hash), {"_id": 1}) is not None
+
+
+def store(project: Database, document: dict, data_hash: Union[str, None] = None,
+          description: Union[dict, None] = None) -> Tuple[dict, Union[dict, None]]:
+    """Moves the data of a dataset document into the blobs collection. Returns the document to insert and the
+    description of its data, or the unchanged document and None when the data stays inline. A document with empty
+    data and a data_hash references a stored blob and raises KeyError if the blob doesn't exist. The description of
+    the data can be passed in when it is already known, for example from describe_raw."""
+    data = document.get("data") or []
+    if len(data) == 0 and data_hash is not None:
+        blob = project[BLOB_COLLECTION].find_one_and_update(blob_query(project, data_hash),
+                                                            {"$set": {"referenced": datetime.utcnow()}}, {"data": 0})
+        if blob is None:
+            raise KeyError(data_hash)
+        description = {"byte_size": blob.get("byte_size"), "element_count": blob.get("element_count"),
+                       "content_hash": data_hash}
+    else:
+        element_count = d.count_elements(data) if description is None else description["element_count"]
+        if element_count < d.DEDUP_MIN_ELEMENTS:
+            return document, None
+        if description is None:
+            description = describe_data(data, element_count)
+        elif description.get("byte_size") is None:
+            description = dict(description, byte_size=len(bson.encode({"data": data})))
+        update = {"$setOnInsert": {"data": data, "byte_size": description["byte_size"], "element_count": element_count},
+                  "$addToSet": {"projects": project.name}, "$set": {"referenced": datetime.utcnow()}}
+        try:
+            project[BLOB_COLLECTION].update_one({"_id": description["content_hash"]}, update, upsert=True)
+        except DuplicateKeyError:
+            # a concurrent insert stored the same data first, so the blob exists now
+            project[BLOB_COLLECTION].update_one({"_id": description["content_hash"]}, update)
+    stored = {key: value for key, value in document.items() if key != "data"}
+    stored["data_ref"] = description["content_hash"]
+    return stored, description
+
+
+def resolve(project: Database, document: Union[dict, None]) -> Union[dict, None]:
+    """Replaces the data reference of a dataset document with the data"""
+    if document is None or "data_ref" not in document:
+        return document
+    blob = project[BLOB_COLLECTION].find_one({"_id": document["data_ref"]}, {"data": 1})
+    document = dict(document)
+    document["data"] = blob.get("data") if blob is not None else []
+    document.pop("data_ref")
+    return document
+
+
+def collect_garbage(project: Database, referenced: Set[str], now: Union[datetime, None] = None) -> int:
+    """Removes the project from the blobs its datasets don't reference, leaving out those referenced within the
+    grace period, and deletes the blobs no project holds any more. Returns the number of blobs released."""
+    cutoff = (now or datetime.utcnow()) - BLOB_GC_GRACE
+    collection = project[BLOB_COLLECTION]
+    unreferenced = [blob["_id"] for blob in collection.find({"projects": project.name, "referenced": {"$lt": cutoff}},
+                                                            {"_id": 1})
+                    if blob["_id"] not in referenced]
+    if len(unreferenced) == 0:
+        return 0
+    condition = {"projects": project.name, "referenced": {"$lt": cutoff}}
+    collection.bulk_write([UpdateOne({"_id": content_hash, **condition}, {"$pull": {"projects": project.name}})
+                           for content_hash in unreferenced], ordered=False)
+    collection.delete_many({"_id": {"$in": unreferenced}, "projects": {"$size": 0}})
+    return len(unreferenced)
+
+
+def copy_request(project_id: str, blob: dict) -> UpdateOne:
+    """Returns the upsert copying a blob of a project database into the shared blobs collection, where another
+    project may have stored the same data"""
+    fields = {key: value for key, value in blob.items() if key not in ("_id", "projects", "referenced")}
+    return UpdateOne({"_id": blob["_id"]}, {"$setOnInsert": fields, "$addToSet": {"projects": project_id},
+                                            "$max": {"referenced": blob.get("referenced") or datetime.utcnow()}},
+                     upsert=True)
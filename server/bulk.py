@@ -0,0 +1,32 @@
+""" Bulk write requests for the collections of both storage layouts. A scoped collection of the consolidated layout
+needs its scope in the filter and in the written document of every request, so the requests are built here from plain
+arguments instead of being rewritten by the collection."""
+from typing import Union
+from pymongo import InsertOne, ReplaceOne, UpdateOne
+from pymongo.collection import Collection
+
+
+def get_scope(collection: Collection) -> Union[dict, None]:
+    """Returns the scope of a scoped collection or None for a plain collection"""
+    # attributes of a pymongo collection are its subcollections
+    scope = getattr(collection, "scope", None)
+    return scope if isinstance(scope, dict) else None
+
+
+def update_one(collection: Collection, filter: dict, update: dict, upsert: bool = False) -> UpdateOne:
+    if get_scope(collection) is not None:
+        filter = collection.scoped(filter)
+    return UpdateOne(filter, update, upsert=upsert)
+
+
+def replace_one(collection: Collection, filter: dict, replacement: dict, upsert: bool = False) -> ReplaceOne:
+    if get_scope(collection) is not None:
+        filter = collection.scoped(filter)
+        replacement = collection.document(replacement)
+    return ReplaceOne(filter, replacement, upsert=upsert)
+
+
+def insert_one(collection: Collection, document: dict) -> InsertOne:
+    if get_scope(collection) is not None:
+        document = collection.document(document)
+    return InsertOne(document)
@@ -1,9 +1,28 @@
 # this file contains the class which describes the datastructure
 from ctypes import string_at
 from typing import Union, List
+import hashlib
+import json
 from pydantic import BaseModel
 import random
-from datetime import date
+from datetime import date, datetime
+
+
+# data arrays with fewer values are stored inline and not deduplicated
+DEDUP_MIN_ELEMENTS = 64
+
+
+def hash_data(data: list) -> str:
+    """Content hash of a data array. The interface and the API compute the same value for the same data."""
+    return hashlib.sha256(json.dumps(data, separators=(",", ":"), sort_keys=True).encode("utf8")).hexdigest()
+
+
+def count_elements(data) -> int:
+    """Returns the number of values in the data array, counting the values of nested arrays"""
+    if not isinstance(data, list):
+        return 1
+    nested = [value for value in data if isinstance(value, list)]
+    return len(data) - len(nested) + sum(count_elements(value) for value in nested)
 
 
 class Dataset(BaseModel):
@@ -23,6 +42,8 @@ class Dataset(BaseModel):
     """Optional variable used during authentication. Works as a credentials requests body. Contain the username of the user inserting the dataset"""
     token: Union[str, None] = None
     """Optional variable used during authentication. Generated JWT token which is then used to verify that the user authenticated."""
+    data_hash: Union[str, None] = None
+    """Optional content hash of the data. A dataset sent with empty data and the hash references data the API already stores."""
 
     # additions not finalised
     data_headings: List[str]
@@ -220,3 +241,85 @@ class Ring(BaseModel):
                               data_headings=self.spectrum_headings[i])
             self.datasets.append(dataset)
         return self.datasets
+
+
+class Rows(BaseModel):
+    """Request body appending rows to the data of a dataset"""
+    rows: List
+    """Values appended to the data. With several data_headings every row is a list with a value per heading."""
+    username: str
+    token: str
+
+
+class Meta_Update(BaseModel):
+    """Request body changing the meta variables or the data headings of a dataset without its data"""
+    set: Union[dict, None] = None
+    """Meta variables to add or change"""
+    unset: Union[List[str], None] = None
+    """Names of the meta variables to remove"""
+    data_headings: Union[List[str], None] = None
+    """New data headings"""
+    username: str
+    token: str
+
+
+class Derived_Request(BaseModel):
+    """Request body of a derived dataset"""
+    params: Union[dict, None] = None
+    """Parameters of the transform, for example {"column": "intensity", "bins": 20}"""
+    username: str
+    token: str
+
+
+class Timeseries(BaseModel):
+    """Request body creating a time-series experiment. The samples of the experiment are stored in a MongoDB
+    time-series collection instead of datasets."""
+    headings: List[str]
+    """Names of the values of every sample, in order"""
+    meta: Union[dict, None] = None
+    """User generated metadata."""
+    author: List[dict]
+    """Experiment author list. See experiment."""
+    username: str
+    token: str
+
+
+class Sample(BaseModel):
+    """A timestamped sample of a time-series experiment"""
+    time: datetime
+    """Time of the measurement. ISO 8601 strings and UNIX timestamps are accepted."""
+    values: List[Union[float, None]]
+    """Measured values in the order of the experiment headings"""
+
+
+class Sample_Batch(BaseModel):
+    """Request body appending samples to a series of a time-series experiment"""
+    series: str
+    """Name of the series, for example the instrument channel"""
+    samples: List[Sample]
+    username: str
+    token: str
+
+
+class Sample_Query(BaseModel):
+    """Request body of a time-range query of a time-series experiment"""
+    username: str
+    token: str
+    series: Union[str, None] = None
+    """Only returns the samples of this series"""
+    start: Union[datetime, None] = None
+    """Inclusive start of the time range"""
+    end: Union[datetime, None] = None
+    """Exclusive end of the time range"""
+    every: Union[float, None] = None
+    """Downsampling interval in seconds. The samples are averaged over intervals of this length."""
+
+
+class Job_Request(BaseModel):
+    """Request body submitting a background job"""
+    kind: str
+    """Name of the job, for example "grant_permission" """
+    params: Union[dict, None] = None
+    """Parameters of the job, for example {"project": ..., "author": ..., "permission": "read"}"""
+    username: str
+    token: str
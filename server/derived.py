@@ -0,0 +1,175 @@
+""" Derived datasets. Transforms such as histograms, FFTs and logarithms are computed from a stored dataset with NumPy
+and the results are stored in the derived collection of the project, keyed by the experiment, the source dataset,
+the transform and its parameters. Every result records the _id and the version of its source, which is incremented
+by the writes to the source, so an outdated result is recomputed instead of being returned. The writes also delete
+the results of their dataset."""
+import json
+from typing import Callable, Dict, List, Tuple, Union
+import numpy as np
+from pymongo import ASCENDING
+from pymongo.database import Database
+from pymongo.errors import DocumentTooLarge
+
+DERIVED_COLLECTION = "derived"
+DERIVED_TYPE = "derived"
+"""data_type of the returned derived datasets"""
+
+# projects which already have the derived index
+indexed_projects = set()
+
+
+def select_values(data: list, headings: Union[List[str], None], params: dict) -> Tuple[np.ndarray, str]:
+    """Returns the values a transform works on and their heading. One dimensional data is used as it is. Rows of
+    values need the column parameter, a heading or an index, and data stored as a list of columns needs the row
+    parameter, the index of the list."""
+    try:
+        values = np.asarray(data, dtype=float)
+    except (TypeError, ValueError):
+        raise ValueError("The data must be numeric")
+    headings = headings or []
+    if values.ndim == 1 and "column" not in params and "row" not in params:
+        return values, headings[0] if len(headings) != 0 else "value"
+    if values.ndim != 2:
+        raise ValueError("The data must be a list of values or a table of values")
+    if "column" in params:
+        column = params["column"]
+        if isinstance(column, str):
+            if column not in headings:
+                raise ValueError(f"The dataset has no heading '{column}'")
+            column = headings.index(column)
+        if not isinstance(column, int) or not 0 <= column < values.shape[1]:
+            raise ValueError("The column doesn't exist")
+        return values[:, column], headings[column] if column < len(headings) else f"column {column}"
+    if "row" in params:
+        row = params["row"]
+        if not isinstance(row, int) or not 0 <= row < values.shape[0]:
+            raise ValueError("The row doesn't exist")
+        return values[row], headings[row] if row < len(headings) else f"row {row}"
+    raise ValueError("Tabular data needs the column or the row parameter")
+
+
+def to_list(values: np.ndarray) -> list:
+    """Converts an array to JSON values. Values which aren't finite become None."""
+    return [float(value) if np.isfinite(value) else None for value in values]
+
+
+def histogram(data: list, headings: Union[List[str], None], params: dict) -> Tuple[list, List[str]]:
+    """Counts of the values in bins, as rows of bin centre and count. With log_counts the empty bins are dropped and
+    the natural logarithm of the counts is returned, like testing.generate_model_data."""
+    values, heading = select_values(data, headings, params)
+    bins = params.get("bins", 10)
+    if not isinstance(bins, int) or bins < 1:
+        raise ValueError("bins must be a positive integer")
+    value_range = params.get("range")
+    if value_range is not None and (not isinstance(value_range, list) or len(value_range) != 2):
+        raise ValueError("range must be a list of the lower and upper edge")
+    counts, edges = np.histogram(values[np.isfinite(values)], bins=bins, range=value_range)
+    centres = (edges[:-1] + edges[1:]) / 2
+    if params.get("log_counts"):
+        kept = counts > 0
+        return [[float(centre), float(np.log(count))] for centre, count in zip(centres[kept], counts[kept])], \
+               [heading, "log(count)"]
+    return [[float(centre), int(count)] for centre, count in zip(centres, counts)], [heading, "count"]
+
+
+def fft(data: list, headings: Union[List[str], None], params: dict) -> Tuple[list, List[str]]:
+    """Amplitude spectrum of real values, as rows of frequency and amplitude. sample_spacing is the interval between
+    the values."""
+    values, heading = select_values(data, headings, params)
+    spacing = params.get("sample_spacing", 1.0)
+    if not isinstance(spacing, (int, float)) or spacing <= 0:
+        raise ValueError("sample_spacing must be positive")
+    amplitudes = np.abs(np.fft.rfft(values))
+    frequencies = np.fft.rfftfreq(len(values), d=spacing)
+    return [[float(frequency), float(amplitude)] for frequency, amplitude in zip(frequencies, amplitudes)], \
+           ["frequency", f"amplitude({heading})"]
+
+
+def log(data: list, headings: Union[List[str], None], params: dict) -> Tuple[list, List[str]]:
+    """Logarithm of the values with the base parameter, e by default. Values which aren't positive become None."""
+    values, heading = select_values(data, headings, params)
+    base = params.get("base")
+    if base is not None and (not isinstance(base, (int, float)) or base <= 0 or base == 1):
+        raise ValueError("base must be positive and not 1")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result = np.log(values) if base is None else np.log(values) / np.log(base)
+    return to_list(result), [f"log({heading})"]
+
+
+TRANSFORMS: Dict[str, Callable[[list, Union[List[str], None], dict], Tuple[list, List[str]]]] = {
+    "histogram": histogram,
+    "fft": fft,
+    "log": log
+}
+
+
+def params_key(transform: str, params: Union[dict, None]) -> str:
+    """Returns the normalised parameters used in the cache key. Raises ValueError for unknown transforms."""
+    if transform not in TRANSFORMS:
+        raise ValueError(f"The transform must be one of {', '.join(TRANSFORMS)}")
+    return json.dumps(params or {}, sort_keys=True, separators=(",", ":"))
+
+
+def compute(transform: str, params: Union[dict, None], data: list,
+            headings: Union[List[str], None]) -> Tuple[list, List[str]]:
+    """Runs the transform. Raises ValueError if the data or the parameters don't suit it."""
+    return TRANSFORMS[transform](data, headings, params or {})
+
+
+def get_derived(project: Database):
+    """Returns the derived collection of the project. The index is checked once per project and process."""
+    collection = project[DERIVED_COLLECTION]
+    if project.name not in indexed_projects:
+        collection.create_index([("experiment", ASCENDING), ("source", ASCENDING), ("transform", ASCENDING),
+                                 ("params", ASCENDING)], unique=True)
+        indexed_projects.add(project.name)
+    return collection
+
+
+def lookup(project: Database, experiment_id: str, source: dict, transform: str, key: str) -> Union[dict, None]:
+    """Returns the stored result if it was computed from the current version of the source"""
+    result = get_derived(project).find_one({"experiment": experiment_id, "source": source["name"],
+                                            "transform": transform, "params": key})
+    if result is None or result.get("source_id") != source["_id"] or \
+            result.get("source_version") != source.get("version", 0):
+        return None
+    return result
+
+
+def store(project: Database, experiment_id: str, source: dict, transform: str, key: str, data: list,
+          headings: List[str]) -> dict:
+    """Stores a result. Results larger than a MongoDB document are returned without being stored."""
+    result = {
+        "experiment": experiment_id,
+        "source": source["name"],
+        "source_id": source["_id"],
+        "source_version": source.get("version", 0),
+        "transform": transform,
+        "params": key,
+        "data": data,
+        "data_headings": headings
+    }
+    try:
+        get_derived(project).replace_one({"experiment": experiment_id, "source": source["name"],
+                                          "transform": transform, "params": key}, result, upsert=True)
+    except DocumentTooLarge:
+        pass
+    return result
+
+
+def invalidate(project: Database, experiment_id: str, name: str) -> None:
+    """Deletes the results computed from a dataset"""
+    project[DERIVED_COLLECTION].delete_many({"experiment": experiment_id, "source": name})
+
+
+def to_dataset(result: dict, author: List[dict]) -> dict:
+    """Returns a result in the form of a dataset. The meta variables describe how it was derived."""
+    return {
+        "name": f"{result['source']}/{result['transform']}",
+        "data": result["data"],
+        "meta": {"source": result["source"], "source_version": result["source_version"],
+                 "transform": result["transform"], "params": json.loads(result["params"])},
+        "data_type": DERIVED_TYPE,
+        "author": author,
+        "data_headings": result["data_headings"]
+    }
@@ -0,0 +1,233 @@
+""" WebSocket ingestion for instruments streaming readings. A connection authenticates once with its first message and
+then sends frames of rows for a dataset or samples for a time-series experiment. The frames are read into a bounded
+queue and the writer drains the queue, grouping the queued frames into one bulk write per dataset and per project,
+and acknowledges each frame once it is written. When the writer falls behind the queue fills up and the server stops
+reading, so the client's unacknowledged frames are limited by the queue size.
+
+Frames:
+    {"username": ..., "token": ...}  first message, answered with {"authenticated": true}
+    {"id": 1, "project": ..., "experiment": ..., "dataset": ..., "rows": [...]}  rows appended to a dataset
+    {"id": 2, "project": ..., "experiment": ..., "series": ..., "rows": [[time, value, ...], ...]}  samples
+The server answers {"acks": [ids], "written": rows} or {"id": id, "error": detail} for a rejected frame."""
+import asyncio
+import json
+from typing import Dict, List, Tuple, Union
+from fastapi import HTTPException, WebSocket, WebSocketDisconnect
+from pydantic.datetime_parse import parse_datetime
+from pymongo.mongo_client import MongoClient
+from starlette.concurrency import run_in_threadpool
+import security
+import storage
+import timeseries
+
+# declare constants for the ingestion
+QUEUE_FRAMES = 16  # frames read ahead of the writer
+MAX_BATCH_FRAMES = 64  # frames grouped into one write
+POLICY_VIOLATION = 1008  # WebSocket close code of failed authentication
+
+
+class Frame_Error(Exception):
+    """A frame which can't be written. Reported to the client without closing the connection."""
+
+
+class Ingest_Session(object):
+    """State of an authenticated connection. The permission and the headings of every target are looked up once."""
+    def __init__(self, client: MongoClient, username: str):
+        self.client = client
+        self.username = username
+        self.targets: Dict[Tuple[str, str, str, bool], dict] = {}
+        self.frames = 0
+        self.rows = 0
+
+    def target(self, project_id: str, experiment_id: str, name: str, is_series: bool) -> dict:
+        """Returns the dataset, or the config of the time-series experiment, after checking the write permission"""
+        key = (project_id, experiment_id, name, is_series)
+        if key not in self.targets:
+            project = storage.get_project(self.client, project_id)
+            if is_series:
+                try:
+                    document = timeseries.get_config(project, experiment_id)
+                except HTTPException as e:
+                    raise Frame_Error(e.detail)
+            else:
+                document = project[experiment_id].find_one({"name": name}, {"name": 1, "author": 1,
+                                                                             "data_headings": 1, "data_ref": 1,
+                                                                             "meta.fragmented": 1})
+                if document is None:
+                    raise Frame_Error(f"The dataset '{name}' doesn't exist")
+                if storage.is_fragmented(document):
+                    raise Frame_Error("Fragmented datasets can't be appended to")
+            if not security.has_permission(document, self.username, write=True):
+                raise Frame_Error(f"You don't have write access to '{name}'")
+            self.targets[key] = document
+        return self.targets[key]
+
+    def parse(self, frame) -> Tuple[tuple, list]:
+        """Validates a frame. Returns the key its rows are grouped by and the rows or sample documents."""
+        if not isinstance(frame, dict):
+            raise Frame_Error("Every frame must be a JSON object")
+        project_id, experiment_id = frame.get("project"), frame.get("experiment")
+        rows = frame.get("rows")
+        if not isinstance(project_id, str) or not isinstance(experiment_id, str) or not isinstance(rows, list):
+            raise Frame_Error("A frame needs a project, an experiment and a list of rows")
+        if isinstance(frame.get("series"), str):
+            series = frame["series"]
+            config = self.target(project_id, experiment_id, series, True)
+            headings = config["data_headings"]
+            documents = []
+            for row in rows:
+                if not isinstance(row, list) or len(row) != len(headings) + 1:
+                    raise Frame_Error(f"Every sample needs a time and {len(headings)} values")
+                try:
+                    time = parse_datetime(row[0])
+                except (TypeError, ValueError):
+                    raise Frame_Error(f"'{row[0]}' isn't a valid time")
+                documents.append(timeseries.sample_document(experiment_id, headings, series, time, row[1:]))
+            return (project_id,), documents
+        if isinstance(frame.get("dataset"), str):
+            dataset = self.target(project_id, experiment_id, frame["dataset"], False)
+            try:
+                storage.check_rows(dataset.get("data_headings"), rows)
+            except ValueError as e:
+                raise Frame_Error(str(e))
+            return (project_id, experiment_id, frame["dataset"]), rows
+        raise Frame_Error("A frame needs a dataset or a series")
+
+    def write(self, key: tuple, rows: list) -> None:
+        """Writes the grouped rows of a target, with one $push for a dataset or one bulk insert of the samples of a
+        project"""
+        project = storage.get_project(self.client, key[0])
+        if len(key) == 1:
+            timeseries.append(project, rows)
+        else:
+            dataset = self.targets[(key[0], key[1], key[2], False)]
+            storage.append_data(project, key[1], dataset, rows)
+            # the data was copied back from the blob by the append
+            dataset.pop("data_ref", None)
+
+
+async def authenticate(websocket: WebSocket, client: MongoClient) -> Union[Ingest_Session, None]:
+    """Reads the credentials message. Closes the connection and returns None if the token fails to authenticate."""
+    try:
+        credentials = json.loads(await websocket.receive_text())
+    except ValueError:
+        credentials = None
+    username = credentials.get("username") if isinstance(credentials, dict) else None
+    token = credentials.get("token") if isinstance(credentials, dict) else None
+    if isinstance(username, str) and isinstance(token, str):
+        user = security.User_Auth(username_in=username, password_in=token, db_client_in=client)
+        try:
+            authenticated = await run_in_threadpool(user.authenticate_token)
+        except HTTPException:
+            authenticated = False
+        if authenticated:
+            await websocket.send_json({"authenticated": True})
+            return Ingest_Session(client, username)
+    await websocket.send_json({"authenticated": False, "error": "The token failed to authenticate"})
+    await websocket.close(code=POLICY_VIOLATION)
+    return None
+
+
+async def receive_frames(websocket: WebSocket, queue: asyncio.Queue) -> None:
+    """Reads frames into the queue until the client disconnects. Waits while the queue is full."""
+    try:
+        while True:
+            message = await websocket.receive_text()
+            try:
+                frame = json.loads(message)
+            except ValueError:
+                frame = message  # rejected by the writer
+            if frame is None:
+                frame = message  # None marks the end of the frames
+            await queue.put(frame)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        await queue.put(None)
+
+
+async def write_batch(session: Ingest_Session, frames: list, reply) -> None:
+    """Writes a batch of frames with one write per target and replies with the acknowledgements and the errors"""
+    # rows and frame IDs by target
+    groups: Dict[tuple, Tuple[list, list]] = {}
+    for frame in frames:
+        frame_id = frame.get("id") if isinstance(frame, dict) else None
+        try:
+            key, rows = session.parse(frame)
+        except Frame_Error as e:
+            await reply({"id": frame_id, "error": str(e)})
+            continue
+        group = groups.setdefault(key, ([], []))
+        group[0].extend(rows)
+        group[1].append(frame_id)
+    acks: List = []
+    written = 0
+    for key, (rows, frame_ids) in groups.items():
+        try:
+            await run_in_threadpool(session.write, key, rows)
+        except Exception as e:
+            for frame_id in frame_ids:
+                await reply({"id": frame_id, "error": f"The write failed: {e!r}"})
+            continue
+        acks += frame_ids
+        written += len(rows)
+    if len(acks) != 0:
+        session.frames += len(acks)
+        session.rows += written
+        await reply({"acks": acks, "written": written})
+
+
+async def write_frames(websocket: WebSocket, session: Ingest_Session, queue: asyncio.Queue) -> None:
+    """Drains the queue, writing the available frames together, until the receiver stops. Every frame read from the
+    client is written, also when the client disconnects or the connection fails while it is being acknowledged; the
+    frames without a reply are then written without one. A client which reconnects resends its unacknowledged frames,
+    so the delivery is at least once."""
+    connected = True
+
+    async def reply(message: dict) -> None:
+        nonlocal connected
+        if not connected:
+            return
+        try:
+            await websocket.send_json(message)
+        except Exception:
+            # the client is gone. The queued frames are still written
+            connected = False
+
+    finished = False
+    try:
+        while not finished:
+            frames = [await queue.get()]
+            while len(frames) < MAX_BATCH_FRAMES and not queue.empty():
+                frames.append(queue.get_nowait())
+            if frames[-1] is None:
+                finished = True
+                frames.pop()
+            await write_batch(session, frames, reply)
+    finally:
+        # frames read before the writer stopped early
+        connected = False
+        frames = []
+        while not queue.empty():
+            frame = queue.get_nowait()
+            if frame is not None:
+                frames.append(frame)
+        if len(frames) != 0:
+            await write_batch(session, frames, reply)
+
+
+async def serve(websocket: WebSocket, client: MongoClient, queue_frames: int = QUEUE_FRAMES) -> None:
+    """Runs an ingestion connection"""
+    await websocket.accept()
+    try:
+        session = await authenticate(websocket, client)
+    except WebSocketDisconnect:
+        return
+    if session is None:
+        return
+    queue = asyncio.Queue(maxsize=queue_frames)
+    receiver = asyncio.ensure_future(receive_frames(websocket, queue))
+    try:
+        await write_frames(websocket, session, queue)
+    finally:
+        receiver.cancel()
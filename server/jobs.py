@@ -0,0 +1,365 @@
+""" Background jobs. Long operations, such as recursive permission grants, index backfills and layout migrations, are
+submitted as jobs and run by a bounded pool of worker threads instead of inside a request. The jobs are stored in the
+Jobs database, so the status and progress can be polled from any server process and queued jobs survive restarts. A
+worker claims the oldest queued job atomically and the job reports its progress, which also records a heartbeat and
+returns the cancellation flag. Jobs interrupted by a shutdown are queued again, and running jobs whose heartbeat is
+older than JOB_STALE_AFTER, left by a server which stopped without shutting down, are queued again by the next idle
+worker. A job can therefore run more than once and every job is written to be repeatable."""
+import threading
+from datetime import datetime, timedelta
+from time import monotonic
+from typing import Callable, Dict, List, Union
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+from pymongo.database import Database
+from pymongo.mongo_client import MongoClient
+import datastructure as d
+import blobs
+import bulk
+import manifest
+import migrate
+import name_search
+import pagination
+import search_cache
+import security
+import storage
+import tracing
+
+JOBS_DATABASE = "Jobs"
+JOBS_COLLECTION = "Jobs"
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+# declare constants for the job runner
+JOB_WORKERS = 2  # jobs run at the same time by a server process
+POLL_INTERVAL = 1.0  # seconds an idle worker waits before looking for queued jobs
+JOB_STALE_AFTER = timedelta(minutes=5)  # running jobs without a heartbeat for this long are queued again
+GRANT_BATCH_SIZE = 500  # author lists updated per bulk write
+
+
+class Job_Cancelled(Exception):
+    """Raised in a job by the progress report once the job is cancelled"""
+
+
+class Job_Interrupted(Exception):
+    """Raised in a job by the progress report once the server is shutting down"""
+
+
+class Job_Context(object):
+    """Handle of a running job passed to the job function"""
+    def __init__(self, runner: "Job_Runner", job: dict):
+        self.runner = runner
+        self.client = runner.client
+        self.job_id = job["_id"]
+        self.username = job["owner"]
+
+    def progress(self, done: int, total: Union[int, None] = None, message: Union[str, None] = None) -> None:
+        """Records the progress and the heartbeat. Raises Job_Cancelled or Job_Interrupted when the job has to stop,
+        so jobs should report their progress at least every few seconds."""
+        fields = {"progress.done": done, "heartbeat": datetime.utcnow()}
+        if total is not None:
+            fields["progress.total"] = total
+        if message is not None:
+            fields["message"] = message
+        job = self.runner.collection().find_one_and_update({"_id": self.job_id, "status": RUNNING}, {"$set": fields},
+                                                           {"cancel_requested": 1})
+        if job is None or job.get("cancel_requested"):
+            raise Job_Cancelled()
+        if self.runner.stopping:
+            raise Job_Interrupted()
+
+
+def with_author(authors: Union[List[dict], None], name: str, permission: str) -> Union[List[dict], None]:
+    """Returns the author list with the author added or its permission changed, or None if it's unchanged"""
+    authors = [dict(author) for author in authors or []]
+    for author in authors:
+        if author.get("name") == name:
+            if author.get("permission") == permission:
+                return None
+            author["permission"] = permission
+            return authors
+    authors.append(d.Author(name=name, permission=permission).dict())
+    return authors
+
+
+def grant_permission(context: Job_Context, params: dict) -> dict:
+    """Adds an author to the project, its experiments and the datasets, or changes its permission. Only the documents
+    the requester can write to are changed."""
+    project_id, name, permission = params["project"], params["author"], params["permission"]
+    project = storage.get_project(context.client, project_id)
+    collections = ["config"] + sorted(collection_name for collection_name in project.list_collection_names()
+                                      if not manifest.is_reserved(collection_name))
+    total = sum(project[collection].count_documents({"author.name": context.username}) for collection in collections)
+    context.progress(0, total)
+    done = 0
+    updated = 0
+    entry_collection = manifest.get_manifest(project)
+    for collection_name in collections:
+        collection = project[collection_name]
+        requests = []
+        entries = []
+        for document in collection.find({"author.name": context.username}, {"name": 1, "author": 1}):
+            done += 1
+            authors = with_author(document.get("author"), name, permission) \
+                if security.has_permission(document, context.username, write=True) else None
+            if authors is not None:
+                requests.append(bulk.update_one(collection, {"_id": document["_id"]}, {"$set": {"author": authors}}))
+                entries.append(bulk.update_one(entry_collection, {"experiment": collection_name,
+                                                                  "name": document.get("name")},
+                                               {"$set": {"author": authors}}))
+            if done % GRANT_BATCH_SIZE == 0:
+                updated += write_authors(project, collection_name, requests, entries)
+                requests, entries = [], []
+                context.progress(done)
+        updated += write_authors(project, collection_name, requests, entries)
+        search_cache.cache.invalidate(project_id, collection_name)
+        context.progress(done)
+    return {"updated": updated}
+
+
+def write_authors(project: Database, collection_name: str, requests: List[UpdateOne], entries: List[UpdateOne]) -> int:
+    """Writes the author lists and the manifest entries of a batch. Returns the number of documents updated."""
+    if len(requests) == 0:
+        return 0
+    project[collection_name].bulk_write(requests, ordered=False)
+    if collection_name != "config":
+        manifest.get_manifest(project).bulk_write(entries, ordered=False)
+    return len(requests)
+
+
+def backfill_name_index(context: Job_Context, params: dict) -> dict:
+    """Creates the name and trigram indexes of every experiment of the project and stores the missing trigrams"""
+    project = storage.get_project(context.client, params["project"])
+    experiments = sorted(name for name in project.list_collection_names() if not manifest.is_reserved(name))
+    context.progress(0, len(experiments))
+    for done, experiment_id in enumerate(experiments):
+        collection = project[experiment_id]
+        pagination.ensure_name_index(collection)
+        name_search.backfill(collection)
+        context.progress(done + 1, message=experiment_id)
+    return {"experiments": len(experiments)}
+
+
+def collect_blobs(context: Job_Context, params: dict) -> dict:
+    """Releases the blobs of the project which none of its datasets reference any more"""
+    project = storage.get_project(context.client, params["project"])
+    experiments = sorted(name for name in project.list_collection_names() if not manifest.is_reserved(name))
+    context.progress(0, len(experiments))
+    referenced = set()
+    for done, experiment_id in enumerate(experiments):
+        referenced.update(project[experiment_id].distinct("data_ref"))
+        context.progress(done + 1, message=experiment_id)
+    return {"referenced": len(referenced), "released": blobs.collect_garbage(project, referenced)}
+
+
+def migrate_project(context: Job_Context, params: dict) -> dict:
+    """Copies the project from the database layout to the consolidated layout, one collection at a time. The progress
+    counts the documents and is reported after every batch."""
+    project_id = params["project"]
+    collections = sorted(context.client[project_id].list_collection_names())
+    storage.create_consolidated_indexes(context.client)
+    total = sum(context.client[project_id][collection_name].estimated_document_count()
+                for collection_name in collections)
+    context.progress(0, total)
+    copied = 0
+    for collection_name in collections:
+        copied += migrate.copy_collection(context.client, project_id, collection_name, context=context, done=copied)
+        context.progress(copied, message=collection_name)
+    return {"copied": copied}
+
+
+JOB_KINDS: Dict[str, Callable[[Job_Context, dict], dict]] = {
+    "grant_permission": grant_permission,
+    "backfill_name_index": backfill_name_index,
+    "collect_blobs": collect_blobs,
+    "migrate_project": migrate_project
+}
+"""Job functions by kind. A job function returns the result stored with the finished job."""
+
+
+def check_request(client: MongoClient, kind: str, params: dict, username: str) -> None:
+    """Validates a submitted job. Raises ValueError for invalid requests and PermissionError unless the user can
+    write to the project."""
+    if kind not in JOB_KINDS:
+        raise ValueError(f"The job kind must be one of {', '.join(JOB_KINDS)}")
+    if not isinstance(params.get("project"), str):
+        raise ValueError("The job needs the project parameter")
+    if kind == "grant_permission":
+        if not isinstance(params.get("author"), str) or params.get("permission") not in ("read", "write"):
+            raise ValueError("The job needs the author parameter and the read or write permission")
+    if kind == "migrate_project":
+        # the project is read from its own database
+        config = client[params["project"]]["config"].find_one({}, {"author": 1})
+    else:
+        config = storage.get_project(client, params["project"])["config"].find_one({}, {"author": 1})
+    if config is None:
+        raise ValueError("The project doesn't exist")
+    if not security.has_permission(config, username, write=True):
+        raise PermissionError("You don't have write access to the project")
+
+
+def to_dict(job: dict) -> dict:
+    """Returns the job as reported to the interface"""
+    return {
+        "job_id": job["_id"],
+        "kind": job.get("kind"),
+        "params": job.get("params"),
+        "status": job.get("status"),
+        "progress": job.get("progress"),
+        "message": job.get("message"),
+        "result": job.get("result"),
+        "error": job.get("error"),
+        "attempts": job.get("attempts"),
+        "created": job.get("created"),
+        "started": job.get("started"),
+        "finished": job.get("finished")
+    }
+
+
+class Job_Runner(object):
+    """Worker threads running the queued jobs of the Jobs database"""
+    def __init__(self, client: MongoClient, workers: int = JOB_WORKERS, poll_interval: float = POLL_INTERVAL,
+                 stale_after: timedelta = JOB_STALE_AFTER):
+        self.client = client
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.threads = []
+        self.stopping = False
+        self.indexed = False
+        self.running = 0
+        self.finished = 0
+        self.failed = 0
+        self.last_recovery = None
+        self.lock = threading.Lock()
+        self.wake_up = threading.Event()
+
+    def collection(self):
+        """Returns the jobs collection. The indexes are checked once per process."""
+        collection = self.client[JOBS_DATABASE][JOBS_COLLECTION]
+        if not self.indexed:
+            collection.create_index([("status", ASCENDING), ("created", ASCENDING)])
+            collection.create_index([("owner", ASCENDING), ("created", ASCENDING)])
+            self.indexed = True
+        return collection
+
+    def start(self) -> None:
+        self.stopping = False
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self.run, name=f"job-worker-{len(self.threads)}", daemon=True)
+            self.threads.append(thread)
+            thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Asks the running jobs to stop at their next progress report, which queues them again"""
+        self.stopping = True
+        self.wake_up.set()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def submit(self, kind: str, params: dict, owner: str) -> dict:
+        now = datetime.utcnow()
+        job = {
+            "_id": tracing.new_id(),
+            "kind": kind,
+            "params": params,
+            "owner": owner,
+            "status": QUEUED,
+            "progress": {"done": 0, "total": None},
+            "message": None,
+            "result": None,
+            "error": None,
+            "cancel_requested": False,
+            "attempts": 0,
+            "created": now,
+            "started": None,
+            "finished": None,
+            "heartbeat": None
+        }
+        self.collection().insert_one(job)
+        self.wake_up.set()
+        return job
+
+    def get(self, job_id: str, owner: str) -> Union[dict, None]:
+        return self.collection().find_one({"_id": job_id, "owner": owner})
+
+    def cancel(self, job_id: str, owner: str) -> Union[dict, None]:
+        """Cancels a queued job at once and asks a running job to stop at its next progress report. Returns the job
+        or None if it doesn't exist."""
+        collection = self.collection()
+        job = collection.find_one_and_update({"_id": job_id, "owner": owner, "status": QUEUED},
+                                             {"$set": {"status": CANCELLED, "cancel_requested": True,
+                                                       "finished": datetime.utcnow()}},
+                                             return_document=ReturnDocument.AFTER)
+        if job is None:
+            job = collection.find_one_and_update({"_id": job_id, "owner": owner, "status": RUNNING},
+                                                 {"$set": {"cancel_requested": True}},
+                                                 return_document=ReturnDocument.AFTER)
+        if job is None:
+            job = self.get(job_id, owner)
+        return job
+
+    def recover(self) -> None:
+        """Queues the running jobs whose server stopped without shutting down. Runs at most once per stale period."""
+        now = monotonic()
+        with self.lock:
+            if self.last_recovery is not None and now - self.last_recovery < self.stale_after.total_seconds() / 2:
+                return
+            self.last_recovery = now
+        self.collection().update_many({"status": RUNNING,
+                                       "heartbeat": {"$lt": datetime.utcnow() - self.stale_after}},
+                                      {"$set": {"status": QUEUED}})
+
+    def claim(self) -> Union[dict, None]:
+        """Marks the oldest queued job as running and returns it"""
+        now = datetime.utcnow()
+        return self.collection().find_one_and_update({"status": QUEUED},
+                                                     {"$set": {"status": RUNNING, "started": now, "heartbeat": now},
+                                                      "$inc": {"attempts": 1}},
+                                                     sort=[("created", ASCENDING)],
+                                                     return_document=ReturnDocument.AFTER)
+
+    def run(self) -> None:
+        while not self.stopping:
+            try:
+                job = self.claim()
+                if job is None:
+                    self.recover()
+                    self.wake_up.wait(self.poll_interval)
+                    self.wake_up.clear()
+                    continue
+                self.execute(job)
+            except Exception:
+                # MongoDB unavailable. The job stays running and is recovered once stale
+                self.wake_up.wait(self.poll_interval)
+
+    def finish(self, job: dict, status: str, result: Union[dict, None] = None,
+               error: Union[str, None] = None) -> None:
+        self.collection().update_one({"_id": job["_id"], "status": RUNNING},
+                                     {"$set": {"status": status, "result": result, "error": error,
+                                               "finished": datetime.utcnow()}})
+
+    def execute(self, job: dict) -> None:
+        with self.lock:
+            self.running += 1
+        try:
+            result = JOB_KINDS[job["kind"]](Job_Context(self, job), job.get("params") or {})
+        except Job_Cancelled:
+            self.finish(job, CANCELLED)
+        except Job_Interrupted:
+            self.collection().update_one({"_id": job["_id"], "status": RUNNING}, {"$set": {"status": QUEUED}})
+        except Exception as e:
+            with self.lock:
+                self.failed += 1
+            self.finish(job, FAILED, error=repr(e))
+        else:
+            with self.lock:
+                self.finished += 1
+            self.finish(job, DONE, result=result)
+        finally:
+            with self.lock:
+                self.running -= 1
@@ -0,0 +1,122 @@
+""" Experiment manifests. The manifest collection of a project holds one entry per dataset with its name, type,
+headings, meta, size, element count and content hash, so experiments can be browsed without reading the payloads.
+The entries are written by the API calls that insert or update datasets. The experiment config isn't a dataset and has
+no entry."""
+from typing import List, Union
+from pymongo import ASCENDING
+from pymongo.database import Database
+import blobs
+import bulk
+import derived
+import timeseries
+
+MANIFEST_COLLECTION = "manifest"
+RESERVED_COLLECTIONS = ("config", MANIFEST_COLLECTION, blobs.BLOB_COLLECTION, timeseries.SAMPLES_COLLECTION,
+                        derived.DERIVED_COLLECTION)
+"""Collections of a project database which aren't experiments"""
+EXPERIMENT_CONFIG_TYPE = "configuration file"
+"""data_type of the config document of an experiment"""
+CONFIG_TYPES = (EXPERIMENT_CONFIG_TYPE, timeseries.TIMESERIES_TYPE)
+BACKFILL_BATCH_SIZE = 1000  # datasets read per query by the manifest backfill
+
+# projects which already have the manifest index
+indexed_projects = set()
+# (project, experiment) pairs whose manifest is known to be complete
+built_experiments = set()
+
+
+def is_config(experiment_id: str, document: dict) -> bool:
+    """True for the config document of the experiment, which is named after it"""
+    return document.get("name") == experiment_id and document.get("data_type") in CONFIG_TYPES
+
+
+def manifest_entry(experiment_id: str, document: dict, description: Union[dict, None] = None) -> dict:
+    """Builds the manifest entry of a dataset document. The description of deduplicated data comes from its blob."""
+    if description is None:
+        description = blobs.describe_data(document.get("data") or [])
+    entry = {
+        "experiment": experiment_id,
+        "name": document.get("name"),
+        "data_type": document.get("data_type"),
+        "data_headings": document.get("data_headings"),
+        "meta": document.get("meta"),
+        "author": document.get("author")
+    }
+    entry.update(description)
+    return entry
+
+
+def get_manifest(project: Database):
+    """Returns the manifest collection of the project. The index is checked once per project and process."""
+    collection = project[MANIFEST_COLLECTION]
+    if project.name not in indexed_projects:
+        collection.create_index([("experiment", ASCENDING), ("name", ASCENDING)], unique=True)
+        indexed_projects.add(project.name)
+    return collection
+
+
+def record_dataset(project: Database, experiment_id: str, document: dict,
+                   description: Union[dict, None] = None) -> None:
+    """Adds or replaces the manifest entry of the dataset"""
+    if is_config(experiment_id, document):
+        return
+    entry = manifest_entry(experiment_id, document, description)
+    get_manifest(project).replace_one({"experiment": experiment_id, "name": entry["name"]}, entry, upsert=True)
+
+
+def record_datasets(project: Database, experiment_id: str, documents: List[dict],
+                    descriptions: List[Union[dict, None]]) -> None:
+    """Adds or replaces the manifest entries of a batch of datasets in one bulk write"""
+    collection = get_manifest(project)
+    requests = []
+    for document, description in zip(documents, descriptions):
+        if is_config(experiment_id, document):
+            continue
+        entry = manifest_entry(experiment_id, document, description)
+        requests.append(bulk.replace_one(collection, {"experiment": experiment_id, "name": entry["name"]}, entry,
+                                         upsert=True))
+    if len(requests) != 0:
+        collection.bulk_write(requests, ordered=False)
+
+
+def update_entry(project: Database, experiment_id: str, name: str, fields: dict) -> None:
+    """Updates fields of a manifest entry which don't depend on the data, for example the author list"""
+    get_manifest(project).update_one({"experiment": experiment_id, "name": name}, {"$set": fields})
+
+
+def apply_update(project: Database, experiment_id: str, name: str, update: dict) -> None:
+    """Applies the meta and data_headings update of a dataset to its manifest entry"""
+    get_manifest(project).update_one({"experiment": experiment_id, "name": name}, update)
+
+
+def record_append(project: Database, experiment_id: str, name: str, element_count: int, byte_size: int) -> None:
+    """Adds the size of appended data to a manifest entry. The content hash no longer describes the data and is
+    cleared, since computing it would read the whole dataset."""
+    get_manifest(project).update_one({"experiment": experiment_id, "name": name},
+                                     {"$inc": {"element_count": element_count, "byte_size": byte_size},
+                                      "$set": {"content_hash": None}})
+
+
+def ensure_manifest(project: Database, experiment_id: str) -> None:
+    """Adds the entries of the datasets written before the manifest existed. Only the missing datasets are read, and
+    a marker entry without a name records that the experiment is complete, so later calls read nothing."""
+    key = (project.name, experiment_id)
+    if key in built_experiments:
+        return
+    collection = get_manifest(project)
+    if collection.find_one({"experiment": experiment_id, "name": None, "built": True}, {"_id": 1}) is None:
+        recorded = set(collection.distinct("name", {"experiment": experiment_id}))
+        experiment = project[experiment_id]
+        missing = [document["_id"] for document in experiment.find({}, {"name": 1, "data_type": 1})
+                   if document.get("name") not in recorded and not is_config(experiment_id, document)]
+        for start in range(0, len(missing), BACKFILL_BATCH_SIZE):
+            documents = list(experiment.find({"_id": {"$in": missing[start:start + BACKFILL_BATCH_SIZE]}}))
+            record_datasets(project, experiment_id, [blobs.resolve(project, document) for document in documents],
+                            [None] * len(documents))
+        collection.replace_one({"experiment": experiment_id, "name": None, "built": True},
+                               {"experiment": experiment_id, "name": None, "built": True}, upsert=True)
+    built_experiments.add(key)
+
+
+def is_reserved(experiment_id: Union[str, None]) -> bool:
+    return experiment_id in RESERVED_COLLECTIONS
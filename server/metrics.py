@@ -0,0 +1,210 @@
+""" Metrics of the API server rendered in the Prometheus text exposition format. Served by the /metrics call."""
+import threading
+from typing import Callable, Dict, List, Tuple, Union
+from monitoring import Request_Context
+
+# default latency buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def format_labels(label_names: Tuple[str, ...], label_values: Tuple, extra: str = "") -> str:
+    """Returns the label set in the exposition format, for example {route="/names",method="GET"}"""
+    pairs = []
+    for name, value in zip(label_names, label_values):
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    if extra:
+        pairs.append(extra)
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join(pairs) + "}"
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric(object):
+    """Base class of the metric families. Values are stored per label set."""
+    type_name = "untyped"
+
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.values: Dict[Tuple, float] = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels: dict) -> Tuple:
+        return tuple(labels.get(name, "") for name in self.label_names)
+
+    def samples(self) -> List[str]:
+        with self.lock:
+            items = list(self.values.items())
+        return [f"{self.name}{format_labels(self.label_names, key)} {format_value(value)}" for key, value in items]
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.type_name}"]
+        return lines + self.samples()
+
+
+class Counter(Metric):
+    """Monotonic counter"""
+    type_name = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Value that can go up and down"""
+    type_name = "gauge"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels) -> None:
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets"""
+    type_name = "histogram"
+
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help_text, label_names)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self.counts: Dict[Tuple, List[int]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            counts = self.counts.get(key)
+            if counts is None:
+                counts = [0] * len(self.buckets)
+                self.counts[key] = counts
+                self.values[key] = 0.0
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self.values[key] += value
+
+    def samples(self) -> List[str]:
+        lines = []
+        with self.lock:
+            items = [(key, list(counts), self.values[key]) for key, counts in self.counts.items()]
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = format_labels(self.label_names, key, f'le="{format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Callback(Metric):
+    """Metric without labels whose value is read from a function when the metrics are rendered"""
+    def __init__(self, name: str, help_text: str, type_name: str, function: Callable[[], float]):
+        Metric.__init__(self, name, help_text)
+        self.type_name = type_name
+        self.function = function
+
+    def samples(self) -> List[str]:
+        return [f"{self.name} {format_value(self.function())}"]
+
+
+class Registry(object):
+    """Collection of the metric families exposed by the server"""
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, help_text, label_names))
+
+    def gauge(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()) -> Gauge:
+        return self.register(Gauge(name, help_text, label_names))
+
+    def histogram(self, name: str, help_text: str, label_names: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help_text, label_names, buckets))
+
+    def callback(self, name: str, help_text: str, type_name: str, function: Callable[[], float]) -> Callback:
+        return self.register(Callback(name, help_text, type_name, function))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+"""The registry rendered by the /metrics call"""
+
+# HTTP metrics
+REQUESTS = REGISTRY.counter("resdata_http_requests_total", "HTTP requests handled", ("method", "route", "status"))
+LATENCY = REGISTRY.histogram("resdata_http_request_duration_seconds", "Time taken to handle and send a request",
+                             ("method", "route"))
+REQUEST_BYTES = REGISTRY.counter("resdata_http_request_bytes_total", "Bytes received in request bodies",
+                                 ("method", "route"))
+RESPONSE_BYTES = REGISTRY.counter("resdata_http_response_bytes_total", "Bytes sent in response bodies",
+                                  ("method", "route"))
+IN_FLIGHT = REGISTRY.gauge("resdata_http_requests_in_flight", "Requests being handled", ("method", "route"))
+ERRORS = REGISTRY.counter("resdata_http_errors_total", "Requests answered with an error status",
+                          ("method", "route", "status"))
+
+# MongoDB metrics
+MONGO_COMMANDS = REGISTRY.counter("resdata_mongo_commands_total", "MongoDB commands issued", ("route", "command"))
+MONGO_DURATION = REGISTRY.histogram("resdata_mongo_command_duration_seconds", "Duration of the MongoDB commands",
+                                    ("command",))
+MONGO_REPLY_BYTES = REGISTRY.counter("resdata_mongo_reply_bytes_total",
+                                     "Bytes returned by MongoDB. Only counted in debug mode", ("route",))
+MONGO_REPLY_DOCUMENTS = REGISTRY.counter("resdata_mongo_reply_documents_total", "Documents returned by MongoDB",
+                                         ("route",))
+MONGO_COMMANDS_PER_REQUEST = REGISTRY.histogram("resdata_mongo_commands_per_request",
+                                                "MongoDB commands issued per HTTP request", ("method", "route"),
+                                                buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 1024))
+
+
+def request_started(context: Request_Context) -> None:
+    IN_FLIGHT.inc(method=context.method, route=context.route)
+
+
+def request_finished(context: Request_Context) -> None:
+    labels = {"method": context.method, "route": context.route}
+    IN_FLIGHT.dec(**labels)
+    REQUESTS.inc(status=context.status, **labels)
+    LATENCY.observe(context.duration, **labels)
+    REQUEST_BYTES.inc(context.request_bytes, **labels)
+    RESPONSE_BYTES.inc(context.response_bytes, **labels)
+    if context.status >= 400:
+        ERRORS.inc(status=context.status, **labels)
+    MONGO_COMMANDS_PER_REQUEST.observe(context.mongo_commands, **labels)
+
+
+def command_finished(context: Union[Request_Context, None], command_name: str, duration: float,
+                     reply_bytes: int, details: Union[dict, None] = None, reply_documents: int = 0) -> None:
+    route = "background" if context is None else context.route
+    MONGO_COMMANDS.inc(route=route, command=command_name)
+    MONGO_DURATION.observe(duration, command=command_name)
+    MONGO_REPLY_BYTES.inc(reply_bytes, route=route)
+    MONGO_REPLY_DOCUMENTS.inc(reply_documents, route=route)
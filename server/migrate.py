@@ -0,0 +1,120 @@
+""" Copies the projects from the database layout, one MongoDB database per project, to the consolidated layout of
+storage.py. The documents keep their _id and are upserted, so the migration can run while the API serves the old
+layout and can be repeated to copy the writes made in the meantime. Time-series collections don't support upserts,
+so the samples of a project are copied again by every run. Switch storage.LAYOUT once a repeated run copies no new
+datasets. The old databases are left in place.
+
+Usage: python migrate.py [project names]"""
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple, Union
+from pymongo import ReplaceOne
+from pymongo.database import Database
+from pymongo.mongo_client import MongoClient
+import blobs
+import derived
+import manifest
+import storage
+import timeseries
+
+# declare constants for the migration
+MIGRATION_WORKERS = 4  # collections copied at the same time
+MIGRATION_BATCH_SIZE = 500  # documents per bulk write
+
+
+def target(database: Database, collection_name: str) -> Tuple[str, dict]:
+    """Returns the consolidated collection of a project collection and the scope fields its documents receive"""
+    if collection_name == "config":
+        return storage.PROJECTS_COLLECTION, {"project": database.name}
+    if collection_name in (manifest.MANIFEST_COLLECTION, derived.DERIVED_COLLECTION):
+        return collection_name, {"project": database.name}
+    if collection_name == blobs.BLOB_COLLECTION:
+        return blobs.BLOB_COLLECTION, {}
+    return storage.DATASETS_COLLECTION, {"project": database.name, "experiment": collection_name}
+
+
+def report(context, done: int, collection_name: str) -> None:
+    """Reports the documents copied so far to the job running the migration, if any. The job stops here when it's
+    cancelled."""
+    if context is not None:
+        context.progress(done, message=collection_name)
+
+
+def copy_samples(client: MongoClient, project_id: str, batch_size: int = MIGRATION_BATCH_SIZE, context=None,
+                 done: int = 0) -> int:
+    """Replaces the samples of the project in the consolidated samples collection. Returns the number of samples
+    copied."""
+    destination = timeseries.get_samples(storage.Scoped_Database(client[storage.CONSOLIDATED_DATABASE], project_id))
+    destination.delete_many({})
+    copied = 0
+    documents = client[project_id][timeseries.SAMPLES_COLLECTION].find().batch_size(batch_size)
+    try:
+        batch = []
+        for document in documents:
+            batch.append(document)
+            if len(batch) >= batch_size:
+                destination.insert_many(batch, ordered=False)
+                copied += len(batch)
+                batch = []
+                report(context, done + copied, timeseries.SAMPLES_COLLECTION)
+        if len(batch) != 0:
+            destination.insert_many(batch, ordered=False)
+            copied += len(batch)
+    finally:
+        documents.close()
+    return copied
+
+
+def copy_collection(client: MongoClient, project_id: str, collection_name: str,
+                    batch_size: int = MIGRATION_BATCH_SIZE, context=None, done: int = 0) -> int:
+    """Upserts every document of a project collection into its consolidated collection. Returns the number of
+    documents copied. The progress of a job context is reported after every batch, counting from done."""
+    if collection_name == timeseries.SAMPLES_COLLECTION:
+        return copy_samples(client, project_id, batch_size, context, done)
+    source = client[project_id]
+    target_name, scope = target(source, collection_name)
+    destination = client[storage.CONSOLIDATED_DATABASE][target_name]
+    copied = 0
+    requests = []
+    documents = source[collection_name].find().batch_size(batch_size)
+    try:
+        for document in documents:
+            if collection_name == blobs.BLOB_COLLECTION:
+                # the blobs collection is shared, so the blob may already be stored by another project
+                requests.append(blobs.copy_request(project_id, document))
+            else:
+                document.update(scope)
+                requests.append(ReplaceOne({"_id": document["_id"]}, document, upsert=True))
+            if len(requests) >= batch_size:
+                destination.bulk_write(requests, ordered=False)
+                copied += len(requests)
+                requests = []
+                report(context, done + copied, collection_name)
+        if len(requests) != 0:
+            destination.bulk_write(requests, ordered=False)
+            copied += len(requests)
+    finally:
+        documents.close()
+    return copied
+
+
+def migrate(client: MongoClient, projects: Union[List[str], None] = None, workers: int = MIGRATION_WORKERS,
+            batch_size: int = MIGRATION_BATCH_SIZE) -> Dict[str, int]:
+    """Copies the projects, all of them by default, to the consolidated layout. The collections are copied in
+    parallel. Returns the number of documents copied per project."""
+    if projects is None:
+        projects = [name for name in client.list_database_names() if name not in storage.SYSTEM_DATABASES]
+    storage.create_consolidated_indexes(client)
+    jobs = [(project_id, name) for project_id in projects for name in client[project_id].list_collection_names()]
+    copied = {project_id: 0 for project_id in projects}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        counts = executor.map(lambda job: copy_collection(client, job[0], job[1], batch_size), jobs)
+        for (project_id, name), count in zip(jobs, counts):
+            copied[project_id] += count
+    return copied
+
+
+if __name__ == "__main__":
+    from API_server import client
+    for project_id, count in migrate(client, sys.argv[1:] or None).items():
+        print(f"{project_id}: {count} documents copied")
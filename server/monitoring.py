@@ -0,0 +1,232 @@
+""" Per-request monitoring for the API server. The middleware keeps a context for every HTTP request and hands it to
+the registered hooks once the response has been sent."""
+import contextvars
+from time import perf_counter, time
+from typing import Callable, Dict, List, Union
+import bson
+from pymongo import monitoring
+from starlette.routing import Match
+import tracing
+
+# the driver doesn't report the reply size, so measuring it encodes every reply again. Off unless debugging, when the
+# reply bytes are zero. The documents returned are always counted.
+COUNT_REPLY_BYTES = False
+
+
+class Request_Context(object):
+    """Variables describing a single HTTP request. Filled in by the middleware and the endpoints."""
+    def __init__(self, method: str, path: str, route: str, path_params: dict, request_bytes: int,
+                 request_headers: Union[dict, None] = None):
+        self.method = method
+        self.path = path
+        self.route = route
+        """Route template, for example /{project_id}/names. Used as the metric label."""
+        self.path_params = path_params
+        self.request_bytes = request_bytes
+        self.request_headers = request_headers if request_headers is not None else {}
+        """Request headers with lower case names"""
+        self.response_bytes = 0
+        self.status = 500
+        self.headers = {}
+        """Extra response headers added by the hooks before the response starts"""
+        self.start = perf_counter()
+        self.duration = 0.0
+        # MongoDB commands issued while handling the request
+        self.mongo_commands = 0
+        self.mongo_duration = 0.0
+        self.mongo_reply_bytes = 0
+        self.mongo_reply_documents = 0
+        self.mongo_command_counts: Dict[str, int] = {}
+        self.annotations = {}
+        """Request parameters recorded by the endpoint, for example the meta_search filters"""
+        # trace span of the request
+        self.span: Union[tracing.Span, None] = None
+        self.span_token = None
+
+
+current_request: contextvars.ContextVar = contextvars.ContextVar("current_request", default=None)
+"""Context of the HTTP request being handled"""
+
+request_start_hooks: List[Callable[[Request_Context], None]] = []
+"""Functions called when a request starts"""
+response_start_hooks: List[Callable[[Request_Context], None]] = []
+"""Functions called just before the response headers are sent. They can add headers."""
+request_end_hooks: List[Callable[[Request_Context], None]] = []
+"""Functions called once the response has been sent or the request failed"""
+command_hooks: List[Callable[[Union[Request_Context, None], str, float, int, Union[dict, None], int], None]] = []
+"""Functions called for every finished MongoDB command with the request context, command name, duration, reply bytes,
+the command details (collection and filter) if the listener captures them and the number of documents returned"""
+
+
+def get_request() -> Union[Request_Context, None]:
+    """Returns the context of the current request or None outside of a request"""
+    return current_request.get()
+
+
+def annotate(**values) -> None:
+    """Records request parameters on the current request. Does nothing outside of a request."""
+    context = current_request.get()
+    if context is not None:
+        context.annotations.update(values)
+
+
+def reply_documents(reply: dict) -> int:
+    """Returns the number of documents in a command reply: the batch of a cursor or the document of a findAndModify"""
+    cursor = reply.get("cursor")
+    if isinstance(cursor, dict):
+        return len(cursor.get("firstBatch", cursor.get("nextBatch", [])))
+    if "value" in reply:
+        return 0 if reply["value"] is None else 1
+    return 0
+
+
+def match_route(scope) -> (str, dict):
+    """Returns the route template and the path parameters for the request"""
+    app = scope.get("app")
+    if app is not None:
+        for route in app.router.routes:
+            match, child_scope = route.matches(scope)
+            if match == Match.FULL:
+                return route.path, child_scope.get("path_params", {})
+    return "unmatched", {}
+
+
+class Command_Listener(monitoring.CommandListener):
+    """pymongo command listener attributing the MongoDB commands to the HTTP request that issued them"""
+    def __init__(self):
+        self.capture_commands = False
+        """Keep the collection and filter of each command until it finishes. Used by the slow query log."""
+        self.commands = {}
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        if self.capture_commands:
+            command = event.command
+            self.commands[(event.connection_id, event.request_id)] = {
+                "collection": command.get(event.command_name),
+                "database": event.database_name,
+                "filter": command.get("filter", command.get("query", command.get("pipeline")))
+            }
+
+    def record(self, event, reply_bytes: int, documents: int) -> None:
+        command_name = event.command_name
+        duration = event.duration_micros / 1e6
+        details = None
+        if self.capture_commands:
+            details = self.commands.pop((event.connection_id, event.request_id), None)
+        context = current_request.get()
+        if context is not None:
+            context.mongo_commands += 1
+            context.mongo_duration += duration
+            context.mongo_reply_bytes += reply_bytes
+            context.mongo_reply_documents += documents
+            context.mongo_command_counts[command_name] = context.mongo_command_counts.get(command_name, 0) + 1
+        for hook in command_hooks:
+            hook(context, command_name, duration, reply_bytes, details, documents)
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        reply_bytes = 0
+        if COUNT_REPLY_BYTES:
+            reply_bytes = len(bson.encode(event.reply))
+        self.record(event, reply_bytes, reply_documents(event.reply))
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self.record(event, 0, 0)
+
+
+command_listener = Command_Listener()
+"""Listener registered with the MongoClient of the server"""
+
+
+def add_debug_headers(context: Request_Context) -> None:
+    """Response start hook exposing the MongoDB accounting of the request as response headers. Debug mode only."""
+    context.headers["X-Mongo-Commands"] = context.mongo_commands
+    context.headers["X-Mongo-Duration-Ms"] = round(context.mongo_duration * 1000, 3)
+    context.headers["X-Mongo-Reply-Bytes"] = context.mongo_reply_bytes
+    context.headers["X-Mongo-Reply-Documents"] = context.mongo_reply_documents
+    context.headers["X-Mongo-Command-Counts"] = ",".join(f"{name}={count}" for name, count in
+                                                         context.mongo_command_counts.items())
+
+
+def start_trace(context: Request_Context) -> None:
+    """Request start hook continuing the trace of the interface or starting a new one"""
+    trace_id = context.request_headers.get(tracing.CORRELATION_HEADER.lower())
+    if trace_id is None:
+        trace_id = tracing.new_id()
+    context.span = tracing.tracer.start_span(f"{context.method} {context.route}", trace_id=trace_id,
+                                             parent_id=context.request_headers.get(tracing.PARENT_HEADER.lower()),
+                                             attributes={"path": context.path})
+    context.span_token = tracing.current_span.set(context.span)
+
+
+def add_trace_header(context: Request_Context) -> None:
+    """Response start hook returning the correlation ID to the caller"""
+    if context.span is not None:
+        context.headers[tracing.CORRELATION_HEADER] = context.span.trace_id
+
+
+def finish_trace(context: Request_Context) -> None:
+    """Request end hook finishing the request span"""
+    if context.span is not None:
+        context.span.set("status", context.status)
+        context.span.set("response_bytes", context.response_bytes)
+        context.span.set("mongo_commands", context.mongo_commands)
+        tracing.current_span.reset(context.span_token)
+        context.span.finish()
+
+
+def trace_command(context: Union[Request_Context, None], command_name: str, duration: float,
+                  reply_bytes: int, details: Union[dict, None] = None, reply_documents: int = 0) -> None:
+    """Command hook recording the MongoDB command as a child of the request span"""
+    if context is not None and context.span is not None:
+        end = time()
+        # nested under the innermost server span, for example the authentication
+        parent = tracing.current_span.get() or context.span
+        tracing.tracer.record_span(f"mongo {command_name}", start=end - duration, end=end, parent=parent,
+                                   reply_bytes=reply_bytes, reply_documents=reply_documents)
+
+
+class Monitoring_Middleware(object):
+    """ASGI middleware creating the request context and calling the monitoring hooks"""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        route, path_params = match_route(scope)
+        request_headers = {}
+        for key, value in scope.get("headers", []):
+            request_headers[key.decode("latin-1").lower()] = value.decode("latin-1")
+        request_bytes = int(request_headers.get("content-length", 0))
+        context = Request_Context(method=scope["method"], path=scope["path"], route=route,
+                                  path_params=path_params, request_bytes=request_bytes,
+                                  request_headers=request_headers)
+        token = current_request.set(context)
+        for hook in request_start_hooks:
+            hook(context)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                context.status = message["status"]
+                for hook in response_start_hooks:
+                    hook(context)
+                if len(context.headers) != 0:
+                    headers = list(message.get("headers", []))
+                    for key, value in context.headers.items():
+                        headers.append((key.lower().encode("latin-1"), str(value).encode("latin-1")))
+                    message["headers"] = headers
+            elif message["type"] == "http.response.body":
+                context.response_bytes += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception:
+            context.status = 500
+            raise
+        finally:
+            context.duration = perf_counter() - context.start
+            for hook in request_end_hooks:
+                hook(context)
+            current_request.reset(token)
@@ -0,0 +1,103 @@
+""" Dataset name search. Prefixes are matched with an anchored regular expression, which MongoDB answers from the name
+index. For substrings every dataset stores the trigrams of its name in name_grams, with a multikey index, so a
+substring search only reads the datasets holding all the trigrams of the substring before the names are compared.
+Datasets inserted before the trigrams were stored are backfilled in a background thread started by the first search
+of their experiment, or by the backfill_name_index job. Until the backfill is done substrings are matched with a
+regular expression, so no dataset is missed."""
+import re
+import threading
+from typing import List, Union
+from pymongo import ASCENDING
+from pymongo.collection import Collection
+import bulk
+import pagination
+
+# declare constants for the name search
+GRAM_LENGTH = 3
+GRAMS_FIELD = "name_grams"
+BACKFILL_BATCH_SIZE = 1000  # datasets updated per bulk write
+
+# experiment collections which already have the trigram index and no datasets without trigrams
+indexed_collections = set()
+# experiment collections whose trigrams are being backfilled by a thread of this process
+backfilling = set()
+backfill_lock = threading.Lock()
+
+
+def name_grams(name: Union[str, None]) -> List[str]:
+    """Returns the distinct trigrams of a name. Names shorter than a trigram have none."""
+    if not isinstance(name, str):
+        return []
+    return sorted({name[i:i + GRAM_LENGTH] for i in range(len(name) - GRAM_LENGTH + 1)})
+
+
+def add_grams(document: dict) -> dict:
+    """Adds the trigrams of the name to a dataset document about to be inserted"""
+    document[GRAMS_FIELD] = name_grams(document.get("name"))
+    return document
+
+
+def backfill(collection: Collection) -> None:
+    """Creates the trigram index and stores the trigrams of the datasets without them"""
+    key = pagination.collection_key(collection)
+    try:
+        collection.create_index([(GRAMS_FIELD, ASCENDING)])
+        requests = []
+        for document in collection.find({GRAMS_FIELD: {"$exists": False}}, {"name": 1}):
+            requests.append(bulk.update_one(collection, {"_id": document["_id"]},
+                                            {"$set": {GRAMS_FIELD: name_grams(document.get("name"))}}))
+            if len(requests) == BACKFILL_BATCH_SIZE:
+                collection.bulk_write(requests, ordered=False)
+                requests = []
+        if len(requests) != 0:
+            collection.bulk_write(requests, ordered=False)
+        indexed_collections.add(key)
+    finally:
+        with backfill_lock:
+            backfilling.discard(key)
+
+
+def prepare(collection: Collection) -> bool:
+    """Returns whether the trigrams of the experiment can be searched. Otherwise the backfill is started in a thread,
+    unless it's already running. Checked once per collection and process."""
+    key = pagination.collection_key(collection)
+    if key in indexed_collections:
+        return True
+    if collection.find_one({GRAMS_FIELD: {"$exists": False}}, {"_id": 1}) is None:
+        collection.create_index([(GRAMS_FIELD, ASCENDING)])
+        indexed_collections.add(key)
+        return True
+    with backfill_lock:
+        if key in backfilling:
+            return False
+        backfilling.add(key)
+    threading.Thread(target=backfill, args=(collection,), name="name_search_backfill", daemon=True).start()
+    return False
+
+
+def search_query(username: str, prefix: Union[str, None], contains: Union[str, None], grams: bool = True) -> dict:
+    """Returns the query of the datasets the user can access whose name may match. Substrings shorter than a trigram,
+    or in experiments whose trigrams aren't backfilled, are matched by the regular expression alone."""
+    clauses = [{"author.name": username}]
+    if prefix:
+        clauses.append({"name": {"$regex": "^" + re.escape(prefix)}})
+    if contains:
+        grams_of_contains = name_grams(contains) if grams else []
+        if len(grams_of_contains) != 0:
+            clauses.append({GRAMS_FIELD: {"$all": grams_of_contains}})
+        else:
+            clauses.append({"name": {"$regex": re.escape(contains)}})
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+def search(collection: Collection, username: str, prefix: Union[str, None], contains: Union[str, None],
+           cursor: Union[str, None], limit: Union[int, None]) -> dict:
+    """Returns a page of the names starting with the prefix and containing the substring, in name order. Matching
+    is case-sensitive."""
+    grams = prepare(collection)
+
+    def matches(document: dict) -> bool:
+        return not contains or contains in (document.get("name") or "")
+
+    return pagination.paginate_collection(collection, search_query(username, prefix, contains, grams), cursor, limit,
+                                          matches)
@@ -0,0 +1,124 @@
+""" Cursor pagination of the listing and search calls. Names are returned in ascending order and the cursor is an
+opaque token holding the last name of the previous page."""
+import base64
+import json
+from typing import Callable, Iterable, List, Union
+from fastapi import HTTPException, status
+from pymongo import ASCENDING
+from pymongo.collection import Collection
+import bulk
+
+# declare constants for the pagination
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+
+# experiment collections which already have the name index
+indexed_collections = set()
+
+
+def encode_cursor(last_name: str) -> str:
+    """Returns the opaque cursor pointing after the given name"""
+    return base64.urlsafe_b64encode(json.dumps({"after": last_name}).encode("utf8")).decode("ascii")
+
+
+def decode_cursor(cursor: Union[str, None]) -> Union[str, None]:
+    """Returns the name the cursor points after or None for the first page"""
+    if cursor is None or cursor == "":
+        return None
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode("ascii"))).get("after")
+    except (ValueError, AttributeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid pagination cursor")
+
+
+def page_size(limit: Union[int, None]) -> int:
+    """Returns the page size capped at the maximum"""
+    if limit is None:
+        return DEFAULT_PAGE_SIZE
+    if limit < 1:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="The page size must be positive")
+    return min(limit, MAX_PAGE_SIZE)
+
+
+def make_page(names: List[str], limit: int) -> dict:
+    """Builds the response from up to limit + 1 names. The extra name signals that another page exists."""
+    next_cursor = None
+    if len(names) > limit:
+        names = names[:limit]
+        next_cursor = encode_cursor(names[-1])
+    return {"names": names, "next_cursor": next_cursor}
+
+
+def make_entries_page(entries: List[dict], limit: int) -> dict:
+    """Builds the response from up to limit + 1 documents keyed by their name"""
+    next_cursor = None
+    if len(entries) > limit:
+        entries = entries[:limit]
+        next_cursor = encode_cursor(entries[-1].get("name"))
+    return {"entries": entries, "next_cursor": next_cursor}
+
+
+def paginate(names: Iterable[str], cursor: Union[str, None], limit: Union[int, None],
+             accept: Callable[[str], bool] = lambda name: True) -> dict:
+    """Paginates an in-memory list of names, for example the databases or the collections. The accept function is
+    only called until the page is full."""
+    after = decode_cursor(cursor)
+    limit = page_size(limit)
+    page = []
+    for name in sorted(names):
+        if after is not None and name <= after:
+            continue
+        if accept(name):
+            page.append(name)
+            if len(page) > limit:
+                break
+    return make_page(page, limit)
+
+
+def collection_key(collection: Collection) -> tuple:
+    """Identifies an experiment collection in the sets of checked collections. The experiments of the consolidated
+    layout share one collection, so the scope of a scoped collection is part of the key."""
+    key = (collection.database.name, collection.name)
+    scope = bulk.get_scope(collection)
+    if scope is None:
+        return key
+    return key + tuple(sorted(scope.items()))
+
+
+def ensure_name_index(collection: Collection) -> None:
+    """Creates the name index used to walk an experiment in name order. Checked once per collection and process."""
+    key = collection_key(collection)
+    if key not in indexed_collections:
+        collection.create_index([("name", ASCENDING)])
+        indexed_collections.add(key)
+
+
+def paginate_collection(collection: Collection, query: dict, cursor: Union[str, None], limit: Union[int, None],
+                        accept: Callable[[dict], bool] = lambda document: True) -> dict:
+    """Paginates the names of the documents matching the query in an experiment collection. Only the name, author
+    and meta fields are read, never the data."""
+    after = decode_cursor(cursor)
+    limit = page_size(limit)
+    ensure_name_index(collection)
+    if after is not None:
+        query = {"$and": [query, {"name": {"$gt": after}}]}
+    page = []
+    documents = collection.find(query, {"name": 1, "author": 1, "meta": 1}).sort("name", ASCENDING)
+    for document in documents:
+        if accept(document):
+            page.append(document.get("name"))
+            if len(page) > limit:
+                break
+    documents.close()
+    return make_page(page, limit)
+
+
+def paginate_entries(collection: Collection, query: dict, cursor: Union[str, None], limit: Union[int, None],
+                     projection: dict) -> dict:
+    """Paginates whole documents in name order. The query should be served by an index ending with the name."""
+    after = decode_cursor(cursor)
+    limit = page_size(limit)
+    if after is not None:
+        query = {"$and": [query, {"name": {"$gt": after}}]}
+    entries = list(collection.find(query, projection).sort("name", ASCENDING).limit(limit + 1))
+    return make_entries_page(entries, limit)
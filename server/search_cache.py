@@ -0,0 +1,77 @@
+""" In-process cache of the meta_search results. The entries are keyed by the experiment, the user, the normalised
+meta query and the page. Every experiment has a generation which is incremented by the inserts, meta updates and
+author changes in the experiment, and an entry is only returned while the generation it was computed at is current.
+Writes made by other server processes aren't seen, so the entries also expire after SEARCH_CACHE_TTL seconds."""
+import json
+import threading
+from collections import OrderedDict
+from time import monotonic
+from typing import Dict, Tuple, Union
+
+# declare constants for the search cache
+SEARCH_CACHE_SIZE = 4096  # pages kept
+SEARCH_CACHE_TTL = 30  # seconds a page is kept
+
+
+def normalise(meta: dict) -> str:
+    """Returns the meta query in a form which doesn't depend on the order of the variables"""
+    return json.dumps(meta, sort_keys=True, separators=(",", ":"), default=str)
+
+
+class Search_Cache(object):
+    """LRU cache of meta_search pages with per-experiment generations"""
+    def __init__(self, max_size: int = SEARCH_CACHE_SIZE, ttl: float = SEARCH_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: "OrderedDict[tuple, Tuple[int, float, dict]]" = OrderedDict()
+        self.generations: Dict[Tuple[str, str], int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def key(self, project_id: str, experiment_id: str, username: str, meta: dict, cursor: Union[str, None],
+            limit: int) -> tuple:
+        """The key starts with the experiment, whose generation the entry is checked against"""
+        return project_id, experiment_id, username, normalise(meta), cursor, limit
+
+    def get(self, key: tuple) -> Union[dict, None]:
+        """Returns the cached page or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == self.generations.get(key[:2], 0) and \
+                    monotonic() - entry[1] < self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+
+    def generation(self, project_id: str, experiment_id: str) -> int:
+        """Returns the current generation of the experiment. Read before the search, so a write during the search
+        makes its page stale."""
+        with self.lock:
+            return self.generations.get((project_id, experiment_id), 0)
+
+    def put(self, key: tuple, generation: int, page: dict) -> None:
+        with self.lock:
+            self.entries[key] = (generation, monotonic(), page)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, project_id: str, experiment_id: str) -> None:
+        """Makes the cached pages of the experiment stale"""
+        with self.lock:
+            key = (project_id, experiment_id)
+            self.generations[key] = self.generations.get(key, 0) + 1
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            # the generations keep increasing, so pages computed before the clear stay stale
+            for key in self.generations:
+                self.generations[key] += 1
+
+
+cache = Search_Cache()
@@ -2,7 +2,8 @@ from typing import Union
 # Crypto
 import hashlib as h
 import random
-from secrets import compare_digest
+import threading
+from secrets import compare_digest, token_hex
 from datetime import datetime, timedelta
 
 # cryptography module
@@ -12,13 +13,96 @@ from cryptography.hazmat.primitives.asymmetric import padding, rsa
 # Server communications
 from fastapi import HTTPException, status
 from jose import jwt, JWTError
+from pymongo.collection import Collection
 from pymongo.mongo_client import MongoClient
 # Internal
 from variables import secret_key, algorithm, access_token_expire
+try:
+    import tracing
+except ImportError:  # imported by the interface as server.security
+    from server import tracing
 # declare constants for the authentication
 SECRET_KEY = secret_key
 ALGORITHM = algorithm
 ACCESS_TOKEN_EXPIRE_MINUTES = access_token_expire
+# constants for the API key pair rotation
+KEY_ROTATION_MINUTES = 60
+KEY_GRACE_MINUTES = 5
+# constants for the session store
+SESSION_CACHE_SIZE = 10000
+
+
+### session cache object
+class session_cache(object):
+    """In-process cache of the sessions validated against the session store. Sessions are immutable until they
+    expire so a cached entry is valid until its expiry date."""
+    def __init__(self, max_size: int = SESSION_CACHE_SIZE):
+        self.max_size = max_size
+        self.tokens = {}  # token -> (username, expiry)
+        self.users = {}  # username -> latest expiry
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def add(self, token: str, username: str, expiry: datetime) -> None:
+        """Stores a valid session"""
+        with self.lock:
+            if len(self.tokens) >= self.max_size:
+                self.tokens.pop(next(iter(self.tokens)))  # drop the oldest entry
+            if len(self.users) >= self.max_size:
+                self.users.pop(next(iter(self.users)))
+            self.tokens[token] = (username, expiry)
+            if self.users.get(username, expiry) <= expiry:
+                self.users[username] = expiry
+
+    def get_token(self, token: str):
+        """Returns the username of an unexpired cached session or None"""
+        with self.lock:
+            entry = self.tokens.get(token)
+            if entry is not None and entry[1] > datetime.utcnow():
+                self.hits += 1
+                return entry[0]
+            self.tokens.pop(token, None)
+            self.misses += 1
+            return None
+
+    def check_user(self, username: str) -> bool:
+        """Returns True if the user has an unexpired cached session"""
+        with self.lock:
+            expiry = self.users.get(username)
+            if expiry is not None and expiry > datetime.utcnow():
+                self.hits += 1
+                return True
+            self.users.pop(username, None)
+            self.misses += 1
+            return False
+
+    def clear(self) -> None:
+        with self.lock:
+            self.tokens.clear()
+            self.users.clear()
+
+
+sessions = session_cache()
+
+
+def init_session_store(client: MongoClient) -> None:
+    """Creates the indexes of the session collection. The TTL index removes sessions once they expire."""
+    collection = client["Authentication"]["Sessions"]
+    collection.create_index("expiry", expireAfterSeconds=0)
+    collection.create_index("token", unique=True)
+    collection.create_index("username")
+
+
+def has_permission(document: Union[dict, None], username: str, write: bool = False) -> bool:
+    """Returns True if the user is an author of the project, experiment or dataset document. With write the author
+    also needs the write permission."""
+    if document is None:
+        return False
+    for author in document.get("author") or []:
+        if author.get("name") == username and (not write or author.get("permission") == "write"):
+            return True
+    return False
 
 ### key manager object
 class key_manager(object):
@@ -89,6 +173,78 @@ class key_manager(object):
         return key
 
 
+### key service object
+class key_service(key_manager):
+    """Keeps the API key pair in memory. The pair is rotated every rotation period by a thread and the previous
+    private key is still accepted for the grace period, so a client which fetched the public key just before
+    a rotation can still create a user."""
+    def __init__(self, rotation_period: timedelta = timedelta(minutes=KEY_ROTATION_MINUTES),
+                 grace_period: timedelta = timedelta(minutes=KEY_GRACE_MINUTES)):
+        key_manager.__init__(self)
+        self.rotation_period = rotation_period
+        self.grace_period = grace_period
+        self.lock = threading.Lock()
+        self.private_key = None
+        self.public_pem = b""
+        self.created = datetime.utcnow()
+        self.previous_key = None
+        self.retired = datetime.utcnow()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.rotate()
+
+    def rotate(self) -> None:
+        """Generates a new key pair in memory and keeps the current private key as the previous one"""
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+        public_pem = private_key.public_key().public_bytes(encoding=serialization.Encoding.PEM,
+                                                          format=serialization.PublicFormat.SubjectPublicKeyInfo)
+        with self.lock:
+            self.previous_key = self.private_key
+            self.retired = datetime.utcnow()
+            self.private_key = private_key
+            self.public_pem = public_pem
+            self.created = datetime.utcnow()
+
+    def run(self) -> None:
+        """Rotates the key pair every rotation period until stopped"""
+        while not self.stopping.wait(self.rotation_period.total_seconds()):
+            self.rotate()
+
+    def start(self) -> None:
+        """Starts the rotation thread, so the key generation never runs on the request path"""
+        self.stopping.clear()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="key-rotation", daemon=True)
+            self.thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def get_public_key(self) -> str:
+        """Returns the current public key as a PEM string. No disk access."""
+        return self.public_pem.decode('utf-8')
+
+    def valid_private_keys(self) -> list:
+        """Returns the private keys accepted for decryption. The previous key is dropped after the grace period."""
+        keys = [self.private_key]
+        if self.previous_key is not None and datetime.utcnow() - self.retired < self.grace_period:
+            keys.append(self.previous_key)
+        return keys
+
+    def decrypt(self, message: str) -> str:
+        """Decrypts the message with the current key and falls back to the previous key within the grace period"""
+        for private_key in self.valid_private_keys():
+            try:
+                return self.decrypt_message(message=message, private_key=private_key)
+            except ValueError:
+                continue  # encrypted with a different key
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail="The message was encrypted with an expired key. Fetch the public key again.")
+
+
 
 ### User verification object
 class User_Auth(key_manager):
@@ -139,29 +295,55 @@ class User_Auth(key_manager):
             return temp.hexdigest(64)  # return a string from bytes
 
     def create_access_token(self, expires_delta: Union[timedelta, None] = None):
-        """Generates a jwt token for authentication between the interface and the API"""
+        """Generates a jwt token for authentication between the interface and the API and stores it as a session"""
         if expires_delta:
             expire = datetime.utcnow() + expires_delta
         else:
             expire = datetime.utcnow() + timedelta(minutes=30)
-        to_encode = {'sub': self.username, 'expiry': str(expire)}
+        to_encode = {'sub': self.username, 'expiry': str(expire), 'jti': token_hex(8)}
         encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-        authentication_exception = HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="The user doesn't exist. Can't generate token"
-        )
-        # update the token in the database
-        auth = self.client["Authentication"]
-        users = auth["Users"]
-
-        temp_list = [{'$set': {'disabled': False}}, {'$set': {'token': encoded_jwt}}, {'$set': {"expiry": expire}}]
-        # update the user database fields
-        for change in temp_list:
-            result = users.find_one_and_update({"username": self.username}, change)
-            if result is None:
-                raise authentication_exception
+        # the TTL index on expiry removes the session once it expires
+        session = {"token": encoded_jwt, "username": self.username, "expiry": expire, "created": datetime.utcnow()}
+        self.client["Authentication"]["Sessions"].insert_one(session)
+        sessions.add(encoded_jwt, self.username, expire)
         return encoded_jwt
 
+    @tracing.traced("auth login")
+    def login(self, expires_delta: Union[timedelta, None] = None) -> Union[str, None]:
+        """Verifies the password with a single read of the user and creates a session. Returns None if the credentials fail."""
+        result = self.client["Authentication"]["Users"].find_one({"username": self.username}, {"hash": 1, "salt": 1})
+        if result is None:
+            return None
+        temp = h.shake_256()
+        temp.update((result.get("salt") + self.password).encode('utf8'))
+        if not compare_digest(temp.hexdigest(64), result.get("hash")):
+            return None
+        return self.create_access_token(expires_delta=expires_delta)
+
+    def check_session(self, token: str) -> bool:
+        """Returns True if the token belongs to an unexpired session of this user"""
+        username = sessions.get_token(token)
+        if username is None:
+            result = self.client["Authentication"]["Sessions"].find_one({"token": token})
+            # the TTL monitor runs periodically so the expiry is checked as well
+            if result is None or result.get("expiry") <= datetime.utcnow():
+                return False
+            username = result.get("username")
+            sessions.add(token, username, result.get("expiry"))
+        return username == self.username
+
+    @tracing.traced("auth check_session_active")
+    def check_session_active(self) -> bool:
+        """Returns True if the user has at least one unexpired session. Replaces the disabled flag book-keeping."""
+        if sessions.check_user(self.username):
+            return True
+        result = self.client["Authentication"]["Sessions"].find_one(
+            {"username": self.username, "expiry": {"$gt": datetime.utcnow()}}, {"token": 1, "expiry": 1})
+        if result is None:
+            return False
+        sessions.add(result.get("token"), self.username, result.get("expiry"))
+        return True
+
     def check_username_exists(self) -> bool:
         """Checks that the user with the given username exists within the database"""
         auth = self.client["Authentication"]
@@ -231,6 +413,7 @@ class User_Auth(key_manager):
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                                 detail="The user was not found")
 
+    @tracing.traced("auth authenticate_token")
     def authenticate_token(self) -> bool:
         """Authenticates the token within the class to be one matching and valid for the username in self.username"""
         # self.password contains the token value
@@ -247,31 +430,13 @@ class User_Auth(key_manager):
                 raise credentials_exception
             # username recovered successfully
         except JWTError:
-            self.deactivate_user()
             raise credentials_exception
 
         if username == self.username:
             # username matches the token
-            # check the token matches the one in the database
-            fetched_user = self.fetch_user()  # fetches the user data
-
-            if fetched_user is None:
-                raise credentials_exception
-
-
-            if compare_digest(self.password, fetched_user.get("token")):  # compares tokens
-                # successfully compared tokens
-                # check the token is valid
-                # check the token expiry date matches the one in the database
-                now = datetime.utcnow()
-                # check the token is not expired
-                if now < fetched_user.get("expiry"):
-                    # user successfully validated
-                    # activate user
-                    self.activate_user()
-                    return True
-        # deactivate user
-        self.deactivate_user()
+            # check the token belongs to an unexpired session
+            if self.check_session(self.password):
+                return True
         raise credentials_exception
 
     def update_disable_status(self):
@@ -285,9 +450,8 @@ class User_Auth(key_manager):
         else:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User doesn't exist")
 
-    def check_author(self, project_id, experiment_id, dataset_id) -> bool:
-        """Verifies the dataset in the given path has the specified author and returns True if access is allowed"""
-        experiment = self.client[project_id][experiment_id]
+    def check_author(self, experiment: Collection, dataset_id) -> bool:
+        """Verifies the dataset in the experiment has the specified author and returns True if access is allowed"""
         result = experiment.find_one({"name" : dataset_id})
         if result != None:
             author_list = result.get("author")
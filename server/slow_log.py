@@ -0,0 +1,85 @@
+""" Slow request and slow query log. Requests and MongoDB commands over the thresholds are written as JSON lines with
+the route, the project and experiment, the response size, the MongoDB accounting and the filters used, so the
+expensive calls can be reproduced."""
+import json
+import threading
+from datetime import datetime
+from typing import Union
+from monitoring import Request_Context
+
+# declare constants for the slow log
+SLOW_REQUEST_SECONDS = 1.0
+SLOW_QUERY_SECONDS = 0.1
+# file the slow requests and slow MongoDB commands are written to, for example "slow_requests.log". None disables the
+# slow log
+SLOW_LOG_FILE = None
+
+
+def query_shape(query):
+    """Returns the query with the values replaced by '?', so the log shows the filter used without the data"""
+    if isinstance(query, dict):
+        return {key: query_shape(value) for key, value in query.items()}
+    if isinstance(query, (list, tuple)):
+        return [query_shape(value) for value in query]
+    return "?"
+
+
+class Slow_Log(object):
+    """Writes the slow requests and the slow MongoDB commands to a local file as JSON lines"""
+    def __init__(self, file_name: str, request_threshold: float = SLOW_REQUEST_SECONDS,
+                 query_threshold: float = SLOW_QUERY_SECONDS):
+        self.file_name = file_name
+        self.request_threshold = request_threshold
+        self.query_threshold = query_threshold
+        self.lock = threading.Lock()
+
+    def write(self, entry: dict) -> None:
+        line = json.dumps(entry, default=str) + "\n"
+        with self.lock:
+            with open(self.file_name, "a") as f:
+                f.write(line)
+                f.close()
+
+    def request_finished(self, context: Request_Context) -> None:
+        """Request end hook logging the requests slower than the request threshold"""
+        if context.duration < self.request_threshold:
+            return
+        params = context.path_params
+        self.write({
+            "type": "request",
+            "time": datetime.utcnow().isoformat(),
+            "method": context.method,
+            "route": context.route,
+            "project": params.get("project_id", params.get("project_name")),
+            "experiment": params.get("experiment_id", params.get("experiment_name")),
+            "dataset": params.get("dataset_id", params.get("dataset_name")),
+            "status": context.status,
+            "duration_ms": round(context.duration * 1000, 3),
+            "request_bytes": context.request_bytes,
+            "response_bytes": context.response_bytes,
+            "mongo_commands": context.mongo_commands,
+            "mongo_duration_ms": round(context.mongo_duration * 1000, 3),
+            "mongo_command_counts": context.mongo_command_counts,
+            "trace_id": context.span.trace_id if context.span is not None else None,
+            "parameters": context.annotations
+        })
+
+    def command_finished(self, context: Union[Request_Context, None], command_name: str, duration: float,
+                         reply_bytes: int, details: Union[dict, None] = None, reply_documents: int = 0) -> None:
+        """Command hook logging the MongoDB commands slower than the query threshold"""
+        if duration < self.query_threshold:
+            return
+        entry = {
+            "type": "query",
+            "time": datetime.utcnow().isoformat(),
+            "route": "background" if context is None else context.route,
+            "command": command_name,
+            "duration_ms": round(duration * 1000, 3),
+            "reply_bytes": reply_bytes,
+            "reply_documents": reply_documents
+        }
+        if details is not None:
+            entry["database"] = details["database"]
+            entry["collection"] = details["collection"]
+            entry["filter"] = query_shape(details["filter"])
+        self.write(entry)
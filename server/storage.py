@@ -0,0 +1,343 @@
+""" Storage layout and dataset reads and writes. Every insert goes through these functions so the blobs and the manifest
+stay in step with the experiments. Fragmented datasets are reassembled here so the interface receives one dataset.
+
+Two layouts are supported. In the database layout every project is a MongoDB database and every experiment a
+collection. In the consolidated layout every dataset is stored in one collection keyed by (project, experiment, name)
+and the project configs and manifests in shared collections keyed by project. get_project returns an object with the
+Database interface for either layout, so the API code doesn't depend on the layout. migrate.py copies a deployment
+from the database layout to the consolidated layout."""
+import json
+import bson
+from typing import Iterator, List, Tuple, Union
+from pymongo import ASCENDING
+from pymongo.collection import Collection
+from pymongo.database import Database
+from pymongo.errors import OperationFailure
+from pymongo.mongo_client import MongoClient
+import datastructure as d
+import blobs
+import derived
+import manifest
+import name_search
+import search_cache
+import timeseries
+
+DATABASE_LAYOUT = "database"
+CONSOLIDATED_LAYOUT = "consolidated"
+LAYOUT = DATABASE_LAYOUT
+"""Storage layout used by the API. Run migrate.py before switching a deployment to the consolidated layout."""
+
+CONSOLIDATED_DATABASE = "ResData"
+"""Database holding every project in the consolidated layout"""
+DATASETS_COLLECTION = "datasets"
+PROJECTS_COLLECTION = "projects"
+SYSTEM_DATABASES = ("Authentication", "Jobs", "admin", "local", "config", CONSOLIDATED_DATABASE)
+"""Databases which aren't projects in the database layout"""
+
+# meta variables written by the interface when it splits a dataset into parts
+FRAGMENT_META = ("fragmented", "number_of_fragments")
+FRAGMENT_PART_META = ("parent_dataset", "fragment_id")
+# field find_dataset returns the BSON size of a dataset in
+SIZE_FIELD = "_stored_size"
+
+# (database, collection, index) of the indexes which have been checked by this process
+indexed = set()
+
+
+def ensure_index(collection: Collection, keys: List[Tuple[str, int]]) -> None:
+    """Creates the index unless this process has already checked it"""
+    key = (collection.database.name, collection.name, tuple(keys))
+    if key not in indexed:
+        collection.create_index(keys)
+        indexed.add(key)
+
+
+class Scoped_Collection(object):
+    """A shared collection of the consolidated layout restricted to one project or experiment. The scope fields are
+    added to every query, inserted document and index, so it can be used like the collection of the database layout.
+    Documents read through it carry the scope fields unless the projection excludes fields."""
+    def __init__(self, collection: Collection, scope: dict):
+        self.collection = collection
+        self.scope = scope
+        self.database = collection.database
+        self.name = collection.name
+
+    def scoped(self, query: Union[dict, None]) -> dict:
+        if not query:
+            return dict(self.scope)
+        return {"$and": [self.scope, query]}
+
+    def projected(self, projection: Union[dict, None]) -> Union[dict, None]:
+        """Hides the scope fields from an exclusion projection, for documents returned to the interface as they are"""
+        if projection and isinstance(projection, dict) and not any(projection.values()):
+            projection = dict(projection)
+            projection.update({key: 0 for key in self.scope})
+        return projection
+
+    def document(self, document: dict) -> dict:
+        """Adds the scope fields to a document to be written. The document is updated in place like insert_one does.
+        Dotted scope fields are written into the embedded document."""
+        for key, value in self.scope.items():
+            *path, field = key.split(".")
+            target = document
+            for part in path:
+                target = target.setdefault(part, {})
+            target[field] = value
+        return document
+
+    def with_options(self, **kwargs) -> "Scoped_Collection":
+        return Scoped_Collection(self.collection.with_options(**kwargs), self.scope)
+
+    def create_index(self, keys, **kwargs):
+        return self.collection.create_index([(key, ASCENDING) for key in self.scope] + list(keys), **kwargs)
+
+    def find(self, filter=None, projection=None, *args, **kwargs):
+        return self.collection.find(self.scoped(filter), self.projected(projection), *args, **kwargs)
+
+    def find_one(self, filter=None, projection=None, *args, **kwargs):
+        return self.collection.find_one(self.scoped(filter), self.projected(projection), *args, **kwargs)
+
+    def count_documents(self, filter, **kwargs):
+        return self.collection.count_documents(self.scoped(filter), **kwargs)
+
+    def distinct(self, key, filter=None, **kwargs):
+        return self.collection.distinct(key, self.scoped(filter), **kwargs)
+
+    def aggregate(self, pipeline, **kwargs):
+        return self.collection.aggregate([{"$match": self.scope}] + list(pipeline), **kwargs)
+
+    def insert_one(self, document, **kwargs):
+        return self.collection.insert_one(self.document(document), **kwargs)
+
+    def insert_many(self, documents, **kwargs):
+        return self.collection.insert_many([self.document(document) for document in documents], **kwargs)
+
+    def update_one(self, filter, update, **kwargs):
+        return self.collection.update_one(self.scoped(filter), update, **kwargs)
+
+    def update_many(self, filter, update, **kwargs):
+        return self.collection.update_many(self.scoped(filter), update, **kwargs)
+
+    def replace_one(self, filter, replacement, **kwargs):
+        return self.collection.replace_one(self.scoped(filter), self.document(replacement), **kwargs)
+
+    def find_one_and_update(self, filter, update, **kwargs):
+        return self.collection.find_one_and_update(self.scoped(filter), update, **kwargs)
+
+    def delete_many(self, filter, **kwargs):
+        return self.collection.delete_many(self.scoped(filter), **kwargs)
+
+    def bulk_write(self, requests, **kwargs):
+        """The requests are built for this collection with the functions of bulk.py, which add the scope"""
+        return self.collection.bulk_write(requests, **kwargs)
+
+
+class Scoped_Database(object):
+    """A project of the consolidated layout with the Database interface used by the API"""
+    def __init__(self, database: Database, project_id: str):
+        self.database = database
+        self.name = project_id
+
+    def __getitem__(self, name: str):
+        if name == "config":
+            return Scoped_Collection(self.database[PROJECTS_COLLECTION], {"project": self.name})
+        if name in (manifest.MANIFEST_COLLECTION, derived.DERIVED_COLLECTION):
+            return Scoped_Collection(self.database[name], {"project": self.name})
+        if name == blobs.BLOB_COLLECTION:
+            # the blobs are content addressed and shared by the projects
+            return self.database[blobs.BLOB_COLLECTION]
+        if name == timeseries.SAMPLES_COLLECTION:
+            # the project is part of the series, so the time-series buckets don't mix projects
+            return Scoped_Collection(self.database[timeseries.SAMPLES_COLLECTION], {"series.project": self.name})
+        return Scoped_Collection(self.database[DATASETS_COLLECTION], {"project": self.name, "experiment": name})
+
+    def with_options(self, **kwargs) -> "Scoped_Database":
+        return Scoped_Database(self.database.with_options(**kwargs), self.name)
+
+    def create_collection(self, name: str, **kwargs):
+        """Creates a shared collection of the consolidated database"""
+        self.database.create_collection(name, **kwargs)
+        return self[name]
+
+    def list_collection_names(self) -> List[str]:
+        names = self.database[DATASETS_COLLECTION].distinct("experiment", {"project": self.name})
+        if self.database[PROJECTS_COLLECTION].find_one({"project": self.name}, {"_id": 1}) is not None:
+            names.append("config")
+        return names
+
+
+def get_project(client: MongoClient, project_id: str) -> Union[Database, Scoped_Database]:
+    """Returns the project with the Database interface in the configured layout"""
+    if LAYOUT == CONSOLIDATED_LAYOUT:
+        return Scoped_Database(client[CONSOLIDATED_DATABASE], project_id)
+    return client[project_id]
+
+
+def list_projects(client: MongoClient) -> List[str]:
+    """Returns the project names. Uses the project index in the consolidated layout."""
+    if LAYOUT == CONSOLIDATED_LAYOUT:
+        return client[CONSOLIDATED_DATABASE][PROJECTS_COLLECTION].distinct("project")
+    return [name for name in client.list_database_names() if name not in SYSTEM_DATABASES]
+
+
+def create_consolidated_indexes(client: MongoClient) -> None:
+    database = client[CONSOLIDATED_DATABASE]
+    database[PROJECTS_COLLECTION].create_index([("project", ASCENDING)])
+    database[DATASETS_COLLECTION].create_index([("project", ASCENDING), ("experiment", ASCENDING),
+                                                ("name", ASCENDING)])
+
+
+def init_layout(client: MongoClient) -> None:
+    """Creates the indexes of the configured layout"""
+    if LAYOUT == CONSOLIDATED_LAYOUT:
+        create_consolidated_indexes(client)
+
+
+def store_dataset(project: Database, experiment_id: str, document: dict, data_hash: Union[str, None] = None,
+                  description: Union[dict, None] = None) -> None:
+    """Inserts a dataset document with the trigrams of its name, storing large data arrays once per project,
+    records it in the experiment manifest and makes the cached meta_search pages of the experiment stale. Raises
+    KeyError if data_hash references unknown data. A known description of the data saves describing it again."""
+    stored, description = blobs.store(project, document, data_hash, description)
+    project[experiment_id].insert_one(name_search.add_grams(stored))
+    manifest.record_dataset(project, experiment_id, document, description)
+    search_cache.cache.invalidate(project.name, experiment_id)
+
+
+def store_datasets(project: Database, experiment_id: str, batch: List[Tuple[dict, Union[str, None]]]) -> None:
+    """Inserts a batch of (document, data_hash) pairs with one bulk insert and one manifest bulk write"""
+    documents = []
+    stored = []
+    descriptions = []
+    for document, data_hash in batch:
+        stored_document, description = blobs.store(project, document, data_hash)
+        documents.append(document)
+        stored.append(name_search.add_grams(stored_document))
+        descriptions.append(description)
+    if len(stored) != 0:
+        project[experiment_id].insert_many(stored, ordered=False)
+        manifest.record_datasets(project, experiment_id, documents, descriptions)
+        search_cache.cache.invalidate(project.name, experiment_id)
+
+
+def check_rows(headings: Union[List[str], None], rows: list) -> None:
+    """Raises ValueError unless every row has one value per heading. Datasets with a single heading take any values."""
+    if headings is None or len(headings) < 2:
+        return
+    for row in rows:
+        if not isinstance(row, list) or len(row) != len(headings):
+            raise ValueError(f"Every row needs {len(headings)} values, one per heading")
+
+
+def append_data(project: Database, experiment_id: str, dataset: dict, rows: list) -> None:
+    """Appends rows to the data of a dataset with $push, so the cost depends on the rows and not on the dataset. The
+    dataset is the document returned by the permission check and needs its data_ref. Deduplicated data is shared,
+    so it is copied back into the dataset by the first append. The version of the dataset is incremented, its
+    derived datasets are deleted, and the manifest entry is updated with the size of the rows and its content hash
+    is cleared."""
+    collection = project[experiment_id]
+    name = dataset.get("name")
+    data_ref = dataset.get("data_ref")
+    if data_ref is not None:
+        blob = project[blobs.BLOB_COLLECTION].find_one({"_id": data_ref}, {"data": 1})
+        data = (blob.get("data") if blob is not None else None) or []
+        # matches nothing if a concurrent append copied the data first
+        result = collection.update_one({"name": name, "data_ref": data_ref},
+                                       {"$set": {"data": data + rows}, "$unset": {"data_ref": ""},
+                                        "$inc": {"version": 1}})
+        if result.modified_count == 0:
+            data_ref = None
+    if data_ref is None:
+        collection.update_one({"name": name}, {"$push": {"data": {"$each": rows}}, "$inc": {"version": 1}})
+    derived.invalidate(project, experiment_id, name)
+    manifest.record_append(project, experiment_id, name, d.count_elements(rows),
+                           len(bson.encode({"data": rows})) - len(bson.encode({"data": []})))
+
+
+def meta_update(dataset: dict, request: d.Meta_Update) -> dict:
+    """Builds the $set/$unset update of a meta update request. Raises ValueError for invalid names and for the meta
+    variables describing the fragmentation."""
+    set_meta = request.set or {}
+    unset_meta = request.unset or []
+    for key in list(set_meta) + unset_meta:
+        if not isinstance(key, str) or key == "" or "." in key or key.startswith("$"):
+            raise ValueError(f"'{key}' isn't a valid meta variable name")
+        if key in FRAGMENT_META or key in FRAGMENT_PART_META:
+            raise ValueError(f"The meta variable '{key}' describes the fragmentation and can't be changed")
+    if len(set(set_meta) & set(unset_meta)) != 0:
+        raise ValueError("A meta variable can't be set and unset together")
+    update = {}
+    if dataset.get("meta") is None:
+        # fields can't be created inside a null meta
+        if len(set_meta) != 0:
+            update["$set"] = {"meta": set_meta}
+    else:
+        if len(set_meta) != 0:
+            update["$set"] = {"meta." + key: value for key, value in set_meta.items()}
+        if len(unset_meta) != 0:
+            update["$unset"] = {"meta." + key: "" for key in unset_meta}
+    if request.data_headings is not None:
+        update.setdefault("$set", {})["data_headings"] = request.data_headings
+    return update
+
+
+def find_dataset(project: Database, experiment_id: str, name: str) -> Tuple[Union[dict, None], int]:
+    """Returns a dataset document as stored, its data possibly a blob reference, with its BSON size in bytes. Both
+    are read in one round trip. Servers before MongoDB 4.4 have no $bsonSize, so the document is measured here."""
+    try:
+        for document in project[experiment_id].aggregate([{"$match": {"name": name}}, {"$limit": 1},
+                                                           {"$addFields": {SIZE_FIELD: {"$bsonSize": "$$ROOT"}}}]):
+            return document, document.pop(SIZE_FIELD)
+        return None, 0
+    except OperationFailure:
+        document = project[experiment_id].find_one({"name": name})
+        return document, 0 if document is None else len(bson.encode(document))
+
+
+def narrow_meta(path: str, value, query: dict) -> None:
+    """Adds the conditions on a meta value to the query of the meta_search candidates. Objects are compared by their
+    fields with dotted paths, since MongoDB compares embedded documents field order included. Values whose keys
+    can't be written as a path are left to the exact comparison of the candidates."""
+    if not isinstance(value, dict):
+        query[path] = value
+        return
+    for key, field in value.items():
+        if isinstance(key, str) and key != "" and "." not in key and not key.startswith("$"):
+            narrow_meta(path + "." + key, field, query)
+
+
+def is_fragmented(document: dict) -> bool:
+    return (document.get("meta") or {}).get("fragmented") == True
+
+
+def fragment_query(collection: Collection, dataset_id: str, projection: dict):
+    """Returns a cursor over the parts of a fragmented dataset in fragment order, served by an index"""
+    ensure_index(collection, [("meta.parent_dataset", ASCENDING), ("meta.fragment_id", ASCENDING)])
+    return collection.find({"meta.parent_dataset": dataset_id}, projection).sort("meta.fragment_id", ASCENDING)
+
+
+def reassemble(project: Database, experiment_id: str, front: dict, extra: Union[dict, None] = None,
+               batch_size: int = 1) -> Iterator[str]:
+    """Yields the JSON of a fragmented dataset with the data of the front document followed by the data of its parts.
+    Only one part is held in memory at a time. The fragmentation meta variables are removed, so the result is the
+    dataset as it was before the interface split it. The extra fields are written before the dataset fields."""
+    meta = {key: value for key, value in (front.get("meta") or {}).items() if key not in FRAGMENT_META}
+    head = "".join(json.dumps(key) + ": " + json.dumps(value) + ", " for key, value in (extra or {}).items())
+    yield '{' + head + '"name": ' + json.dumps(front.get("name")) + ', "data": ['
+    separator = ""
+    data = blobs.resolve(project, front).get("data") or []
+    if len(data) != 0:
+        yield ", ".join(json.dumps(value) for value in data)
+        separator = ", "
+    parts = fragment_query(project[experiment_id], front.get("name"), {"data": 1, "data_ref": 1})
+    try:
+        for part in parts.batch_size(batch_size):
+            data = blobs.resolve(project, part).get("data") or []
+            if len(data) != 0:
+                yield separator + ", ".join(json.dumps(value) for value in data)
+                separator = ", "
+    finally:
+        parts.close()
+    yield '], "meta": ' + json.dumps(meta) + ', "data_type": ' + json.dumps(front.get("data_type")) + \
+          ', "author": ' + json.dumps(front.get("author")) + ', "data_headings": ' + \
+          json.dumps(front.get("data_headings")) + '}'
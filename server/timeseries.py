@@ -0,0 +1,190 @@
+""" Time-series experiments. The experiment collection holds only the experiment config, with the data_type
+TIMESERIES_TYPE and the sample headings, and the samples of all the time-series experiments of a project are stored in
+the samples collection. MongoDB stores it as a time-series collection which groups the samples of a series into
+compressed buckets. Each sample holds its time, the series it belongs to and its values by heading."""
+from datetime import datetime, timedelta, timezone
+import json
+from typing import List, Union
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import ASCENDING
+from pymongo.database import Database
+from pymongo.errors import CollectionInvalid, OperationFailure
+from fastapi import HTTPException, status
+import datastructure as d
+import pagination
+
+SAMPLES_COLLECTION = "samples"
+TIMESERIES_TYPE = "time series"
+"""data_type of the config document of a time-series experiment"""
+TIME_FIELD = "time"
+META_FIELD = "series"
+EPOCH = datetime(1970, 1, 1)
+GRANULARITY = "seconds"
+"""Expected interval between the samples of a series, used by MongoDB to size the buckets"""
+
+# projects whose samples collection has been checked by this process
+created_projects = set()
+
+
+def get_samples(project: Database):
+    """Returns the samples collection of the project, creating it as a time-series collection on first use. Servers
+    without time-series collections get a plain collection with the same index."""
+    collection = project[SAMPLES_COLLECTION]
+    if project.name not in created_projects:
+        try:
+            project.create_collection(SAMPLES_COLLECTION, timeseries={"timeField": TIME_FIELD,
+                                                                      "metaField": META_FIELD,
+                                                                      "granularity": GRANULARITY})
+        except CollectionInvalid:
+            pass  # created earlier
+        except OperationFailure:
+            pass  # MongoDB before 5.0
+        collection.create_index([("series.experiment", ASCENDING), ("series.name", ASCENDING),
+                                 (TIME_FIELD, ASCENDING)])
+        created_projects.add(project.name)
+    return collection
+
+
+def config_document(experiment_id: str, request: d.Timeseries) -> dict:
+    """Returns the config document of a new time-series experiment. Raises ValueError for invalid headings."""
+    if len(request.headings) == 0 or len(set(request.headings)) != len(request.headings):
+        raise ValueError("The headings must be a non-empty list of distinct names")
+    for heading in request.headings:
+        if heading == "" or "." in heading or heading.startswith("$"):
+            raise ValueError(f"'{heading}' isn't a valid heading")
+    return {
+        "name": experiment_id,
+        "meta": request.meta,
+        "data_type": TIMESERIES_TYPE,
+        "data": [],
+        "author": request.author,
+        "data_headings": request.headings
+    }
+
+
+def get_config(project: Database, experiment_id: str) -> dict:
+    """Returns the config of a time-series experiment or raises 404"""
+    config = project[experiment_id].find_one({"name": experiment_id, "data_type": TIMESERIES_TYPE},
+                                             {"author": 1, "data_headings": 1})
+    if config is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"'{experiment_id}' isn't a time-series experiment")
+    return config
+
+
+def sample_documents(experiment_id: str, headings: List[str], series: str, samples: List[d.Sample]) -> List[dict]:
+    """Converts samples into the documents of the samples collection. Raises ValueError for samples whose values
+    don't match the headings."""
+    documents = []
+    for sample in samples:
+        if len(sample.values) != len(headings):
+            raise ValueError(f"Every sample needs {len(headings)} values, one per heading")
+        documents.append(sample_document(experiment_id, headings, series, sample.time, sample.values))
+    return documents
+
+
+def sample_document(experiment_id: str, headings: List[str], series: str, time: datetime, values: list) -> dict:
+    return {
+        TIME_FIELD: time,
+        META_FIELD: {"experiment": experiment_id, "name": series},
+        "values": dict(zip(headings, values))
+    }
+
+
+def append(project: Database, documents: List[dict]) -> int:
+    if len(documents) != 0:
+        get_samples(project).insert_many(documents, ordered=False)
+    return len(documents)
+
+
+def to_utc(time: Union[datetime, None]) -> Union[datetime, None]:
+    """Returns the time as a naive UTC datetime, the form MongoDB returns"""
+    if time is None or time.tzinfo is None:
+        return time
+    return time.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def encode_position(time: datetime, series: str, sample_id: Union[ObjectId, None] = None) -> str:
+    """Returns the cursor after a sample or an interval. Raw samples carry their _id, which breaks the ties between
+    samples of a series with the same time."""
+    return pagination.encode_cursor(json.dumps([time.isoformat(), series,
+                                                str(sample_id) if sample_id is not None else None]))
+
+
+def decode_position(cursor: Union[str, None]):
+    after = pagination.decode_cursor(cursor)
+    if after is None:
+        return None
+    try:
+        time, series, *sample_id = json.loads(after)
+        sample_id = ObjectId(sample_id[0]) if len(sample_id) != 0 and sample_id[0] is not None else None
+        return datetime.fromisoformat(time), series, sample_id
+    except (TypeError, ValueError, InvalidId):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="The cursor is invalid")
+
+
+def time_query(experiment_id: str, series: Union[str, None], start: Union[datetime, None],
+               end: Union[datetime, None]) -> dict:
+    match = {"series.experiment": experiment_id}
+    if series is not None:
+        match["series.name"] = series
+    time_range = {}
+    if start is not None:
+        time_range["$gte"] = start
+    if end is not None:
+        time_range["$lt"] = end
+    if len(time_range) != 0:
+        match[TIME_FIELD] = time_range
+    return match
+
+
+def query_samples(project: Database, experiment_id: str, headings: List[str], query: d.Sample_Query,
+                  cursor: Union[str, None], limit: Union[int, None]) -> dict:
+    """Returns a page of the samples in the time range, in time order. With an interval the samples of each series
+    are averaged over the intervals by the aggregation, so only the averages leave the database."""
+    limit = pagination.page_size(limit)
+    position = decode_position(cursor)
+    start = to_utc(query.start)
+    end = to_utc(query.end)
+    if position is not None and (start is None or position[0] > start):
+        start = position[0]
+    samples = get_samples(project)
+    if query.every is None:
+        match = time_query(experiment_id, query.series, start, end)
+        if position is not None:
+            after = [{TIME_FIELD: {"$gt": position[0]}},
+                     {TIME_FIELD: position[0], "series.name": {"$gt": position[1]}}]
+            if position[2] is not None:
+                after.append({TIME_FIELD: position[0], "series.name": position[1], "_id": {"$gt": position[2]}})
+            match = {"$and": [match, {"$or": after}]}
+        documents = samples.find(match, {"_id": 1, TIME_FIELD: 1, "series.name": 1, "values": 1})
+        documents = list(documents.sort([(TIME_FIELD, ASCENDING), ("series.name", ASCENDING), ("_id", ASCENDING)])
+                         .limit(limit + 1))
+        rows = [{"time": document[TIME_FIELD], "series": document[META_FIELD]["name"],
+                 "values": [document["values"].get(heading) for heading in headings]} for document in documents]
+    else:
+        if query.every <= 0:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="The interval must be positive")
+        interval = max(1, int(query.every * 1000))
+        time_ms = {"$subtract": ["$" + TIME_FIELD, EPOCH]}  # milliseconds since the epoch
+        group = {"_id": {"time": {"$subtract": [time_ms, {"$mod": [time_ms, interval]}]}, "series": "$series.name"},
+                 "count": {"$sum": 1}}
+        for index, heading in enumerate(headings):
+            group[f"v{index}"] = {"$avg": "$values." + heading}
+        pipeline = [{"$match": time_query(experiment_id, query.series, start, end)}, {"$group": group}]
+        if position is not None:
+            # the interval of the cursor is complete up to its series
+            position_ms = (position[0] - EPOCH) // timedelta(milliseconds=1)
+            pipeline.append({"$match": {"$or": [{"_id.time": {"$gt": position_ms}},
+                                                {"_id.time": position_ms, "_id.series": {"$gt": position[1]}}]}})
+        pipeline += [{"$sort": {"_id.time": 1, "_id.series": 1}}, {"$limit": limit + 1}]
+        rows = [{"time": EPOCH + timedelta(milliseconds=bucket["_id"]["time"]), "series": bucket["_id"]["series"],
+                 "count": bucket["count"], "values": [bucket.get(f"v{index}") for index in range(len(headings))]}
+                for bucket in samples.aggregate(pipeline)]
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        sample_id = documents[limit - 1]["_id"] if query.every is None else None
+        next_cursor = encode_position(rows[-1]["time"], rows[-1]["series"], sample_id)
+    return {"headings": headings, "samples": rows, "next_cursor": next_cursor}
@@ -0,0 +1,140 @@
+""" Lightweight tracing shared by the interface and the API. Spans carry a correlation ID which the interface sends
+in the X-Correlation-ID header, so a single timeline covers the client, the HTTP calls, the API and its MongoDB
+commands. The file exporter writes one JSON line per finished span."""
+import contextvars
+import functools
+import json
+import threading
+import uuid
+from contextlib import contextmanager
+from time import time
+from typing import Union
+
+CORRELATION_HEADER = "X-Correlation-ID"
+"""Header carrying the trace ID between the interface and the API"""
+PARENT_HEADER = "X-Parent-Span-ID"
+"""Header carrying the ID of the client span that issued the HTTP request"""
+
+
+def new_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+class Span(object):
+    """A timed operation within a trace"""
+    def __init__(self, tracer, name: str, trace_id: str, parent_id: Union[str, None] = None,
+                 attributes: Union[dict, None] = None, start: Union[float, None] = None):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = new_id()
+        self.parent_id = parent_id
+        self.attributes = attributes if attributes is not None else {}
+        self.start = start if start is not None else time()
+        self.end = None
+
+    def set(self, key: str, value) -> None:
+        self.attributes[key] = value
+
+    def finish(self, end: Union[float, None] = None) -> None:
+        self.end = end if end is not None else time()
+        self.tracer.export(self)
+
+    def to_dict(self) -> dict:
+        return {
+            "service": self.tracer.service,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "end": self.end,
+            "duration_ms": round((self.end - self.start) * 1000, 3),
+            "attributes": self.attributes
+        }
+
+
+class File_Exporter(object):
+    """Appends the finished spans to a local file as JSON lines"""
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.lock = threading.Lock()
+
+    def export(self, span: Span) -> None:
+        line = json.dumps(span.to_dict(), default=str) + "\n"
+        with self.lock:
+            with open(self.file_name, "a") as f:
+                f.write(line)
+                f.close()
+
+
+current_span: contextvars.ContextVar = contextvars.ContextVar("current_span", default=None)
+"""The innermost active span"""
+
+
+class Tracer(object):
+    """Creates spans for a service. Without an exporter the spans are timed but not written anywhere."""
+    def __init__(self, service: str, exporter: Union[File_Exporter, None] = None):
+        self.service = service
+        self.exporter = exporter
+
+    def export(self, span: Span) -> None:
+        if self.exporter is not None:
+            self.exporter.export(span)
+
+    def start_span(self, name: str, trace_id: Union[str, None] = None, parent_id: Union[str, None] = None,
+                   attributes: Union[dict, None] = None, start: Union[float, None] = None) -> Span:
+        """Starts a span. Without an explicit trace ID the span continues the current span or starts a new trace."""
+        if trace_id is None:
+            parent = current_span.get()
+            if parent is not None:
+                trace_id = parent.trace_id
+                parent_id = parent.span_id
+            else:
+                trace_id = new_id()
+        return Span(self, name, trace_id, parent_id, attributes, start)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """Times the block as a child of the current span"""
+        span = self.start_span(name, attributes=attributes)
+        token = current_span.set(span)
+        try:
+            yield span
+        except Exception as e:
+            span.set("error", repr(e))
+            raise
+        finally:
+            current_span.reset(token)
+            span.finish()
+
+    def record_span(self, name: str, start: float, end: float, parent: Union[Span, None] = None,
+                    **attributes) -> Union[Span, None]:
+        """Records an operation which has already finished, for example a MongoDB command"""
+        if parent is None:
+            parent = current_span.get()
+        if parent is None:
+            return None
+        span = Span(self, name, parent.trace_id, parent.span_id, attributes, start)
+        span.finish(end)
+        return span
+
+
+tracer = Tracer("api")
+"""Tracer used by the API server modules. The server assigns the exporter."""
+
+
+def span(name: str, **attributes):
+    """Times the block with the API tracer"""
+    return tracer.span(name, **attributes)
+
+
+def traced(name: str):
+    """Decorator timing every call of the function with the API tracer"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,88 @@
+""" Write modes of the dataset inserts. Acknowledged writes use the write concern of the MongoClient, journaled writes
+wait for the journal and buffered writes are queued in process and written by a background thread with bulk inserts.
+Buffered writes are lost if the server stops before they are flushed; the /flush call works as a barrier."""
+import threading
+from typing import Callable, Dict, List, Tuple, Union
+from pymongo.database import Database
+from pymongo.mongo_client import MongoClient
+from pymongo.write_concern import WriteConcern
+import storage
+
+ACKNOWLEDGED = "acknowledged"
+JOURNALED = "journaled"
+BUFFERED = "buffered"
+WRITE_MODES = (ACKNOWLEDGED, JOURNALED, BUFFERED)
+
+# declare constants for the write buffer
+FLUSH_INTERVAL = 0.5  # seconds between the background flushes
+MAX_BUFFERED_DOCUMENTS = 5000  # the insert flushes the buffer itself above this size
+
+
+def get_database(client: MongoClient, project_id: str, write_mode: str) -> Database:
+    """Returns the project database with the write concern of the write mode"""
+    project = storage.get_project(client, project_id)
+    if write_mode == JOURNALED:
+        return project.with_options(write_concern=WriteConcern(j=True))
+    return project
+
+
+class Write_Buffer(object):
+    """Write-behind buffer of dataset documents. The documents are grouped by experiment and written by the store
+    function in one call per experiment."""
+    def __init__(self, store: Callable[[Database, str, List[Tuple[dict, Union[str, None]]]], None],
+                 client: MongoClient, flush_interval: float = FLUSH_INTERVAL,
+                 max_documents: int = MAX_BUFFERED_DOCUMENTS):
+        self.store = store
+        """Function writing a batch of (document, data_hash) pairs to an experiment"""
+        self.client = client
+        self.flush_interval = flush_interval
+        self.max_documents = max_documents
+        self.pending: Dict[Tuple[str, str], List[Tuple[dict, Union[str, None]]]] = {}
+        self.count = 0
+        self.written = 0
+        self.failed = 0
+        self.last_error = None
+        self.lock = threading.Lock()
+        # held while a batch is written, so a flush returns only once the earlier writes are done
+        self.flush_lock = threading.Lock()
+        self.wake_up = threading.Event()
+        self.thread = None
+
+    def start(self) -> None:
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="write-buffer", daemon=True)
+            self.thread.start()
+
+    def run(self) -> None:
+        while True:
+            self.wake_up.wait(self.flush_interval)
+            self.wake_up.clear()
+            self.flush()
+
+    def add(self, project_id: str, experiment_id: str, document: dict, data_hash: Union[str, None] = None) -> None:
+        """Queues a dataset document"""
+        with self.lock:
+            self.pending.setdefault((project_id, experiment_id), []).append((document, data_hash))
+            self.count += 1
+        self.start()
+
+    def full(self) -> bool:
+        return self.count >= self.max_documents
+
+    def flush(self) -> int:
+        """Writes the queued documents. Returns the number of documents written."""
+        with self.flush_lock:
+            with self.lock:
+                pending = self.pending
+                self.pending = {}
+                self.count = 0
+            written = 0
+            for (project_id, experiment_id), batch in pending.items():
+                try:
+                    self.store(storage.get_project(self.client, project_id), experiment_id, batch)
+                    written += len(batch)
+                except Exception as e:
+                    self.failed += len(batch)
+                    self.last_error = repr(e)
+            self.written += written
+            return written
@@ -289,3 +289,18 @@ def save_file_project(file_name: str, project: d.Project):
     with open(file_name, 'w') as file:
         json.dump(project.dict(), file)
         file.close()
+
+
+def save_file_project_ndjson(file_name: str, project: d.Project):
+    # writes one project, experiment or dataset per line. The file can be streamed by API_interface.import_project
+    with open(file_name, 'w') as file:
+        file.write(json.dumps({"type": "project", "name": project.name, "meta": project.meta,
+                               "author": project.author, "creator": project.creator}) + "\n")
+        for experiment in project.groups or []:
+            file.write(json.dumps({"type": "experiment", "name": experiment.name, "meta": experiment.meta,
+                                   "author": experiment.author}) + "\n")
+            for dataset in experiment.children:
+                record = {"type": "dataset", "experiment": experiment.name}
+                record.update(dataset.convertJSON())
+                file.write(json.dumps(record) + "\n")
+        file.close()
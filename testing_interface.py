@@ -4,9 +4,43 @@ import server.datastructure as d
 path = "http://127.0.0.1:8000/"
 #path = "http://10.99.96.185/"
 import time
+import threading
+import json
+import bson
+from datetime import datetime, timedelta
 from os.path import exists
 import jupyter_driver as jd
 import simple_interface as s
+import os
+import sys
+from types import SimpleNamespace
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+# the unit tests import the server modules, which import each other by their module name, without a running server
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server"))
+import security
+import metrics
+import monitoring
+import slow_log
+import tracing
+import pagination
+import bulk
+import mongomock
+from pymongo import MongoClient, ReplaceOne, UpdateOne
+import manifest
+import storage
+import admission
+import archive
+import blobs
+import write_buffer
+import timeseries
+import ingest
+import derived
+import search_cache
+import name_search
+import jobs
+import migrate
+import asyncio
 
 # tests to conduct
 
@@ -708,6 +742,895 @@ class TestClass:
         assert dataset_in.author == dataset_out.author
         assert dataset_in.data_headings == dataset_out.data_headings
 
+    def test_18(self):
+        # walk the dataset names and the meta search results one page at a time
+        username = "test_user"
+        password = "some_password"
+        project_name = "project_pages"
+        experiment_name = "experiment_pages"
+        ui = API_interface(path)
+        ui.purge_everything()
+        ui.create_user(username, password, "email", "full_name")
+        ui.generate_token(username, password)
+        author = [d.Author(name=username, permission="write").dict()]
+        datasets = [d.Dataset(name=f"dataset_{i:02d}", data=[i], data_type="test", author=author, data_headings=["x"],
+                              meta={"parity": i % 2}) for i in range(11)]
+        experiment = d.Experiment(name=experiment_name, children=datasets, meta={"note": "pages"}, author=author)
+        project = d.Project(name=project_name, author=author, groups=[experiment], meta=None, creator=username)
+        assert ui.insert_project(project) == True
+        ui.page_size = 3
+        names = list(ui.iter_dataset_names(project_id=project_name, experiment_id=experiment_name))
+        # the experiment configuration document is listed with the datasets
+        assert names == sorted([dataset.name for dataset in datasets] + [experiment_name])
+        names = list(ui.iter_meta_search_names({"parity": 1}, experiment_id=experiment_name, project_id=project_name))
+        assert names == [f"dataset_{i:02d}" for i in range(1, 11, 2)]
+        assert ui.get_project_names() == [project_name]
+
+    def test_19(self):
+        # the manifest describes the datasets without returning their data
+        username = "test_user"
+        password = "some_password"
+        project_name = "project_manifest"
+        experiment_name = "experiment_manifest"
+        ui = API_interface(path)
+        ui.purge_everything()
+        ui.create_user(username, password, "email", "full_name")
+        ui.generate_token(username, password)
+        author = [d.Author(name=username, permission="write").dict()]
+        dataset = d.Dataset(name="dataset_1", data=[[1, 2], [3, 4]], data_type="test", author=author,
+                            data_headings=["x", "y"], meta={"sample": "A"})
+        experiment = d.Experiment(name=experiment_name, children=[dataset], meta={"note": "manifest"}, author=author)
+        project = d.Project(name=project_name, author=author, groups=[experiment], meta=None, creator=username)
+        assert ui.insert_project(project) == True
+        entries = {entry["name"]: entry for entry in ui.get_manifest(project_name, experiment_name)}
+        assert entries["dataset_1"]["element_count"] == 4
+        assert entries["dataset_1"]["data_headings"] == ["x", "y"]
+        assert entries["dataset_1"]["meta"] == {"sample": "A"}
+        assert entries["dataset_1"]["content_hash"] == d.hash_data(dataset.data)
+        assert ui.get_experiment_names(project_name) == [experiment_name]
+
+    def test_20(self):
+        # export a project to an NDJSON file
+        username = "test_user"
+        password = "some_password"
+        file_name = "test_project.json"
+        export_name = "test_project_export.ndjson"
+        project_name = "test_project_1"
+        ui = API_interface(path)
+        ui.purge_everything()
+        ui.create_user(username, password, "email", "full_name")
+        ui.generate_token(username, password)
+        t.create_test_file_project(filename_in=file_name, structure=[2, 3], project_name=project_name,
+                                   author_name=username)
+        project_in = t.load_file_project(filename_out=file_name)
+        assert ui.insert_project(project=project_in) == True
+        assert ui.export_project(project_name=project_name, file_name=export_name) > 0
+        with open(export_name, "r") as file:
+            records = [json.loads(line) for line in file]
+        assert records[0]["type"] == "project" and records[0]["name"] == project_name
+        assert len([record for record in records if record["type"] == "experiment"]) == 2
+        assert len([record for record in records if record["type"] == "dataset"]) == 6
+
+    def test_21(self):
+        # import a project from an NDJSON file and compare it with the file
+        username = "test_user"
+        password = "some_password"
+        file_name = "test_project.json"
+        ndjson_name = "test_project.ndjson"
+        project_name = "test_project_1"
+        ui = API_interface(path)
+        ui.purge_everything()
+        ui.create_user(username, password, "email", "full_name")
+        ui.generate_token(username, password)
+        t.create_test_file_project(filename_in=file_name, structure=[2, 3], project_name=project_name,
+                                   author_name=username)
+        project_from_file = t.load_file_project(filename_out=file_name)
+        t.save_file_project_ndjson(ndjson_name, project_from_file)
+        summary = ui.import_project(ndjson_name, import_id="test_import")
+        assert summary["status"] == "done" and summary["datasets"] == 6
+        assert ui.get_import_progress("test_import")["status"] == "done"
+        project_from_db = ui.return_full_project(project_name)
+        assert project_from_db.name == project_from_file.name
+        for file_experiment, db_experiment in zip(project_from_file.groups, project_from_db.groups):
+            assert file_experiment.name == db_experiment.name
+            for file_dataset, db_dataset in zip(file_experiment.children, db_experiment.children):
+                assert file_dataset.data == db_dataset.data
+
+    def test_22(self):
+        # append samples to a time-series experiment and read them back by time range and downsampled
+        username = "test_user"
+        password = "some_password"
+        project_name = "project_timeseries"
+        ui = API_interface(path)
+        ui.purge_everything()
+        ui.create_user(username, password, "email", "full_name")
+        ui.generate_token(username, password)
+        author = [d.Author(name=username, permission="write").dict()]
+        ui.insert_project(d.Project(name=project_name, author=author, groups=[], meta=None, creator=username))
+        assert ui.create_timeseries(project_name, "pl_monitoring", ["intensity", "temperature"]) == True
+        start = datetime(2024, 1, 1)
+        samples = [(start + timedelta(seconds=i), [float(i), 20.0]) for i in range(60)]
+        assert ui.append_samples(project_name, "pl_monitoring", "channel_1", samples) == 60
+        window = ui.get_samples(project_name, "pl_monitoring", start=start + timedelta(seconds=10),
+                                end=start + timedelta(seconds=20))
+        assert [sample["values"][0] for sample in window] == [float(i) for i in range(10, 20)]
+        averages = ui.get_samples(project_name, "pl_monitoring", series="channel_1", every=30)
+        assert [average["count"] for average in averages] == [30, 30]
+        assert averages[0]["values"] == [14.5, 20.0]
+
+    def test_23(self):
+        # append rows to a stored dataset without sending the existing data
+        username = "test_user"
+        password = "some_password"
+        project_name = "project_append"
+        experiment_name = "experiment_append"
+        ui = API_interface(path)
+        ui.purge_everything()
+        ui.create_user(username, password, "email", "full_name")
+        ui.generate_token(username, password)
+        author = [d.Author(name=username, permission="write").dict()]
+        dataset = d.Dataset(name="spectrum", data=[[i, i * 2] for i in range(100)], data_type="test", author=author,
+                            data_headings=["wavelength", "intensity"], meta=None)
+        experiment = d.Experiment(name=experiment_name, children=[dataset], meta=None, author=author)
+        ui.insert_project(d.Project(name=project_name, author=author, groups=[experiment], meta=None, creator=username))
+        assert ui.append_to_dataset(project_name, experiment_name, "spectrum", [[100, 200], [101, 202]]) == 2
+        dataset_from_db = ui.return_full_dataset(project_name, experiment_name, "spectrum")
+        assert dataset_from_db.data == dataset.data + [[100, 200], [101, 202]]
+        entries = {entry["name"]: entry for entry in ui.get_manifest(project_name, experiment_name)}
+        assert entries["spectrum"]["element_count"] == 204
+
+    def test_24(self):
+        # change the meta variables of a dataset without inserting it again
+        username = "test_user"
+        password = "some_password"
+        project_name = "project_meta_update"
+        experiment_name = "experiment_meta_update"
+        ui = API_interface(path)
+        ui.purge_everything()
+        ui.create_user(username, password, "email", "full_name")
+        ui.generate_token(username, password)
+        author = [d.Author(name=username, permission="write").dict()]
+        dataset = d.Dataset(name="ring_1", data=[1, 2, 3], data_type="test", author=author, data_headings=["counts"],
+                            meta={"sample": "A", "comment": "first scan"})
+        experiment = d.Experiment(name=experiment_name, children=[dataset], meta=None, author=author)
+        ui.insert_project(d.Project(name=project_name, author=author, groups=[experiment], meta=None, creator=username))
+        assert ui.update_dataset_meta(project_name, experiment_name, "ring_1", set_meta={"quality": "bad"},
+                                      unset_meta=["comment"]) == True
+        dataset_from_db = ui.return_full_dataset(project_name, experiment_name, "ring_1")
+        assert dataset_from_db.meta == {"sample": "A", "quality": "bad"}
+        assert dataset_from_db.data == [1, 2, 3]
+
+    def test_25(self):
+        # search the dataset names by prefix and by substring
+        username = "test_user"
+        password = "some_password"
+        project_name = "project_name_search"
+        experiment_name = "experiment_name_search"
+        ui = API_interface(path)
+        ui.purge_everything()
+        ui.create_user(username, password, "email", "full_name")
+        ui.generate_token(username, password)
+        author = [d.Author(name=username, permission="write").dict()]
+        names = [f"ring_id {ring} - {kind}" for ring in (12, 120, 13) for kind in ("spectra", "image")]
+        datasets = [d.Dataset(name=name, data=[1, 2], data_type="test", author=author, data_headings=["counts"],
+                              meta=None) for name in names]
+        experiment = d.Experiment(name=experiment_name, children=datasets, meta=None, author=author)
+        ui.insert_project(d.Project(name=project_name, author=author, groups=[experiment], meta=None, creator=username))
+        assert ui.search_dataset_names(project_name, experiment_name, prefix="ring_id 12") == \
+            sorted(name for name in names if name.startswith("ring_id 12"))
+        assert ui.search_dataset_names(project_name, experiment_name, prefix="ring_id 12", contains="spectra") == \
+            ["ring_id 12 - spectra", "ring_id 120 - spectra"]
+        assert ui.search_dataset_names(project_name, experiment_name, contains="3 - im") == ["ring_id 13 - image"]
+
+    def test_26(self):
+        # grant read access to a whole project with a background job
+        username = "test_user"
+        password = "some_password"
+        username2 = "test_user2"
+        project_name = "project_jobs"
+        experiment_name = "experiment_jobs"
+        ui = API_interface(path)
+        ui.purge_everything()
+        ui.create_user(username, password, "email", "full_name")
+        ui.generate_token(username, password)
+        author = [d.Author(name=username, permission="write").dict()]
+        datasets = [d.Dataset(name=f"dataset_{i}", data=[i], data_type="test", author=author, data_headings=["counts"],
+                              meta=None) for i in range(5)]
+        experiment = d.Experiment(name=experiment_name, children=datasets, meta=None, author=author)
+        ui.insert_project(d.Project(name=project_name, author=author, groups=[experiment], meta=None, creator=username))
+        job_id = ui.submit_job("grant_permission", {"project": project_name, "author": username2, "permission": "read"})
+        job = ui.wait_for_job(job_id, poll_interval=0.1, timeout=30)
+        assert job["status"] == "done"
+        assert job["progress"]["done"] == job["progress"]["total"]
+        ui.create_user(username2, password, "email", "full_name")
+        ui2 = API_interface(path)
+        ui2.generate_token(username2, password)
+        assert ui2.get_experiment_names(project_name) == [experiment_name]
+        assert len(ui2.get_dataset_names(project_name, experiment_name)) == 6
+
+
+    def test_27(self):
+        # the API key pair rotates and the previous key decrypts until the grace period ends
+        keys = security.key_service(rotation_period=timedelta(minutes=60), grace_period=timedelta(minutes=5))
+        first_pem = keys.get_public_key()
+        message = keys.encrypt_message("test_user", keys.serialize_public_key(first_pem.encode("utf8")))
+        assert keys.decrypt(message) == "test_user"
+        keys.rotate()
+        assert keys.get_public_key() != first_pem
+        assert keys.decrypt(message) == "test_user"
+        keys.retired = datetime.utcnow() - timedelta(minutes=6)
+        try:
+            keys.decrypt(message)
+            assert False, "the retired key still decrypts"
+        except HTTPException as e:
+            assert e.status_code == 401
+        # the rotation runs in its own thread and the public key is only read by the requests
+        keys = security.key_service(rotation_period=timedelta(seconds=0.1))
+        first_pem = keys.get_public_key()
+        keys.start()
+        time.sleep(0.5)
+        keys.stop()
+        assert keys.get_public_key() != first_pem and keys.thread is None
+
+
+    def test_28(self):
+        # the session cache serves unexpired sessions, counts hits and misses and drops the oldest entries
+        sessions = security.session_cache(max_size=2)
+        expiry = datetime.utcnow() + timedelta(minutes=30)
+        sessions.add("token_1", "user_1", expiry)
+        assert sessions.get_token("token_1") == "user_1"
+        assert sessions.check_user("user_1") == True
+        assert sessions.get_token("unknown") is None
+        assert (sessions.hits, sessions.misses) == (2, 1)
+        sessions.add("token_2", "user_2", datetime.utcnow() - timedelta(seconds=1))
+        assert sessions.get_token("token_2") is None
+        assert sessions.check_user("user_2") == False
+        sessions.add("token_3", "user_3", expiry)
+        sessions.add("token_4", "user_4", expiry)
+        assert sessions.get_token("token_1") is None
+        assert sessions.get_token("token_4") == "user_4"
+        # the purge clears the cache, so the dropped sessions stop authenticating
+        sessions.clear()
+        assert sessions.get_token("token_4") is None and sessions.check_user("user_4") == False
+        # the dataset author is checked in the experiment collection given by the server
+        experiment = mongomock.MongoClient()["test_project"]["test_experiment"]
+        experiment.insert_one({"name": "test_dataset", "author": [{"name": "user_1", "permission": "read"}]})
+        user = security.User_Auth(username_in="user_1", password_in="", db_client_in=None)
+        assert user.check_author(experiment, "test_dataset") and not user.check_author(experiment, "unknown")
+
+
+    def test_29(self):
+        # the metrics are rendered in the Prometheus text exposition format
+        registry = metrics.Registry()
+        requests = registry.counter("test_requests_total", "Requests handled", ("route", "status"))
+        latency = registry.histogram("test_latency_seconds", "Latency", ("route",), buckets=(0.1, 1.0))
+        registry.callback("test_queue", "Queued items", "gauge", lambda: 3)
+        requests.inc(route="/names", status="200")
+        requests.inc(2, route="/names", status="200")
+        requests.inc(route='/a"b', status="500")
+        latency.observe(0.05, route="/names")
+        latency.observe(0.5, route="/names")
+        latency.observe(5, route="/names")
+        lines = registry.render().splitlines()
+        assert "# TYPE test_requests_total counter" in lines
+        assert 'test_requests_total{route="/names",status="200"} 3' in lines
+        assert 'test_requests_total{route="/a\\"b",status="500"} 1' in lines
+        assert 'test_latency_seconds_bucket{route="/names",le="0.1"} 1' in lines
+        assert 'test_latency_seconds_bucket{route="/names",le="1"} 2' in lines
+        assert 'test_latency_seconds_bucket{route="/names",le="+Inf"} 3' in lines
+        assert 'test_latency_seconds_sum{route="/names"} 5.55' in lines
+        assert 'test_latency_seconds_count{route="/names"} 3' in lines
+        assert "# TYPE test_queue gauge" in lines and "test_queue 3" in lines
+
+
+    def test_30(self):
+        # spans nest within a trace and the file exporter writes one JSON line per finished span
+        file_name = "test_trace.jsonl"
+        if exists(file_name):
+            os.remove(file_name)
+        tracer = tracing.Tracer("test", tracing.File_Exporter(file_name))
+        with tracer.span("outer", route="/names") as outer:
+            with tracer.span("inner"):
+                pass
+            tracer.record_span("find", outer.start, outer.start + 0.5)
+        assert tracer.record_span("orphan", 0, 1) is None
+        try:
+            with tracer.span("failing"):
+                raise ValueError("failed")
+        except ValueError:
+            pass
+        with open(file_name) as f:
+            spans = [json.loads(line) for line in f]
+        os.remove(file_name)
+        assert [span["name"] for span in spans] == ["inner", "find", "outer", "failing"]
+        assert spans[0]["trace_id"] == spans[2]["trace_id"] and spans[0]["parent_id"] == spans[2]["span_id"]
+        assert spans[1]["parent_id"] == spans[2]["span_id"] and spans[1]["duration_ms"] == 500
+        assert spans[2]["parent_id"] is None and spans[2]["attributes"] == {"route": "/names"}
+        assert spans[3]["trace_id"] != spans[2]["trace_id"] and "ValueError" in spans[3]["attributes"]["error"]
+        assert tracing.current_span.get() is None
+
+
+    def test_31(self):
+        # the cursors walk the names in order without repeating or skipping any, in memory and in a collection
+        names = [f"name_{i:02d}" for i in range(25)]
+        page = pagination.paginate(reversed(names), None, 10)
+        assert page["names"] == names[:10] and page["next_cursor"] is not None
+        page = pagination.paginate(names, page["next_cursor"], 10, lambda name: name != "name_12")
+        assert page["names"] == names[10:12] + names[13:21]
+        page = pagination.paginate(names, page["next_cursor"], 10)
+        assert page == {"names": names[21:], "next_cursor": None}
+        collection = mongomock.MongoClient()["test_project"]["test_experiment"]
+        collection.insert_many([{"name": name, "author": [{"name": "test_user"}], "data": [1]} for name in names])
+        collected = []
+        cursor = None
+        while True:
+            page = pagination.paginate_collection(collection, {"author.name": "test_user"}, cursor, 7)
+            collected += page["names"]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+        assert collected == names
+        page = pagination.paginate_entries(collection, {}, pagination.encode_cursor("name_22"), 5, {"_id": 0, "data": 0})
+        assert page == {"entries": [{"name": name, "author": [{"name": "test_user"}]} for name in names[23:]],
+                        "next_cursor": None}
+        for cursor, limit in (("not a cursor", 10), (None, 0)):
+            try:
+                pagination.paginate(names, cursor, limit)
+                assert False
+            except HTTPException as e:
+                assert e.status_code == 400
+        assert len(pagination.paginate(names, None, pagination.MAX_PAGE_SIZE + 1)["names"]) == 25
+
+
+    def test_32(self):
+        # the manifest backfill adds every dataset without an entry, even when the experiment already has entries
+        project = mongomock.MongoClient()["test_manifest_project"]
+        author = [d.Author(name="test_user", permission="write").dict()]
+        config = d.Dataset(name="test_experiment", data=[], meta=None, data_type=manifest.EXPERIMENT_CONFIG_TYPE,
+                           author=author, data_headings=["experiment_metadata"])
+        storage.store_dataset(project, "test_experiment", config.convertJSON())
+        for name in ("dataset_1", "dataset_2"):
+            dataset = d.Dataset(name=name, data=[1, 2, 3], meta=None, data_type="dataset", author=author,
+                                data_headings=["x"])
+            storage.store_dataset(project, "test_experiment", dataset.convertJSON())
+            if name == "dataset_1":
+                # the dataset written before the manifest existed
+                project[manifest.MANIFEST_COLLECTION].delete_many({})
+        manifest.ensure_manifest(project, "test_experiment")
+        entries = list(project[manifest.MANIFEST_COLLECTION].find({"author.name": "test_user"}))
+        assert sorted(entry["name"] for entry in entries) == ["dataset_1", "dataset_2"]
+        assert all(entry["element_count"] == 3 for entry in entries)
+        # the marker records the complete manifest, so later calls don't read the experiment, also in other processes
+        project["test_experiment"].insert_one({"name": "dataset_3", "data": [1], "author": author})
+        manifest.ensure_manifest(project, "test_experiment")
+        assert project[manifest.MANIFEST_COLLECTION].count_documents({"name": "dataset_3"}) == 0
+        manifest.built_experiments.clear()
+        manifest.ensure_manifest(project, "test_experiment")
+        assert project[manifest.MANIFEST_COLLECTION].count_documents({"name": "dataset_3"}) == 0
+
+
+    def test_33(self):
+        # the per-user limit queues the requests of a busy user, which get a 429 with Retry-After after the timeout
+        async def run():
+            controller = admission.Admission_Controller(max_requests=3, max_user_requests=2, max_bytes=100,
+                                                        max_user_bytes=60, queue_timeout=0.2, retry_after=7)
+            first = await controller.acquire("alice")
+            second = await controller.acquire("alice")
+            try:
+                await controller.acquire("alice")
+                assert False
+            except HTTPException as e:
+                assert e.status_code == 429 and e.headers == {"Retry-After": "7"}
+            # another user still gets the last slot, after which everybody queues
+            other = await controller.acquire("bob")
+            waiting = asyncio.ensure_future(controller.acquire("carol"))
+            await asyncio.sleep(0.05)
+            await controller.release(first)
+            assert (await waiting).username == "carol"
+            assert controller.user_requests == {"alice": 1, "bob": 1, "carol": 1}
+            # the bytes of a user are limited below the global budget
+            await controller.reserve_bytes(second, 50)
+            try:
+                await controller.reserve_bytes(second, 20)
+                assert False
+            except HTTPException as e:
+                assert e.status_code == 429
+            await controller.reserve_bytes(other, 50)
+            assert controller.bytes == 100 and controller.rejected == 2
+            await controller.release(second)
+            await controller.release(second)
+            await controller.release(other)
+            assert controller.bytes == 0 and controller.requests == 1 and controller.user_requests == {"carol": 1}
+            # a response sent to a disconnected client still returns its ticket
+            ticket = await controller.acquire("alice")
+            await controller.reserve_bytes(ticket, 10)
+            response = controller.respond(ticket, '"data"')
+
+            async def disconnected(message):
+                raise OSError("The client disconnected")
+            try:
+                await response({"type": "http"}, None, disconnected)
+                assert False
+            except OSError:
+                pass
+            assert ticket.released and controller.bytes == 0 and controller.requests == 1
+        asyncio.run(run())
+        # the download reads the size to reserve with the dataset, mongomock measures it without $bsonSize
+        project = mongomock.MongoClient()["test_project"]
+        project["test_experiment"].insert_one({"name": "test_dataset", "data": [1, 2, 3]})
+        document, size = storage.find_dataset(project, "test_experiment", "test_dataset")
+        assert document["data"] == [1, 2, 3] and size == len(bson.encode(document))
+        assert storage.find_dataset(project, "test_experiment", "unknown") == (None, 0)
+
+
+    def test_34(self):
+        # an import into an existing project needs the write permission, a read permission isn't enough
+        project = mongomock.MongoClient()["test_import_project"]
+        project["config"].insert_one({"name": "test_import_project", "meta": None, "data": [], "creator": "owner",
+                                      "author": [{"name": "owner", "permission": "write"},
+                                                 {"name": "reader", "permission": "read"}]})
+        line = json.dumps({"type": "project", "name": "test_import_project", "meta": None, "creator": "owner",
+                           "author": []}).encode("utf8")
+        reader = archive.Importer(project, "reader", archive.Import_Progress("test_read", "test_import_project"))
+        try:
+            reader.add_lines([line])
+            assert False
+        except PermissionError:
+            pass
+        owner = archive.Importer(project, "owner", archive.Import_Progress("test_write", "test_import_project"))
+        experiment = json.dumps({"type": "experiment", "name": "test_experiment", "meta": None}).encode("utf8")
+        dataset = json.dumps({"type": "dataset", "experiment": "test_experiment", "name": "test_dataset",
+                              "data": [1, 2], "meta": None, "data_type": "dataset", "data_headings": ["x"],
+                              "author": [{"name": "owner", "permission": "write"}]}).encode("utf8")
+        owner.add_lines([line, experiment, dataset])
+        owner.flush()
+        assert owner.progress.lines == 3 and owner.progress.datasets == 1
+        assert project["test_experiment"].count_documents({"name": "test_dataset"}) == 1
+
+
+    def test_35(self):
+        # identical data arrays are stored once per project, and a project only sees the blobs it stored itself
+        database = mongomock.MongoClient()[storage.CONSOLIDATED_DATABASE]
+        first, second = storage.Scoped_Database(database, "test_first"), storage.Scoped_Database(database, "test_second")
+        data = list(range(d.DEDUP_MIN_ELEMENTS))
+        author = [{"name": "test_user", "permission": "write"}]
+        for name in ("copy_1", "copy_2"):
+            storage.store_dataset(first, "test_experiment", {"name": name, "data": list(data), "author": author})
+        storage.store_dataset(first, "test_experiment", {"name": "small", "data": [1, 2], "author": author})
+        assert database[blobs.BLOB_COLLECTION].count_documents({}) == 1
+        stored = first["test_experiment"].find_one({"name": "copy_2"})
+        assert "data" not in stored and blobs.resolve(first, stored)["data"] == data
+        assert first["test_experiment"].find_one({"name": "small"})["data"] == [1, 2]
+        content_hash = stored["data_ref"]
+        assert blobs.has_blob(first, content_hash) and not blobs.has_blob(second, content_hash)
+        try:
+            storage.store_dataset(second, "test_experiment", {"name": "copy", "data": [], "author": author}, content_hash)
+            assert False
+        except KeyError:
+            pass
+        # a referenced blob is kept, an unreferenced one is released once the grace period has passed
+        storage.store_dataset(second, "test_experiment", {"name": "copy", "data": list(data), "author": author})
+        assert database[blobs.BLOB_COLLECTION].find_one({"_id": content_hash})["projects"] == ["test_first", "test_second"]
+        later = datetime.utcnow() + blobs.BLOB_GC_GRACE * 2
+        assert blobs.collect_garbage(first, {content_hash}, later) == 0
+        assert blobs.collect_garbage(first, set()) == 0
+        assert blobs.collect_garbage(first, set(), later) == 1 and not blobs.has_blob(first, content_hash)
+        assert blobs.has_blob(second, content_hash)
+        assert blobs.collect_garbage(second, set(), later) == 1
+        assert database[blobs.BLOB_COLLECTION].count_documents({}) == 0
+
+
+    def test_36(self):
+        # the buffered writes are grouped by experiment, written by a flush and a failed batch is counted
+        batches = []
+
+        def store(project, experiment_id, batch):
+            if experiment_id == "failing":
+                raise ValueError("The write failed")
+            batches.append((project.name, experiment_id, [document["name"] for document, data_hash in batch]))
+        client = mongomock.MongoClient()
+        buffer = write_buffer.Write_Buffer(store, client, flush_interval=60, max_documents=3)
+        buffer.add("test_project", "experiment_1", {"name": "a"})
+        buffer.add("test_project", "experiment_2", {"name": "b"}, "hash")
+        assert not buffer.full()
+        buffer.add("test_project", "experiment_1", {"name": "c"})
+        buffer.add("test_project", "failing", {"name": "d"})
+        assert buffer.full() and batches == []
+        assert buffer.flush() == 3
+        assert sorted(batches) == [("test_project", "experiment_1", ["a", "c"]), ("test_project", "experiment_2", ["b"])]
+        assert buffer.count == 0 and buffer.written == 3 and buffer.failed == 1 and "ValueError" in buffer.last_error
+        assert buffer.flush() == 0
+        # the write concern is set without connecting
+        journaled = write_buffer.get_database(MongoClient(connect=False), "test_project", write_buffer.JOURNALED)
+        assert journaled.write_concern.document == {"j": True}
+
+
+    def test_37(self):
+        # a fragmented dataset is reassembled in fragment order, with deduplicated parts and without the fragment meta
+        project = mongomock.MongoClient()["test_reassembly_project"]
+        author = [{"name": "test_user", "permission": "write"}]
+        large = list(range(100, 100 + d.DEDUP_MIN_ELEMENTS))
+        front = {"name": "big", "data": [1, 2], "data_type": "dataset", "author": author, "data_headings": ["x"],
+                 "meta": {"k": 1, "fragmented": True, "number_of_fragments": 3}}
+        storage.store_dataset(project, "test_experiment", dict(front))
+        for fragment_id, data in ((10, [9]), (2, large), (1, [3, 4])):
+            storage.store_dataset(project, "test_experiment", {"name": f"big_{fragment_id}", "data": data, "author": [],
+                                                               "meta": {"fragment_id": fragment_id,
+                                                                        "parent_dataset": "big"}})
+        stored = project["test_experiment"].find_one({"name": "big"})
+        assert storage.is_fragmented(stored)
+        text = "".join(storage.reassemble(project, "test_experiment", stored, {"type": "dataset"}))
+        dataset = json.loads(text)
+        assert list(dataset) == ["type", "name", "data", "meta", "data_type", "author", "data_headings"]
+        assert dataset["data"] == [1, 2, 3, 4] + large + [9]
+        assert dataset["meta"] == {"k": 1} and dataset["author"] == author
+
+
+    def test_38(self):
+        # the raw insert counts and hashes the data on the request bytes, with the values of the Python functions
+        for data in ([1, 2.5, -3e-7], [[1, 2], [], [3, [4, 5]]], [], list(range(d.DEDUP_MIN_ELEMENTS))):
+            body = json.dumps({"name": "x", "meta": {"data": [9]}, "data": data}).encode("utf8")
+            assert blobs.describe_raw(body) == {"byte_size": None, "element_count": d.count_elements(data),
+                                                "content_hash": d.hash_data(data)}
+        # data which isn't the last field, holds strings or objects or isn't a key of the body isn't described
+        for body in (b'{"data": [1], "name": "x"}', b'{"data": ["a", 1]}', b'{"data": [{"a": 1}]}',
+                     b'{"meta": {"data": [1]}}', b'{"x\\"data": [1]}', b'{"name": "data"}'):
+            assert blobs.describe_raw(body) is None
+        project = mongomock.MongoClient()["test_raw_project"]
+        data = list(range(d.DEDUP_MIN_ELEMENTS))
+        description = blobs.describe_raw(json.dumps({"name": "raw", "data": data}).encode("utf8"))
+        storage.store_dataset(project, "test_experiment", {"name": "raw", "data": data, "author": []}, None, description)
+        entry = project[manifest.MANIFEST_COLLECTION].find_one({"name": "raw"}, {"_id": 0, "byte_size": 1,
+                                                                                "element_count": 1, "content_hash": 1})
+        assert entry == blobs.describe_data(data)
+
+
+    def test_39(self):
+        # the projects of the consolidated layout share the collections without seeing each other's documents
+        database = mongomock.MongoClient()[storage.CONSOLIDATED_DATABASE]
+        first, second = storage.Scoped_Database(database, "test_first"), storage.Scoped_Database(database, "test_second")
+        for project in (first, second):
+            project["config"].insert_one({"name": project.name, "author": [{"name": "test_user"}]})
+            project["experiment_1"].insert_many([{"name": "a", "meta": {"k": 1}}, {"name": "b", "meta": {"k": 2}}])
+        second["experiment_2"].insert_one({"name": "c"})
+        assert sorted(first.list_collection_names()) == ["config", "experiment_1"]
+        assert sorted(second.list_collection_names()) == ["config", "experiment_1", "experiment_2"]
+        assert database[storage.DATASETS_COLLECTION].count_documents({"name": "a"}) == 2
+        # the scope is added to the queries, the written documents and the bulk writes
+        first["experiment_1"].update_one({"name": "a"}, {"$set": {"meta.k": 5}})
+        experiment = first["experiment_1"]
+        experiment.bulk_write([bulk.replace_one(experiment, {"name": "b"}, {"name": "b", "meta": {"k": 6}}),
+                               bulk.insert_one(experiment, {"name": "d"})])
+        assert bulk.replace_one(experiment, {"name": "b"}, {"name": "b"}) == \
+            ReplaceOne({"$and": [{"project": "test_first", "experiment": "experiment_1"}, {"name": "b"}]},
+                       {"name": "b", "project": "test_first", "experiment": "experiment_1"})
+        assert bulk.update_one(database["samples"], {"name": "b"}, {"$set": {"k": 1}}) == \
+            UpdateOne({"name": "b"}, {"$set": {"k": 1}})
+        documents = first["experiment_1"].find({}, {"_id": 0})
+        assert sorted((document["name"], document.get("meta")) for document in documents) == \
+            [("a", {"k": 5}), ("b", {"k": 6}), ("d", None)]
+        assert [document["meta"]["k"] for document in second["experiment_1"].find({}, {"_id": 0}).sort("name")] == [1, 2]
+        assert first["experiment_1"].find_one({"name": "a"}, {"_id": 0}) == {"name": "a", "meta": {"k": 5}}
+        assert sorted(first["experiment_1"].distinct("name")) == ["a", "b", "d"]
+        first["experiment_1"].delete_many({})
+        assert second["experiment_1"].count_documents({}) == 2 and first["experiment_1"].count_documents({}) == 0
+        # the dotted scope of the samples is written into the embedded document
+        samples = storage.Scoped_Collection(database["samples"], {"series.project": "test_first"})
+        samples.insert_one({"series": {"name": "s"}, "value": 1})
+        assert database["samples"].find_one({}, {"_id": 0}) == {"series": {"name": "s", "project": "test_first"},
+                                                                "value": 1}
+
+
+    def test_40(self):
+        # samples of a series with the same time are paged by their _id, so none is skipped or repeated
+        project = mongomock.MongoClient()["test_samples_project"]
+        # mongomock has no time-series collections
+        timeseries.created_projects.add(project.name)
+        start = datetime(2026, 1, 1)
+        project[timeseries.SAMPLES_COLLECTION].insert_many(
+            [{"time": start + timedelta(seconds=i // 3), "series": {"experiment": "test_experiment", "name": series},
+              "values": {"v": i}} for i in range(9) for series in ("a", "b")])
+        query = d.Sample_Query(username="test_user", token="token")
+        values = []
+        cursor = None
+        while True:
+            page = timeseries.query_samples(project, "test_experiment", ["v"], query, cursor, 2)
+            values += [(row["series"], row["values"][0]) for row in page["samples"]]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+        assert sorted(values) == [(series, i) for series in ("a", "b") for i in range(9)] and len(values) == 18
+        # cursors without the _id, issued before it was added, are still accepted
+        old_cursor = pagination.encode_cursor(json.dumps([start.isoformat(), "b"]))
+        page = timeseries.query_samples(project, "test_experiment", ["v"], query, old_cursor, 100)
+        assert len(page["samples"]) == 12
+
+
+    def test_41(self):
+        # the queued frames are written when the client disconnects while they are being acknowledged
+        written = []
+
+        class Session(ingest.Ingest_Session):
+            def parse(self, frame):
+                return ("test_project", "test_experiment", frame["dataset"]), frame["rows"]
+
+            def write(self, key, rows):
+                written.extend(rows)
+
+        class Disconnecting_Socket(object):
+            def __init__(self):
+                self.sent = []
+
+            async def send_json(self, message):
+                if len(self.sent) == 1:
+                    raise RuntimeError("The connection is closed")
+                self.sent.append(message)
+
+        async def run():
+            queue = asyncio.Queue()
+            websocket = Disconnecting_Socket()
+            task = asyncio.ensure_future(ingest.write_frames(websocket, Session(None, "test_user"), queue))
+            for frame_id in range(3):
+                await queue.put({"id": frame_id, "dataset": "a", "rows": [[frame_id]]})
+                await asyncio.sleep(0.01)
+            await queue.put(None)
+            await task
+            return websocket.sent
+        sent = asyncio.run(run())
+        assert written == [[0], [1], [2]]
+        assert sent == [{"acks": [0], "written": 1}]
+
+
+    def test_42(self):
+        # the transforms select the values, compute with NumPy and the results are only reused for the same version
+        rows = [[i, i * i] for i in range(8)]
+        data, headings = derived.compute("histogram", {"column": "y", "bins": 2}, rows, ["x", "y"])
+        assert data == [[12.25, 5], [36.75, 3]] and headings == ["y", "count"]
+        data, headings = derived.compute("log", {"base": 2}, [1, 4, 0, -1], ["v"])
+        assert data == [0.0, 2.0, None, None] and headings == ["log(v)"]
+        data, headings = derived.compute("fft", {"sample_spacing": 0.5}, [1, 0, -1, 0], None)
+        assert data == [[0.0, 0.0], [0.5, 2.0], [1.0, 0.0]] and headings == ["frequency", "amplitude(value)"]
+        for transform, params, values in (("histogram", {}, rows), ("log", {"base": 1}, [1]), ("fft", {"row": 9}, rows),
+                                          ("log", {}, ["a"]), ("histogram", {"column": "z"}, rows)):
+            try:
+                derived.compute(transform, params, values, ["x", "y"])
+                assert False
+            except ValueError:
+                pass
+        try:
+            derived.params_key("median", {})
+            assert False
+        except ValueError:
+            pass
+        assert derived.params_key("log", {"b": 1, "a": 2}) == derived.params_key("log", {"a": 2, "b": 1})
+        project = mongomock.MongoClient()["test_derived_project"]
+        source = {"_id": 1, "name": "spectrum", "version": 0}
+        key = derived.params_key("log", None)
+        derived.store(project, "test_experiment", source, "log", key, [0.0], ["log(value)"])
+        assert derived.lookup(project, "test_experiment", source, "log", key)["data"] == [0.0]
+        assert derived.lookup(project, "test_experiment", dict(source, version=1), "log", key) is None
+        derived.invalidate(project, "test_experiment", "spectrum")
+        assert derived.lookup(project, "test_experiment", source, "log", key) is None
+
+
+    def test_43(self):
+        # object meta values are searched by their fields, so the field order of the stored object doesn't matter
+        collection = mongomock.MongoClient()["test_meta_project"]["test_experiment"]
+        collection.insert_many([{"name": "reordered", "meta": {"k": {"b": 2, "a": 1}, "n": 1}},
+                                {"name": "extra", "meta": {"k": {"a": 1, "b": 2, "c": 3}, "n": 1}},
+                                {"name": "other", "meta": {"k": {"a": 1, "b": 3}, "n": 1}}])
+        search = {"k": {"a": 1, "b": 2}, "n": 1}
+        query = {}
+        for key, value in search.items():
+            storage.narrow_meta("meta." + key, value, query)
+        assert query == {"meta.k.a": 1, "meta.k.b": 2, "meta.n": 1}
+        candidates = [document for document in collection.find(query)]
+        assert sorted(document["name"] for document in candidates) == ["extra", "reordered"]
+        assert [document["name"] for document in candidates
+                if all(document["meta"].get(key) == value for key, value in search.items())] == ["reordered"]
+        # keys which aren't paths are left to the exact comparison
+        query = {}
+        storage.narrow_meta("meta.k", {"a.b": 1, "$gt": 0, "c": {"d": [1, 2]}}, query)
+        assert query == {"meta.k.c.d": [1, 2]}
+
+    def test_44(self):
+        # the cached pages are kept per user and only returned while the experiment is unchanged and fresh
+        cache = search_cache.Search_Cache(max_size=2, ttl=0.2)
+        alice = cache.key("test_project", "test_experiment", "alice", {"b": 1, "a": 2}, None, 10)
+        bob = cache.key("test_project", "test_experiment", "bob", {"a": 2, "b": 1}, None, 10)
+        assert alice[:2] == ("test_project", "test_experiment") and alice != bob
+        assert alice == cache.key("test_project", "test_experiment", "alice", {"a": 2, "b": 1}, None, 10)
+        cache.put(alice, cache.generation("test_project", "test_experiment"), {"names": ["a"], "next_cursor": None})
+        assert cache.get(alice) == {"names": ["a"], "next_cursor": None} and cache.get(bob) is None
+        # a write to the experiment makes the page stale, also a page read while the write happened
+        generation = cache.generation("test_project", "test_experiment")
+        cache.invalidate("test_project", "test_experiment")
+        assert cache.get(alice) is None
+        cache.put(alice, generation, {"names": [], "next_cursor": None})
+        assert cache.get(alice) is None
+        cache.invalidate("test_project", "other_experiment")
+        cache.put(alice, cache.generation("test_project", "test_experiment"), {"names": ["a"], "next_cursor": None})
+        assert cache.get(alice) is not None
+        # the least recently used page is evicted and the pages expire
+        cache.put(bob, cache.generation("test_project", "test_experiment"), {"names": ["b"], "next_cursor": None})
+        cache.get(alice)
+        third = cache.key("test_project", "test_experiment", "carol", {}, None, 10)
+        cache.put(third, cache.generation("test_project", "test_experiment"), {"names": [], "next_cursor": None})
+        assert list(cache.entries) == [alice, third]
+        time.sleep(0.25)
+        assert cache.get(alice) is None
+        cache.put(alice, cache.generation("test_project", "test_experiment"), {"names": ["a"], "next_cursor": None})
+        cache.clear()
+        assert cache.get(alice) is None and len(cache.entries) == 0
+        assert cache.hits == 3 and cache.misses == 5
+
+
+    def test_45(self):
+        # the experiments of the consolidated layout are backfilled one by one, and searched by regex until then
+        database = mongomock.MongoClient()[storage.CONSOLIDATED_DATABASE]
+        project = storage.Scoped_Database(database, "test_name_search")
+        first, second = project["experiment_1"], project["experiment_2"]
+        for experiment in (first, second):
+            experiment.insert_many([{"name": name, "author": [{"name": "test_user"}]}
+                                    for name in ("sample_one", "sample_two", "other")])
+        assert pagination.collection_key(first) != pagination.collection_key(second)
+        name_search.indexed_collections.clear()
+        assert name_search.search(first, "test_user", None, "mple", None, 10)["names"] == ["sample_one", "sample_two"]
+        for thread in threading.enumerate():
+            if thread.name == "name_search_backfill":
+                thread.join(10)
+        assert pagination.collection_key(first) in name_search.indexed_collections
+        assert pagination.collection_key(second) not in name_search.indexed_collections
+        assert first.count_documents({name_search.GRAMS_FIELD: {"$exists": False}}) == 0
+        assert second.count_documents({name_search.GRAMS_FIELD: {"$exists": False}}) == 3
+        assert name_search.prepare(first)
+        assert name_search.search(first, "test_user", "sam", "two", None, 10)["names"] == ["sample_two"]
+        assert name_search.search(second, "test_user", None, "oth", None, 10)["names"] == ["other"]
+        # the search of the second experiment started its own backfill
+        for thread in threading.enumerate():
+            if thread.name == "name_search_backfill":
+                thread.join(10)
+        assert name_search.search_query("test_user", None, "oth", grams=False) == \
+            {"$and": [{"author.name": "test_user"}, {"name": {"$regex": "oth"}}]}
+        assert name_search.prepare(second)
+
+
+    def test_46(self):
+        # the migration reports its progress after every batch, so a long collection keeps the job alive
+        class Recording_Context(object):
+            def __init__(self):
+                self.reports = []
+
+            def progress(self, done, total=None, message=None):
+                self.reports.append((done, message))
+
+        client = mongomock.MongoClient()
+        client["test_migration"]["experiment_1"].insert_many([{"name": f"dataset_{i}"} for i in range(5)])
+        context = Recording_Context()
+        assert migrate.copy_collection(client, "test_migration", "experiment_1", 2, context, 10) == 5
+        assert context.reports == [(12, "experiment_1"), (14, "experiment_1")]
+        # the job counts the documents, and the counters of the runner are updated under its lock
+        client["test_migration"]["config"].insert_one({"name": "test_migration"})
+        runner = jobs.Job_Runner(client)
+        runner.submit("migrate_project", {"project": "test_migration"}, "test_user")
+        runner.execute(runner.claim())
+        job = runner.collection().find_one({})
+        assert job["status"] == jobs.DONE and job["result"] == {"copied": 6}
+        assert job["progress"] == {"done": 6, "total": 6}
+        runner.submit("migrate_project", {}, "test_user")
+        runner.execute(runner.claim())
+        assert runner.finished == 1 and runner.failed == 1 and runner.running == 0
+
+
+    def test_47(self):
+        # a short load test against mongomock runs every operation of the mix without errors
+        import load_testing
+        report = load_testing.run_load_test(users=2, duration=1.0, seed_datasets=3, data_size=20)
+        operations, routes = report["operations"], report["routes"]
+        assert set(operations) == set(load_testing.DEFAULT_MIX) | {"total"}
+        assert operations["total"]["requests"] > 0 and operations["total"]["errors"] == 0
+        # the requests are reported by route, the meta search only calls its own route
+        assert routes["GET /{project_id}/{experiment_id}/meta_search"]["requests"] == \
+            operations["meta_search"]["requests"]
+        assert routes["POST /{project_id}/{experiment_id}/{dataset_id}/return_dataset"]["requests"] == \
+            operations["return_dataset"]["requests"]
+        assert all(entry["errors"] == 0 for entry in routes.values())
+
+
+    def test_48(self):
+        # the command listener attributes the MongoDB commands to the request, and the debug headers report them
+        def event(request_id, command_name, micros=0, reply=None):
+            return SimpleNamespace(connection_id=1, request_id=request_id, command_name=command_name,
+                                   duration_micros=micros, reply=reply, database_name="test_project",
+                                   command={command_name: "test_experiment", "filter": {"name": "a"}})
+
+        listener = monitoring.Command_Listener()
+        listener.capture_commands = True
+        finished = []
+        app = FastAPI()
+        app.add_middleware(monitoring.Monitoring_Middleware)
+
+        @app.get("/{project_id}/names")
+        async def names(project_id: str):
+            listener.started(event(1, "find"))
+            listener.succeeded(event(1, "find", 2000, {"cursor": {"firstBatch": [{"name": "a"}, {"name": "b"}]}}))
+            monitoring.COUNT_REPLY_BYTES = True
+            reply = {"value": {"name": "a"}, "ok": 1}
+            listener.succeeded(event(2, "findAndModify", 3000, reply))
+            monitoring.COUNT_REPLY_BYTES = False
+            listener.failed(event(3, "insert", 1000))
+            return len(bson.encode(reply))
+
+        saved = (list(monitoring.command_hooks), list(monitoring.response_start_hooks))
+        monitoring.command_hooks[:] = [lambda *arguments: finished.append(arguments)]
+        monitoring.response_start_hooks[:] = [monitoring.add_debug_headers]
+        try:
+            response = TestClient(app).get("/test_project/names")
+            # a command outside a request is counted without a context
+            listener.succeeded(event(4, "find", 1000, {"cursor": {"nextBatch": [{}]}}))
+        finally:
+            monitoring.command_hooks[:], monitoring.response_start_hooks[:] = saved
+        assert response.headers["x-mongo-commands"] == "3"
+        assert response.headers["x-mongo-duration-ms"] == "6.0"
+        assert response.headers["x-mongo-reply-bytes"] == str(response.json())
+        assert response.headers["x-mongo-reply-documents"] == "3"
+        assert response.headers["x-mongo-command-counts"] == "find=1,findAndModify=1,insert=1"
+        context = finished[0][0]
+        assert context.route == "/{project_id}/names" and context.path_params == {"project_id": "test_project"}
+        assert finished[0][1:] == ("find", 0.002, 0, {"collection": "test_experiment", "database": "test_project",
+                                                      "filter": {"name": "a"}}, 2)
+        assert [arguments[5] for arguments in finished] == [2, 1, 0, 1] and finished[3][0] is None
+
+
+    def test_49(self):
+        # the slow log writes one JSON line per request or command over its threshold, without the filter values
+        file_name = "test_slow.log"
+        if exists(file_name):
+            os.remove(file_name)
+        log = slow_log.Slow_Log(file_name, request_threshold=0.5, query_threshold=0.1)
+        context = monitoring.Request_Context("POST", "/test_project/test_experiment/meta_search",
+                                             "/{project_id}/{experiment_id}/meta_search",
+                                             {"project_id": "test_project", "experiment_id": "test_experiment"}, 120)
+        context.status, context.duration, context.response_bytes = 200, 0.2, 3000
+        context.mongo_commands, context.mongo_command_counts = 2, {"find": 2}
+        context.annotations = {"filters": ["sample_id", "temperature"]}
+        log.request_finished(context)
+        assert not exists(file_name)
+        context.duration = 0.75
+        log.request_finished(context)
+        details = {"database": "test_project", "collection": "test_experiment",
+                   "filter": {"$and": [{"author.name": "test_user"}, {"meta.sample_id": {"$in": [1, 2]}}]}}
+        log.command_finished(context, "find", 0.05, 0, details, 4)
+        log.command_finished(context, "find", 0.25, 0, details, 4)
+        with open(file_name) as f:
+            request, query = [json.loads(line) for line in f]
+        os.remove(file_name)
+        assert request["type"] == "request" and request["route"] == "/{project_id}/{experiment_id}/meta_search"
+        assert (request["project"], request["experiment"]) == ("test_project", "test_experiment")
+        assert request["duration_ms"] == 750.0 and request["response_bytes"] == 3000
+        assert request["mongo_commands"] == 2 and request["mongo_command_counts"] == {"find": 2}
+        assert request["parameters"] == {"filters": ["sample_id", "temperature"]}
+        assert query["type"] == "query" and query["command"] == "find" and query["reply_documents"] == 4
+        assert query["filter"] == {"$and": [{"author.name": "?"}, {"meta.sample_id": {"$in": ["?", "?"]}}]}
+        assert slow_log.query_shape([{"a": 1}, "b"]) == [{"a": "?"}, "?"]
+
+
+    def test_50(self):
+        # the export uses the access rule of the server and leaves out the time-series experiments
+        project = mongomock.MongoClient()["test_export_project"]
+        reader = [{"name": "reader", "permission": "read"}]
+        project["config"].insert_one({"name": "test_export_project", "author": reader})
+        project["experiment_1"].insert_many([
+            {"name": "experiment_1", "data_type": archive.EXPERIMENT_CONFIG_TYPE, "author": reader},
+            {"name": "dataset_1", "data": [1, 2], "author": reader},
+            {"name": "hidden", "data": [3], "author": [{"name": "other", "permission": "write"}]}])
+        project["experiment_2"].insert_one({"name": "experiment_2", "data_type": archive.EXPERIMENT_CONFIG_TYPE,
+                                            "author": [{"name": "other", "permission": "write"}]})
+        project["series"].insert_one({"name": "series", "data_type": timeseries.TIMESERIES_TYPE, "author": reader})
+        lines = [json.loads(line) for line in archive.export_project(project, "reader")]
+        assert [(line["type"], line["name"]) for line in lines] == \
+            [("project", "test_export_project"), ("experiment", "experiment_1"), ("dataset", "dataset_1")]
+
         
 #def main():
 #    test_class = TestClass()